@@ -0,0 +1,328 @@
+"""Throughput and latency benchmarks for the file transfer client and server.
+
+Starts filetransferserver.py as a subprocess listening on loopback in a scratch directory and
+drives FileTransferClient over a matrix of file sizes, chunk counts and warm or cold page cache,
+then times the small requests (PING, STAT, LIST_PAGE) and a batch of small files. The report is
+JSON: MB/s and per-operation latency for every case, and the peak RSS of client and server.
+
+    python benchmarks/bench.py --output before.json
+    python benchmarks/bench.py --baseline before.json --output after.json
+
+With --baseline every case is compared to the same case of an earlier report, and the run exits
+with status 1 when throughput dropped or latency grew by more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import filetransferclient
+
+SIZES = '4K,256K,4M,64M'
+CHUNKS = '1,4,8'
+CACHES = 'warm,cold'
+REPEAT = 3
+# Round trips timed for every small request
+LATENCY_SAMPLES = 200
+BATCH_FILES = 500
+BATCH_FILE_SIZE = 4 * 1024
+TOLERANCE = 0.1
+SERVER_START_TIMEOUT = 10
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    ordered = sorted(samples)
+    pick = lambda fraction: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    return {
+        'min': round(ordered[0] * 1000, 3),
+        'p50': round(pick(0.5) * 1000, 3),
+        'p95': round(pick(0.95) * 1000, 3),
+        'max': round(ordered[-1] * 1000, 3),
+    }
+
+def drop_cache(*paths: str):
+    """Evict files, or every file under directories, from the page cache. Dirty pages have to be
+    written back first, so the files are synced before the kernel is told to drop them."""
+    for path in paths:
+        files = [path] if os.path.isfile(path) else [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+        for file_path in files:
+            fd = os.open(file_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+def client_peak_rss() -> int | None:
+    """Peak resident set size of this process in KiB."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def server_peak_rss(pid: int) -> int | None:
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
+@contextlib.contextmanager
+def running_server(directory: str, port: int, server_args: list[str]):
+    """filetransferserver.py running in `directory` until the block exits."""
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'filetransferserver.py'), '--host', '127.0.0.1', '--port', str(port), *server_args],
+                               cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("The server did not start")
+                time.sleep(0.05)
+        yield process
+
+    finally:
+        process.terminate()
+        process.wait()
+
+def transfer_case(client: filetransferclient.FileTransferClient, directory: str, size: int, chunks: int, cache: str, repeat: int) -> list[dict]:
+    """Upload then download a file of `size` bytes `repeat` times with `chunks` streams."""
+    source = os.path.join(directory, f'source-{size}')
+    if not os.path.exists(source):
+        with open(source, 'wb') as file:
+            file.write(os.urandom(size))
+    server_directories = [os.path.join(directory, name) for name in ('server_data', 'server_cas') if os.path.isdir(os.path.join(directory, name))]
+
+    timings: dict[str, list[float]] = {'upload': [], 'download': []}
+    errors: dict[str, int] = {'upload': 0, 'download': 0}
+    for i in range(repeat):
+        name = f'bench-{size}-{chunks}-{cache}-{i}'
+        path = os.path.join(directory, name)
+        shutil.copyfile(source, path)
+        if cache == 'cold':
+            drop_cache(path)
+        start = time.perf_counter()
+        uploaded = client.upload_file(path, chunks)
+        timings['upload'].append(time.perf_counter() - start)
+        errors['upload'] += not uploaded
+        os.remove(path)
+
+        destination = os.path.join(directory, 'download')
+        if cache == 'cold':
+            drop_cache(*server_directories)
+        start = time.perf_counter()
+        downloaded = client.download_file(name, destination, chunks)
+        timings['download'].append(time.perf_counter() - start)
+        errors['download'] += not downloaded
+        os.remove(destination)
+        client.delete_file(name)
+
+    return [{
+        'op': op,
+        'size': size,
+        'chunks': chunks,
+        'cache': cache,
+        'repeat': repeat,
+        'errors': errors[op],
+        'mb_per_s': round(size * repeat / sum(samples) / 1e6, 3),
+        'latency_ms': percentiles(samples),
+    } for op, samples in timings.items()]
+
+def latency_cases(client: filetransferclient.FileTransferClient, directory: str, samples: int) -> list[dict]:
+    """Round trip time of the requests that carry no file data."""
+    path = os.path.join(directory, 'bench-stat')
+    with open(path, 'wb') as file:
+        file.write(b'\0' * 1024)
+    client.upload_file(path)
+
+    requests = {
+        'ping': client.ping,
+        'stat': lambda: client.stat('bench-stat'),
+        'list_page': lambda: client.list_page(limit=100),
+    }
+    results: list[dict] = []
+    for op, request in requests.items():
+        timings: list[float] = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            request()
+            timings.append(time.perf_counter() - start)
+        results.append({'op': op, 'repeat': samples, 'latency_ms': percentiles(timings)})
+
+    client.delete_file('bench-stat')
+    return results
+
+def batch_case(client: filetransferclient.FileTransferClient, directory: str, file_count: int, file_size: int, chunks: int) -> list[dict]:
+    """Upload and download a directory of many small files."""
+    tree = os.path.join(directory, 'tree')
+    for i in range(file_count):
+        subdirectory = os.path.join(tree, f'd{i % 10}')
+        os.makedirs(subdirectory, exist_ok=True)
+        with open(os.path.join(subdirectory, f'f{i}'), 'wb') as file:
+            file.write(os.urandom(file_size))
+
+    results: list[dict] = []
+    start = time.perf_counter()
+    failed = client.upload_directory(tree, 'bench-tree', chunks)
+    upload_time = time.perf_counter() - start
+    start = time.perf_counter()
+    failed_downloads = client.download_directory('bench-tree', os.path.join(directory, 'tree-download'), chunks)
+    download_time = time.perf_counter() - start
+
+    for op, elapsed, errors in (('upload_directory', upload_time, failed), ('download_directory', download_time, failed_downloads)):
+        results.append({
+            'op': op,
+            'size': file_size,
+            'files': file_count,
+            'chunks': chunks,
+            'errors': len(errors),
+            'files_per_s': round(file_count / elapsed, 1),
+            'mb_per_s': round(file_count * file_size / elapsed / 1e6, 3),
+        })
+
+    for name, _, _ in list(client.iter_files('bench-tree/')):
+        client.delete_file(name)
+    shutil.rmtree(tree)
+    shutil.rmtree(os.path.join(directory, 'tree-download'), ignore_errors=True)
+    return results
+
+
+
+def case_key(result: dict) -> tuple:
+    return tuple(result.get(field) for field in ('op', 'size', 'chunks', 'cache', 'files'))
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[dict]:
+    """Cases whose throughput fell or whose median latency grew by more than `tolerance`."""
+    previous = {case_key(result): result for result in baseline['results']}
+    regressions: list[dict] = []
+    for result in report['results']:
+        before = previous.get(case_key(result))
+        if before is None or result.get('errors') or before.get('errors'):
+            continue
+        for metric in ('mb_per_s', 'files_per_s'):
+            if metric in result and metric in before and result[metric] < before[metric] * (1 - tolerance):
+                regressions.append({'case': case_key(result), 'metric': metric, 'baseline': before[metric], 'current': result[metric]})
+        if 'latency_ms' in result and 'latency_ms' in before:
+            now, then = result['latency_ms']['p50'], before['latency_ms']['p50']
+            if now > then * (1 + tolerance):
+                regressions.append({'case': case_key(result), 'metric': 'latency_ms.p50', 'baseline': then, 'current': now})
+    return regressions
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the file transfer client and server on loopback")
+    parser.add_argument('--sizes', default=SIZES, help="comma separated file sizes, K/M/G suffixes allowed")
+    parser.add_argument('--chunks', default=CHUNKS, help="comma separated stream counts, 0 for the adaptive mode")
+    parser.add_argument('--cache', default=CACHES, help="warm, cold or both; cold evicts the files from the page cache before every transfer")
+    parser.add_argument('--repeat', type=int, default=REPEAT, help="transfers timed per case")
+    parser.add_argument('--latency-samples', type=int, default=LATENCY_SAMPLES, help="round trips timed per small request, 0 to skip")
+    parser.add_argument('--batch-files', type=int, default=BATCH_FILES, help="files in the directory transfer case, 0 to skip")
+    parser.add_argument('--compression', default='none', help="client compression preference, 'auto' for the best codec both sides have, 'none' to send raw")
+    parser.add_argument('--engine', choices=('thread', 'selector'), default='thread', help="server engine")
+    parser.add_argument('--storage', choices=('flat', 'cas'), default='flat', help="server storage")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--baseline', help="earlier JSON report to compare with")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help="relative change allowed before a case counts as a regression")
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes.split(',') if size]
+    chunk_counts = [int(chunks) for chunks in args.chunks.split(',') if chunks]
+    caches = [cache for cache in args.cache.split(',') if cache]
+    if 'cold' in caches and not hasattr(os, 'posix_fadvise'):
+        print("Cold cache runs need posix_fadvise, running warm only", file=sys.stderr)
+        caches = [cache for cache in caches if cache != 'cold']
+
+    port = free_port()
+    directory = tempfile.mkdtemp(prefix='ftbench-')
+    try:
+        with running_server(directory, port, ['--engine', args.engine, '--storage', args.storage]) as server:
+            client = filetransferclient.FileTransferClient(port, '127.0.0.1', compression=None if args.compression == 'none' else args.compression)
+            # Negotiate and open a connection before the first case is timed
+            client.ping()
+            results: list[dict] = []
+            for size in sizes:
+                for chunks in chunk_counts:
+                    for cache in caches:
+                        results += transfer_case(client, directory, size, chunks, cache, args.repeat)
+                        print(f"{size} bytes, {chunks} streams, {cache}: "
+                              + ", ".join(f"{result['op']} {result['mb_per_s']} MB/s" for result in results[-2:]), file=sys.stderr)
+            if args.latency_samples:
+                results += latency_cases(client, directory, args.latency_samples)
+            if args.batch_files:
+                results += batch_case(client, directory, args.batch_files, BATCH_FILE_SIZE, max(chunk_counts, default=4))
+            client.close()
+            peak_rss = {'client_kib': client_peak_rss(), 'server_kib': server_peak_rss(server.pid)}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'engine': args.engine,
+            'storage': args.storage,
+            'compression': args.compression,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+        'peak_rss': peak_rss,
+    }
+
+    regressions: list[dict] = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(report, baseline, args.tolerance)
+        report['comparison'] = {'baseline': baseline.get('meta', {}).get('revision'), 'tolerance': args.tolerance, 'regressions': regressions}
+        for regression in regressions:
+            print(f"[REGRESSION] {regression['case']} {regression['metric']}: {regression['baseline']} -> {regression['current']}", file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import threading
+from typing import BinaryIO
+
+import commands
+import fileio
+
+
+
+class BlockStore:
+    """Content-addressed store for the DIGEST_BLOCK_SIZE blocks of complete files.
+
+    Every distinct block is kept once, named after its BLAKE2b digest, and a
+    file is a manifest listing the digests of its blocks, so blocks shared by
+    several files (or by two versions of one file) take disk space only once.
+    Reference counts are rebuilt from the manifests at startup and a block is
+    removed when the last manifest using it is deleted. Uploads in progress
+    hold the blocks they count on, which keeps a block without references
+    until its last holder is done with it.
+    """
+    root: str
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.lock = threading.RLock()
+        self._refs: dict[str, int] = {}
+        self._manifests: dict[str, dict] = {}
+        # Digests held by each upload in progress, and how many uploads hold each digest
+        self._holds: dict[str, set[str]] = {}
+        self._holders: dict[str, int] = {}
+
+        os.makedirs(os.path.join(root, 'blocks'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'files'), exist_ok=True)
+        for file_name in self.file_names():
+            for block in self.manifest(file_name)['blocks']:
+                self._refs[block] = self._refs.get(block, 0) + 1
+
+    def block_path(self, digest: bytes) -> str:
+        name = digest.hex()
+        return os.path.join(self.root, 'blocks', name[:2], name)
+
+    def manifest_path(self, file_name: str) -> str:
+        return os.path.join(self.root, 'files', fileio.flat_name(file_name) + '.json')
+
+    def has_block(self, digest: bytes) -> bool:
+        return os.path.exists(self.block_path(digest))
+
+    def has_file(self, file_name: str) -> bool:
+        return os.path.exists(self.manifest_path(file_name))
+
+    def file_names(self) -> list[str]:
+        return [fileio.unflat_name(name[:-len('.json')]) for name in os.listdir(os.path.join(self.root, 'files')) if name.endswith('.json')]
+
+    def manifest(self, file_name: str) -> dict | None:
+        with self.lock:
+            manifest = self._manifests.get(file_name)
+            if manifest is None:
+                try:
+                    with open(self.manifest_path(file_name), 'r') as file:
+                        manifest = json.load(file)
+                except FileNotFoundError:
+                    return None
+                self._manifests[file_name] = manifest
+            return manifest
+
+    def file_size(self, file_name: str) -> int:
+        return self.manifest(file_name)['size']
+
+    def file_ctime(self, file_name: str) -> float:
+        return self.manifest(file_name)['ctime']
+
+    def segments(self, file_name: str, start_byte: int, end_byte: int) -> list[tuple[str, int, int]]:
+        """(block path, offset, count) pieces holding the inclusive byte range, in order."""
+        blocks = self.manifest(file_name)['blocks']
+        segments: list[tuple[str, int, int]] = []
+        for piece_start, piece_end in fileio.digest_pieces(start_byte, end_byte):
+            index = piece_start // commands.DIGEST_BLOCK_SIZE
+            segments.append((self.block_path(bytes.fromhex(blocks[index])),
+                             piece_start - index * commands.DIGEST_BLOCK_SIZE, piece_end - piece_start + 1))
+        return segments
+
+    def hold(self, holder: str, digest: bytes):
+        """Keep the block `digest` for the upload `holder` even if no file refers to it anymore."""
+        block = digest.hex()
+        with self.lock:
+            blocks = self._holds.setdefault(holder, set())
+            if block not in blocks:
+                blocks.add(block)
+                self._holders[block] = self._holders.get(block, 0) + 1
+
+    def drop_holds(self, holder: str):
+        """Let go of every block `holder` held, removing the ones nothing else needs."""
+        with self.lock:
+            for block in self._holds.pop(holder, ()):
+                self._holders[block] -= 1
+                if not self._holders[block]:
+                    del self._holders[block]
+                    self._collect(block)
+
+    def _collect(self, block: str):
+        if block in self._refs or block in self._holders:
+            return
+        try:
+            os.remove(self.block_path(bytes.fromhex(block)))
+        except FileNotFoundError:
+            pass
+
+    def collect_garbage(self):
+        """Remove the blocks nothing refers to or holds, left behind by a crash."""
+        with self.lock:
+            blocks_path = os.path.join(self.root, 'blocks')
+            for prefix in os.listdir(blocks_path):
+                for name in os.listdir(os.path.join(blocks_path, prefix)):
+                    if '.' not in name:
+                        self._collect(name)
+
+    def ingest(self, file_name: str, path: str, digests: list[bytes | None]) -> list[bytes]:
+        """Turn the complete flat file at `path` into a manifest, storing only the blocks the
+        store does not have yet, then remove the flat file and return the block digests.
+        Blocks whose digest is not known (uploads from v1 clients) are hashed here. A manifest
+        the file already had is replaced and its blocks released as in delete_file."""
+        file_size = os.path.getsize(path)
+        stored: list[bytes] = []
+        with open(path, 'rb') as file:
+            for index, digest in enumerate(digests):
+                offset = index * commands.DIGEST_BLOCK_SIZE
+                count = min(commands.DIGEST_BLOCK_SIZE, file_size - offset)
+                if digest is None:
+                    file.seek(offset)
+                    block_hash = fileio.new_hash()
+                    block_hash.update(file.read(count))
+                    digest = block_hash.digest()
+                # Taking the reference first keeps a concurrent delete from collecting the block
+                with self.lock:
+                    self._refs[digest.hex()] = self._refs.get(digest.hex(), 0) + 1
+                    present = self.has_block(digest)
+                if not present:
+                    self._store_block(file, offset, count, digest)
+                stored.append(digest)
+
+        manifest = {'size': file_size, 'ctime': time.time(), 'blocks': [digest.hex() for digest in stored]}
+        with self.lock:
+            previous = self.manifest(file_name)
+            temporary_path = self.manifest_path(file_name) + '.tmp'
+            with open(temporary_path, 'w') as file:
+                json.dump(manifest, file)
+            os.replace(temporary_path, self.manifest_path(file_name))
+            self._manifests[file_name] = manifest
+            if previous is not None:
+                self._release(previous['blocks'])
+        os.remove(path)
+        return stored
+
+    def _store_block(self, file: BinaryIO, offset: int, count: int, digest: bytes):
+        path = self.block_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, 'wb') as block:
+            if hasattr(os, 'copy_file_range'):
+                copied = 0
+                while copied < count:
+                    size = os.copy_file_range(file.fileno(), block.fileno(), count - copied, offset + copied)
+                    if not size:
+                        break
+                    copied += size
+            else:
+                file.seek(offset)
+                block.write(file.read(count))
+        os.replace(temporary_path, path)
+
+    def delete_file(self, file_name: str):
+        """Remove a manifest and every block no other file refers to or upload holds."""
+        with self.lock:
+            manifest = self.manifest(file_name)
+            self._manifests.pop(file_name, None)
+            os.remove(self.manifest_path(file_name))
+            self._release(manifest['blocks'])
+
+    def _release(self, blocks: list[str]):
+        for block in blocks:
+            self._refs[block] -= 1
+            if self._refs[block] > 0:
+                continue
+            del self._refs[block]
+            self._collect(block)
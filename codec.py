@@ -0,0 +1,166 @@
+import os
+import zlib
+import lzma
+import struct
+import socket
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable
+
+import fileio
+from tracing import tracer
+
+# zstd is in the standard library from Python 3.14, the zstandard package provides it before that
+try:
+    from compression import zstd
+
+    def zstd_compress(data) -> bytes:
+        return zstd.compress(data, level=3)
+
+    def zstd_decompress(data: bytes, max_length: int) -> bytes:
+        return zstd.ZstdDecompressor().decompress(data, max_length)
+
+except ImportError:
+    try:
+        import zstandard
+
+        def zstd_compress(data) -> bytes:
+            return zstandard.ZstdCompressor(level=3).compress(data)
+
+        def zstd_decompress(data: bytes, max_length: int) -> bytes:
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_length)
+
+    except ImportError:
+        zstd_compress = zstd_decompress = None
+
+# Codec ids sent in every frame header, RAW frames are sent as they are
+RAW = 0
+ZLIB = 1
+LZMA = 2
+ZSTD = 3
+CODECS = {'zstd': ZSTD, 'zlib': ZLIB, 'lzma': LZMA}
+
+# Compressed payloads are cut into frames of at most FRAME_SIZE bytes, each one is
+# compressed on its own and preceded by '!BII': codec, original length, payload length
+FRAME_SIZE = 256 * 1024
+FRAME_HEADER = struct.Struct('!BII')
+# The start of every frame is compressed first, frames whose sample does not shrink by
+# at least MIN_SAVING are sent raw without spending time on the rest
+SAMPLE_SIZE = 16 * 1024
+MIN_SAVING = 0.1
+# Frames compressed ahead of the one being sent
+LOOKAHEAD = 4
+
+# zlib, lzma and zstd release the GIL while they work, so compressing on these threads
+# overlaps with the socket I/O of the thread that sends
+_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix='codec')
+
+
+
+def available() -> list[str]:
+    """Codecs this side can use, the preferred one first."""
+    return [name for name in CODECS if name != 'zstd' or zstd_compress is not None]
+
+def choose(preference: str | None, offered: list[str]) -> int | None:
+    """Codec to use given the client's preference ('auto', a codec name or None) and the
+    codecs the other side offered, None to send everything raw."""
+    if preference is None:
+        return None
+    shared = [name for name in available() if name in offered]
+    if preference == 'auto':
+        return CODECS[shared[0]] if shared else None
+    return CODECS[preference] if preference in shared else None
+
+def compress(codec: int, data) -> bytes:
+    if codec == ZLIB:
+        return zlib.compress(data, 1)
+    if codec == LZMA:
+        return lzma.compress(data, preset=0)
+    if codec == ZSTD and zstd_compress is not None:
+        return zstd_compress(data)
+    raise ValueError(f"Unsupported codec {codec}")
+
+def decompress(codec: int, data: bytes, size: int) -> bytes:
+    """Decompress a frame that must hold `size` bytes, producing at most one byte more."""
+    if codec == ZLIB:
+        return zlib.decompressobj().decompress(data, size + 1)
+    if codec == LZMA:
+        return lzma.LZMADecompressor().decompress(data, size + 1)
+    if codec == ZSTD and zstd_decompress is not None:
+        return zstd_decompress(data, size + 1)
+    raise ValueError(f"Unsupported codec {codec}")
+
+def encode_frame(codec: int, data: bytes) -> tuple[int, bytes]:
+    if len(compress(codec, data[:SAMPLE_SIZE])) > min(SAMPLE_SIZE, len(data)) * (1 - MIN_SAVING):
+        return RAW, data
+    payload = compress(codec, data)
+    return (codec, payload) if len(payload) < len(data) else (RAW, data)
+
+def read_at(file: BinaryIO, offset: int, count: int) -> bytes:
+    if hasattr(os, 'pread'):
+        return os.pread(file.fileno(), count, offset)
+    file.seek(offset)
+    return file.read(count)
+
+def recv_exact(sock: socket.socket, length: int) -> bytearray:
+    data = bytearray(length)
+    view = memoryview(data)
+    received: int = 0
+    while received < length:
+        size = sock.recv_into(view[received:])
+        if not size:
+            raise ConnectionError("Socket connection closed before receiving all data")
+        received += size
+    return data
+
+
+
+def send_frames(sock: socket.socket, file: BinaryIO, offset: int, count: int, codec: int, progress: Callable[[int, int], None] | None = None, hasher: fileio.RangeHasher | None = None) -> int:
+    """Send `count` bytes of `file` starting at `offset` as frames compressed with `codec`
+    where that pays off, and return how many bytes went on the wire. Frames are compressed
+    on the shared pool, LOOKAHEAD of them ahead of the socket. `progress` is called with the
+    original and the wire size of every frame, `hasher` sees the original data."""
+    pending: deque = deque()
+    position, end = offset, offset + count
+    wire: int = 0
+    while position < end or pending:
+        while position < end and len(pending) < LOOKAHEAD:
+            data = read_at(file, position, min(FRAME_SIZE, end - position))
+            if not data:
+                raise EOFError("File ended before the range was sent")
+            if hasher is not None:
+                hasher.update(memoryview(data))
+            pending.append((len(data), _executor.submit(encode_frame, codec, data)))
+            position += len(data)
+
+        length, frame = pending.popleft()
+        with tracer.span('compress wait', 'cpu'):
+            frame_codec, payload = frame.result()
+        with tracer.span('send', 'socket'):
+            sock.sendall(FRAME_HEADER.pack(frame_codec, length, len(payload)))
+            sock.sendall(payload)
+        wire += FRAME_HEADER.size + len(payload)
+        if progress is not None:
+            progress(length, FRAME_HEADER.size + len(payload))
+    return wire
+
+def recv_frames(sock: socket.socket, file: BinaryIO, offset: int, count: int, progress: Callable[[int, int], None] | None = None, hasher: fileio.RangeHasher | None = None):
+    """Receive the frames send_frames produced for `count` bytes and write them to `file` at `offset`."""
+    received: int = 0
+    while received < count:
+        with tracer.span('recv', 'socket'):
+            frame_codec, length, size = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+            if not 0 < length <= min(FRAME_SIZE, count - received) or size > FRAME_SIZE + 1024:
+                raise ValueError("Malformed frame")
+            payload = recv_exact(sock, size)
+        with tracer.span('decompress', 'cpu'):
+            data = payload if frame_codec == RAW else decompress(frame_codec, bytes(payload), length)
+        if len(data) != length:
+            raise ValueError("Frame does not decompress to its length")
+        if hasher is not None:
+            hasher.update(memoryview(data))
+        with tracer.span('write', 'disk'):
+            fileio.write_at(file, memoryview(data), offset + received)
+        received += length
+        if progress is not None:
+            progress(length, FRAME_HEADER.size + size)
@@ -4,4 +4,43 @@ REQUEST_UPLOAD = 3
 REQUEST_DOWNLOAD = 4
 UPLOAD_CHUNK = 5
 DOWNLOAD_CHUNK = 6
-DELETE = 7
\ No newline at end of file
+DELETE = 7
+HELLO = 8
+QUERY_RANGES = 9
+OFFER_BLOCKS = 10
+SIGNATURES = 11
+APPLY_DELTA = 12
+LIST_PAGE = 13
+STAT = 14
+WATCH = 15
+UPLOAD_BATCH = 16
+DOWNLOAD_BATCH = 17
+UPLOAD_SMALL = 18
+STATS = 19
+# Names of the opcodes above, for logs and metrics
+NAMES = {value: name for name, value in globals().copy().items() if name.isupper()}
+
+PROTOCOL_VERSION = 2
+# Commands framed as v2 have this bit set and are followed by a request id
+V2_FLAG = 0x80
+# v2 chunk commands with this bit set carry their payload in codec frames
+COMPRESSED_FLAG = 0x40
+# v2 commands with this bit set are part of a traced transfer, its '!Q' id follows the request id
+TRACED_FLAG = 0x20
+# struct codes for sizes and offsets, v2 widens them to 64 bits
+INT_CODES = {1: 'I', 2: 'Q'}
+# v2 checksums every DIGEST_BLOCK_SIZE block of a file with BLAKE2b, the file digest is the
+# BLAKE2b of its block digests in order
+DIGEST_BLOCK_SIZE = 1024 * 1024
+DIGEST_SIZE = 32
+# Kinds of the change events WATCH pushes
+FILE_ADDED = 1
+FILE_COMPLETED = 2
+FILE_DELETED = 3
+# Per-file answers in UPLOAD_BATCH, DOWNLOAD_BATCH and UPLOAD_SMALL replies
+BATCH_OK = 0
+BATCH_EXISTS = 1
+BATCH_MISSING = 2
+BATCH_INVALID = 3
+BATCH_TOO_LARGE = 4
+BATCH_CORRUPT = 5
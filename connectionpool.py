@@ -0,0 +1,98 @@
+import socket
+import select
+import threading
+import time
+from contextlib import contextmanager
+
+from tracing import tracer
+
+MAX_IDLE_PER_ADDRESS = 16
+IDLE_TIMEOUT = 30.0
+
+
+
+class ConnectionPool:
+    """Thread-safe pool of warm TCP connections keyed by server address.
+
+    Sockets are handed out with `connection()`. A socket that leaves the
+    `with` block normally goes back to the pool, one that leaves it with an
+    exception is closed, since its position in the protocol stream is unknown.
+    """
+    max_idle: int
+    idle_timeout: float
+
+    def __init__(self, max_idle: int = MAX_IDLE_PER_ADDRESS, idle_timeout: float = IDLE_TIMEOUT) -> None:
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle: dict[tuple[str, int], list[tuple[socket.socket, float]]] = {}
+        self._lock = threading.Lock()
+
+    def is_healthy(self, sock: socket.socket) -> bool:
+        # An idle connection must have nothing to read, otherwise the server closed it
+        # (or sent something nobody asked for) and the socket cannot be reused
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            return not readable
+        except (OSError, ValueError):
+            return False
+
+    def _evict_expired(self, idle: list[tuple[socket.socket, float]], now: float) -> list[socket.socket]:
+        expired: list[socket.socket] = []
+        while idle and now - idle[0][1] > self.idle_timeout:
+            expired.append(idle.pop(0)[0])
+        return expired
+
+    def acquire(self, address: tuple[str, int]) -> socket.socket:
+        now = time.monotonic()
+        sock: socket.socket | None = None
+        with self._lock:
+            idle = self._idle.get(address, [])
+            discarded = self._evict_expired(idle, now)
+            # Most recently released first, it is the least likely to have gone stale
+            while idle:
+                candidate = idle.pop()[0]
+                if self.is_healthy(candidate):
+                    sock = candidate
+                    break
+                discarded.append(candidate)
+
+        for i in discarded:
+            i.close()
+        if sock is not None:
+            return sock
+
+        with tracer.span('connect', 'socket'):
+            sock = socket.create_connection(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def release(self, address: tuple[str, int], sock: socket.socket):
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(address, [])
+            stale = self._evict_expired(idle, now)
+            if len(idle) < self.max_idle:
+                idle.append((sock, now))
+                sock = None
+
+        for i in stale:
+            i.close()
+        if sock is not None:
+            sock.close()
+
+    @contextmanager
+    def connection(self, address: tuple[str, int]):
+        sock = self.acquire(address)
+        try:
+            yield sock
+        except BaseException:
+            sock.close()
+            raise
+        self.release(address, sock)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for sock, _ in connections:
+                sock.close()
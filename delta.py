@@ -0,0 +1,108 @@
+import math
+import zlib
+
+import commands
+import fileio
+
+# Delta instructions, COPY takes bytes from the server's current version of the file,
+# LITERAL sends them from the new one
+COPY = 0
+LITERAL = 1
+
+MIN_BLOCK_SIZE = 4 * 1024
+# Bytes rolled past the last match before the search starts skipping ahead
+ROLL_LIMIT = 2
+
+ADLER_MOD = 65521
+
+
+
+def block_size_for(file_size: int) -> int:
+    """rsync's rule of thumb, blocks of about the square root of the file size."""
+    block_size = -(-math.isqrt(file_size) // 1024) * 1024
+    return min(max(block_size, MIN_BLOCK_SIZE), commands.DIGEST_BLOCK_SIZE)
+
+def weak_checksum(data) -> int:
+    return zlib.adler32(data)
+
+def strong_checksum(data) -> bytes:
+    block_hash = fileio.new_hash()
+    block_hash.update(data)
+    return block_hash.digest()
+
+def roll(checksum: int, out_byte: int, in_byte: int, block_size: int) -> int:
+    """Slide the adler32 of a block_size window one byte forward."""
+    a = ((checksum & 0xffff) - out_byte + in_byte) % ADLER_MOD
+    b = ((checksum >> 16) - block_size * out_byte + a - 1) % ADLER_MOD
+    return (b << 16) | a
+
+def compute_delta(data, base_size: int, signatures: list[tuple[int, bytes]], block_size: int) -> list[tuple[int, int, int]]:
+    """Instructions that rebuild `data` from a base file of `base_size` bytes whose blocks have
+    the given (weak, strong) signatures: (COPY, offset in the base, length) and
+    (LITERAL, offset in data, length), adjacent instructions merged.
+
+    Blocks are looked for at every byte offset with the rolling checksum, but only up to
+    ROLL_LIMIT blocks past the last match; after that the search jumps ahead by a distance
+    that doubles until something matches again, so data unlike the base costs little time.
+    """
+    size = len(data)
+    blocks: dict[int, list[int]] = {}
+    for index, (weak, _) in enumerate(signatures):
+        blocks.setdefault(weak, []).append(index)
+    # The last block of the base may be short, it can only match the end of data
+    last_length = base_size - (len(signatures) - 1) * block_size if signatures else block_size
+    whole_blocks = len(signatures) if last_length == block_size else len(signatures) - 1
+
+    instructions: list[tuple[int, int, int]] = []
+
+    def emit(kind: int, offset: int, length: int):
+        if instructions and instructions[-1][0] == kind and sum(instructions[-1][1:]) == offset:
+            instructions[-1] = (kind, instructions[-1][1], instructions[-1][2] + length)
+        else:
+            instructions.append((kind, offset, length))
+
+    def find(start: int, length: int, candidates) -> int | None:
+        strong = None
+        for index in candidates:
+            if strong is None:
+                strong = strong_checksum(data[start:start + length])
+            if signatures[index][1] == strong:
+                return index
+        return None
+
+    position = literal_start = 0
+    checksum: int | None = None
+    rolled, skip = 0, block_size
+    while position + block_size <= size:
+        if checksum is None:
+            checksum = weak_checksum(data[position:position + block_size])
+        match = find(position, block_size, (i for i in blocks.get(checksum, ()) if i < whole_blocks))
+        if match is not None:
+            if literal_start < position:
+                emit(LITERAL, literal_start, position - literal_start)
+            emit(COPY, match * block_size, block_size)
+            position += block_size
+            literal_start = position
+            checksum = None
+            rolled, skip = 0, block_size
+        elif rolled >= ROLL_LIMIT * block_size:
+            position += skip
+            skip *= 2
+            checksum = None
+            rolled = 0
+        else:
+            if position + block_size < size:
+                checksum = roll(checksum, data[position], data[position + block_size], block_size)
+            position += 1
+            rolled += 1
+
+    if whole_blocks < len(signatures) and size - last_length >= literal_start:
+        tail = size - last_length
+        if find(tail, last_length, [whole_blocks]) is not None:
+            if literal_start < tail:
+                emit(LITERAL, literal_start, tail - literal_start)
+            emit(COPY, whole_blocks * block_size, last_length)
+            literal_start = size
+    if literal_start < size:
+        emit(LITERAL, literal_start, size - literal_start)
+    return instructions
@@ -0,0 +1,135 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from tracing import tracer
+
+# Open files kept around while nobody uses them
+FILE_CACHE_SIZE = 256
+# Files can only be shared where every read and write names its own offset
+SHARED = hasattr(os, 'pread') and hasattr(os, 'pwrite') and hasattr(os, 'preadv')
+
+
+
+class CachedFile:
+    __slots__ = ('file', 'users', 'valid')
+
+    def __init__(self, file) -> None:
+        self.file = file
+        self.users: int = 0
+        self.valid: bool = True
+
+
+
+class FileCache:
+    """Open files shared by every thread and reused from one chunk to the next, so a chunk
+    costs neither an open() nor a path lookup.
+
+    Files are keyed by path and mode, handed out unbuffered and counted while in use. All
+    I/O on them has to be positional (os.pread/os.pwrite, fileio.readinto_at/write_at), as
+    the file position is shared. At most `size` unused files stay open, the least recently
+    used one is closed first. `invalidate` is for paths that are deleted or replaced: the
+    file is dropped from the cache and closed as soon as its last user is done with it.
+    """
+
+    def __init__(self, size: int = FILE_CACHE_SIZE) -> None:
+        self.size = size
+        self._files: OrderedDict[tuple[str, str], CachedFile] = OrderedDict()
+        self._idle: int = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def open(self, path: str, mode: str = 'rb'):
+        if not SHARED or self.size <= 0:
+            with tracer.span('open', 'disk'):
+                file = open(path, mode, buffering=0)
+            with file:
+                yield file
+            return
+
+        cached = self._acquire(path, mode)
+        try:
+            yield cached.file
+        finally:
+            self._release(cached)
+
+    def _acquire(self, path: str, mode: str) -> CachedFile:
+        key = (path, mode)
+        with self._lock:
+            cached = self._files.get(key)
+            if cached is not None:
+                self._files.move_to_end(key)
+                if not cached.users:
+                    self._idle -= 1
+                cached.users += 1
+                return cached
+
+        with tracer.span('open', 'disk'):
+            file = open(path, mode, buffering=0)
+        with self._lock:
+            cached = self._files.get(key)
+            if cached is None:
+                cached = self._files[key] = CachedFile(file)
+                file = None
+            elif not cached.users:
+                self._idle -= 1
+            self._files.move_to_end(key)
+            cached.users += 1
+            closing = self._evict()
+        # Another thread opened the same file meanwhile
+        if file is not None:
+            closing.append(file)
+        for i in closing:
+            i.close()
+        return cached
+
+    def _release(self, cached: CachedFile):
+        with self._lock:
+            cached.users -= 1
+            if cached.users:
+                return
+            if not cached.valid:
+                closing = [cached.file]
+            else:
+                self._idle += 1
+                closing = self._evict()
+        for i in closing:
+            i.close()
+
+    def _evict(self) -> list:
+        """Take the least recently used idle files out until at most `size` are left, the
+        caller closes them outside of the lock."""
+        closing = []
+        if self._idle <= self.size:
+            return closing
+        for key, cached in list(self._files.items()):
+            if not cached.users:
+                del self._files[key]
+                self._idle -= 1
+                closing.append(cached.file)
+                if self._idle <= self.size:
+                    break
+        return closing
+
+    def invalidate(self, path: str):
+        """Stop handing out `path`, it is about to be deleted or replaced."""
+        self._invalidate(lambda cached_path: cached_path == path)
+
+    def invalidate_under(self, directory: str):
+        self._invalidate(lambda cached_path: cached_path.startswith(os.path.join(directory, '')))
+
+    def _invalidate(self, matches):
+        closing = []
+        with self._lock:
+            for key in [key for key in self._files if matches(key[0])]:
+                cached = self._files.pop(key)
+                cached.valid = False
+                if not cached.users:
+                    self._idle -= 1
+                    closing.append(cached.file)
+        for i in closing:
+            i.close()
+
+    def close(self):
+        self._invalidate(lambda cached_path: True)
@@ -0,0 +1,198 @@
+import os
+import re
+import time
+import struct
+import bisect
+import fnmatch
+import threading
+import itertools
+from collections import deque
+from typing import Callable
+
+import commands
+
+# Orders a listing page can be sorted in, the position is the id sent on the wire
+SORT_KEYS = ('name', 'ctime', 'size')
+# Changes kept for watchers that come back with an older token
+CHANGE_HISTORY = 10000
+
+
+
+def encode_cursor(sort: str, cursor: tuple) -> bytes:
+    key, name = cursor
+    if sort == 'name':
+        return name.encode()
+    return struct.pack('!d' if sort == 'ctime' else '!Q', key) + name.encode()
+
+def decode_cursor(sort: str, data: bytes) -> tuple | None:
+    if not data:
+        return None
+    if sort == 'name':
+        return (data.decode(), data.decode())
+    key = struct.unpack_from('!d' if sort == 'ctime' else '!Q', data)[0]
+    return (key, data[8:].decode())
+
+
+
+class FileIndex:
+    """In-memory metadata of the files on the server, so LIST is answered without a system
+    call per file.
+
+    The handlers that create, complete, replace and delete files keep it current, and
+    `reconcile` rebuilds it from the data directory (and the block store) at startup. The
+    encoded listing is kept until the next change, and a sorted list of (key, name) per
+    SORT_KEYS lets `page` start right at a cursor instead of going through every file.
+
+    Every change is also published with a token one higher than the one before. Tokens
+    start from the clock in microseconds, so the tokens of an earlier run of the server are
+    always older than anything this one has kept.
+    """
+
+    def __init__(self) -> None:
+        self._entries: dict[str, tuple[float, int]] = {}
+        self._lines: dict[str, str] = {}
+        self._listing: bytes | None = None
+        self._sorted: dict[str, list[tuple]] = {key: [] for key in SORT_KEYS}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._changes: deque[tuple[int, int, str, float, int]] = deque(maxlen=CHANGE_HISTORY)
+        self._token: int = time.time_ns() // 1000
+
+    def reconcile(self, directory: str, store = None):
+        entries: dict[str, tuple[float, int]] = {}
+        self._scan(directory, '', entries)
+        if store is not None:
+            for name in store.file_names():
+                entries[name] = (store.file_ctime(name), store.file_size(name))
+
+        with self._lock:
+            self._entries = entries
+            self._lines = {name: self._line(name, *metadata) for name, metadata in entries.items()}
+            self._listing = None
+            self._sorted = {key: sorted(self._sort_key(key, name, *metadata) for name, metadata in entries.items()) for key in SORT_KEYS}
+
+    def _scan(self, directory: str, prefix: str, entries: dict[str, tuple[float, int]]):
+        # Files in subdirectories are named by their '/' separated path from the data directory
+        with os.scandir(directory) as scan:
+            for entry in scan:
+                if entry.is_dir(follow_symlinks=False):
+                    self._scan(entry.path, prefix + entry.name + '/', entries)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    entries[prefix + entry.name] = (stat.st_ctime, stat.st_size)
+
+    def _line(self, name: str, ctime: float, size: int) -> str:
+        return f"{name}@{time.ctime(ctime)}@{size}"
+
+    def _sort_key(self, key: str, name: str, ctime: float, size: int) -> tuple:
+        return (name, name) if key == 'name' else (ctime if key == 'ctime' else size, name)
+
+    def _unsort(self, name: str):
+        metadata = self._entries.get(name)
+        if metadata is None:
+            return
+        for key, keys in self._sorted.items():
+            i = bisect.bisect_left(keys, self._sort_key(key, name, *metadata))
+            del keys[i]
+
+    def _publish(self, kind: int, name: str, ctime: float, size: int):
+        self._token += 1
+        self._changes.append((self._token, kind, name, ctime, size))
+        self._changed.notify_all()
+
+    def put(self, name: str, ctime: float, size: int, kind: int = commands.FILE_ADDED):
+        with self._lock:
+            self._unsort(name)
+            self._entries[name] = (ctime, size)
+            self._lines[name] = self._line(name, ctime, size)
+            self._listing = None
+            for key, keys in self._sorted.items():
+                bisect.insort(keys, self._sort_key(key, name, ctime, size))
+            self._publish(kind, name, ctime, size)
+
+    def remove(self, name: str):
+        with self._lock:
+            self._unsort(name)
+            if self._entries.pop(name, None) is not None:
+                del self._lines[name]
+                self._listing = None
+                self._publish(commands.FILE_DELETED, name, 0.0, 0)
+
+    def changes_since(self, token: int, timeout: float) -> tuple[list[tuple[int, str, float, int]], int, bool]:
+        """(kind, name, ctime, size) changes made after `token`, waiting up to `timeout` for one
+        if there are none yet, with the token they bring the caller to. A token of 0 starts from
+        now. The last value tells that `token` is unknown or too old to follow, and the caller
+        has to list everything again."""
+        with self._changed:
+            if token == 0:
+                token = self._token
+            oldest = self._changes[0][0] if self._changes else self._token + 1
+            if token > self._token or token < oldest - 1:
+                return [], self._token, True
+            if token == self._token:
+                self._changed.wait(timeout)
+            start = token - self._changes[0][0] + 1 if self._changes else 0
+            if start < 0:
+                return [], self._token, True
+            changes = [change[1:] for change in itertools.islice(self._changes, start, None)]
+            return changes, self._token, False
+
+    def wait(self, token: int, timeout: float) -> int:
+        """Wait up to `timeout` for a change after `token` and return the token of the latest change."""
+        with self._changed:
+            if token == self._token:
+                self._changed.wait(timeout)
+            return self._token
+
+    def get(self, name: str) -> tuple[float, int] | None:
+        with self._lock:
+            return self._entries.get(name)
+
+    def listing(self) -> bytes:
+        """The LIST reply, one name@ctime@size line per file."""
+        with self._lock:
+            if self._listing is None:
+                self._listing = '\n'.join(self._lines.values()).encode()
+            return self._listing
+
+    def page(self, pattern: str = '', glob: bool = False, sort: str = 'name', descending: bool = False,
+             limit: int = 100, cursor: tuple | None = None) -> tuple[list[tuple[str, float, int]], tuple | None]:
+        """Up to `limit` (name, ctime, size) entries whose name starts with `pattern`, or matches
+        it as a glob, in `sort` order after `cursor`, and the cursor of the next page (None on
+        the last one). A cursor is the (key, name) of the last entry of the previous page.
+
+        Names sorted by name are walked only from the literal start of the pattern and as far
+        as they can still match, the other orders walk from the cursor and filter on the way.
+        """
+        literal = re.split(r'[*?\[]', pattern, maxsplit=1)[0] if glob else pattern
+        matches: Callable[[str], object] = re.compile(fnmatch.translate(pattern)).match if glob else (lambda name: True)
+        by_name = sort == 'name'
+
+        with self._lock:
+            keys = self._sorted[sort]
+            if not descending:
+                start = bisect.bisect_right(keys, cursor) if cursor is not None else 0
+                if by_name:
+                    start = max(start, bisect.bisect_left(keys, (literal,)))
+                positions = range(start, len(keys))
+            else:
+                start = bisect.bisect_left(keys, cursor) - 1 if cursor is not None else len(keys) - 1
+                if by_name and literal:
+                    start = min(start, bisect.bisect_left(keys, (literal + '\U0010ffff',)) - 1)
+                positions = range(start, -1, -1)
+
+            entries: list[tuple[str, float, int]] = []
+            last: tuple | None = None
+            for i in positions:
+                name = keys[i][1]
+                if not name.startswith(literal):
+                    if by_name:
+                        break
+                    continue
+                if not matches(name):
+                    continue
+                if len(entries) == limit:
+                    return entries, last
+                entries.append((name, *self._entries[name]))
+                last = keys[i]
+            return entries, None
@@ -0,0 +1,224 @@
+import os
+import errno
+import socket
+import ntpath
+import hashlib
+import threading
+from typing import BinaryIO, Callable, Iterable
+
+import commands
+from tracing import tracer
+
+BUFFER_SIZE = 256 * 1024
+PROGRESS_BLOCK = 1024 * 1024
+# Ranges of files at least this big leave the page cache once transferred, smaller files are
+# cheap to keep and likely to be asked for again
+DONTNEED_SIZE = 64 * 1024 * 1024
+
+_local = threading.local()
+
+
+
+def thread_buffer() -> memoryview:
+    """Return this thread's reusable I/O buffer, allocating it on first use."""
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is None:
+        buffer = memoryview(bytearray(BUFFER_SIZE))
+        _local.buffer = buffer
+    return buffer
+
+def valid_name(file_name: str) -> bool:
+    """Whether a file name is a relative '/' separated path that stays inside the directory it
+    is joined to: no empty, '.' or '..' parts, no backslashes, NUL bytes or drive letters."""
+    if not file_name or '\\' in file_name or '\0' in file_name or ntpath.splitdrive(file_name)[0]:
+        return False
+    return all(part not in ('', '.', '..') for part in file_name.split('/'))
+
+def flat_name(file_name: str) -> str:
+    """A file name turned into a single path component, for files kept next to each other
+    whatever directory the file is in. '%' is escaped too so the mapping stays reversible."""
+    return file_name.replace('%', '%25').replace('/', '%2F')
+
+def unflat_name(name: str) -> str:
+    return name.replace('%2F', '/').replace('%25', '%')
+
+def new_hash():
+    return hashlib.blake2b(digest_size=commands.DIGEST_SIZE)
+
+def digest_pieces(start_byte: int, end_byte: int) -> list[tuple[int, int]]:
+    """Cut the inclusive range on the DIGEST_BLOCK_SIZE grid, one piece per digest."""
+    block_size = commands.DIGEST_BLOCK_SIZE
+    return [(max(start_byte, i * block_size), min(end_byte, (i + 1) * block_size - 1))
+            for i in range(start_byte // block_size, end_byte // block_size + 1)]
+
+
+
+class RangeHasher:
+    """Hashes a byte range while it is streamed in order, in the pieces given by digest_pieces,
+    so whole blocks get the same digest however the file was split for the transfer."""
+    position: int
+    digests: list[bytes]
+
+    def __init__(self, offset: int) -> None:
+        self.position = offset
+        self.digests = []
+        self._hash = None
+
+    def update(self, data: memoryview):
+        while data:
+            if self._hash is None:
+                self._hash = new_hash()
+            room = commands.DIGEST_BLOCK_SIZE - self.position % commands.DIGEST_BLOCK_SIZE
+            piece = data[:room]
+            self._hash.update(piece)
+            self.position += len(piece)
+            data = data[len(piece):]
+            if self.position % commands.DIGEST_BLOCK_SIZE == 0:
+                self.digests.append(self._hash.digest())
+                self._hash = None
+
+    def finish(self) -> list[bytes]:
+        if self._hash is not None:
+            self.digests.append(self._hash.digest())
+            self._hash = None
+        return self.digests
+
+
+
+def allocate(path: str, size: int):
+    """Create `path`, or empty it, with `size` bytes of disk space reserved up front, so chunks
+    written in parallel fill one contiguous allocation instead of fragmenting a sparse file.
+    Filesystems that cannot reserve space get a sparse file of that size."""
+    with open(path, 'wb') as file:
+        if size <= 0:
+            return
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(file.fileno(), 0, size)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+                    raise
+        file.truncate(size)
+
+def advise_sequential(file: BinaryIO, offset: int, count: int):
+    """Hint that the range is about to be read front to back, so the kernel reads further ahead."""
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(file.fileno(), offset, count, os.POSIX_FADV_SEQUENTIAL)
+
+def release_range(file: BinaryIO, offset: int, count: int):
+    """Let the pages of a range that was just transferred go, when the file is at least
+    DONTNEED_SIZE, so one large transfer does not push everything else out of the page cache.
+    Written pages are only dropped once they are on disk, the hint starts writing them."""
+    if hasattr(os, 'posix_fadvise') and os.fstat(file.fileno()).st_size >= DONTNEED_SIZE:
+        os.posix_fadvise(file.fileno(), offset, count, os.POSIX_FADV_DONTNEED)
+
+def sync_paths(paths: Iterable[str]):
+    """fsync every file in `paths`, then every directory holding them once however many of
+    the files it holds, so the files and their names survive a crash."""
+    directories: set[str] = set()
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        directories.add(os.path.dirname(path) or os.curdir)
+    # Directories cannot be opened for fsync on Windows
+    if os.name == 'posix':
+        for directory in sorted(directories):
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+def readinto_at(file: BinaryIO, buffer: memoryview, offset: int) -> int:
+    """Read into `buffer` from `offset` without moving the file position where the platform
+    allows, so threads can share the file."""
+    if hasattr(os, 'preadv'):
+        return os.preadv(file.fileno(), [buffer], offset)
+    file.seek(offset)
+    return file.readinto(buffer)
+
+def write_at(file: BinaryIO, data: memoryview, offset: int):
+    if hasattr(os, 'pwrite'):
+        fd = file.fileno()
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+    else:
+        file.seek(offset)
+        file.write(data)
+
+def send_file_range(sock: socket.socket, file: BinaryIO, offset: int, count: int, progress: Callable[[int], None] | None = None, hasher: RangeHasher | None = None) -> int:
+    """Send `count` bytes of `file` starting at `offset` and return how many were sent.
+
+    Uses the kernel's sendfile so the data never passes through user space,
+    and falls back to a streamed copy through one fixed-size buffer where
+    sendfile is not available or the data has to go through `hasher`. When
+    `progress` is given the range is sent in PROGRESS_BLOCK pieces and
+    `progress` is called with the size of each one.
+    """
+    if count <= 0:
+        return 0
+    if hasher is not None or not hasattr(os, 'sendfile'):
+        return send_file_range_streamed(sock, file, offset, count, progress, hasher)
+    if progress is None:
+        with tracer.span('sendfile', 'socket', bytes=count):
+            return sock.sendfile(file, offset, count)
+
+    total_sent: int = 0
+    while total_sent < count:
+        with tracer.span('sendfile', 'socket'):
+            sent = sock.sendfile(file, offset + total_sent, min(PROGRESS_BLOCK, count - total_sent))
+        if not sent:
+            break
+        total_sent += sent
+        progress(sent)
+    return total_sent
+
+def send_file_range_streamed(sock: socket.socket, file: BinaryIO, offset: int, count: int, progress: Callable[[int], None] | None = None, hasher: RangeHasher | None = None) -> int:
+    buffer = thread_buffer()
+    total_sent: int = 0
+    while total_sent < count:
+        with tracer.span('read', 'disk'):
+            read = readinto_at(file, buffer[:min(len(buffer), count - total_sent)], offset + total_sent)
+        if not read:
+            break
+        if hasher is not None:
+            hasher.update(buffer[:read])
+        with tracer.span('send', 'socket'):
+            sock.sendall(buffer[:read])
+        total_sent += read
+        if progress is not None:
+            progress(read)
+    return total_sent
+
+def recv_file_range(sock: socket.socket, file: BinaryIO, offset: int, count: int, progress: Callable[[int], None] | None = None, hasher: RangeHasher | None = None):
+    """Receive exactly `count` bytes from `sock` into `file` starting at `offset`.
+
+    Data is read with recv_into into the thread's fixed-size buffer and each
+    filled buffer is written at its offset right away, so memory use does not
+    depend on the size of the range. `progress` is called with the size of
+    every block written, and `hasher` sees the data on its way to disk.
+    """
+    buffer = thread_buffer()
+    received: int = 0
+    while received < count:
+        block = min(len(buffer), count - received)
+        filled: int = 0
+        with tracer.span('recv', 'socket'):
+            while filled < block:
+                size = sock.recv_into(buffer[filled:block])
+                if not size:
+                    raise ConnectionError("Socket connection closed before receiving all data")
+                filled += size
+        if hasher is not None:
+            hasher.update(buffer[:filled])
+        with tracer.span('write', 'disk'):
+            write_at(file, buffer[:filled], offset + received)
+        received += filled
+        if progress is not None:
+            progress(filled)
@@ -1,211 +1,1092 @@
-import socket
-import threading
-import struct
-import os
-
-import commands
-
-
-
-class FileTransferClient:
-    address: tuple[str, int]
-
-    def __init__(self, port: int, server_ip: str = socket.gethostbyname(socket.gethostname())) -> None:
-        self.address = (server_ip, port)
-        socket.setdefaulttimeout(13)
-
-    def get_local_host(self):
-        return socket.gethostbyname(socket.gethostname())
-
-    def send_command(self, sock: socket.socket, command: int, data_length: int = 0):
-        sock.sendall(struct.pack('!BI', command, data_length))
-
-    def send_int(self, sock: socket.socket, value: int):
-        sock.sendall(struct.pack('!I', value))
-
-    def recv_bool(self, sock: socket.socket) -> bool:
-        return struct.unpack('!?', sock.recv(1))[0]
-
-    def recv_int(self, sock: socket.socket) -> int:
-        return struct.unpack('!I', sock.recv(4))[0]
-
-    def recv_all(self, sock: socket.socket, length: int) -> bytes:
-        data = bytearray()
-        while len(data) < length:
-            packet = sock.recv(length - len(data))
-            if not packet:
-                raise ConnectionError("Socket connection closed before receiving all data")
-            data.extend(packet)
-        return bytes(data)
-
-
-
-    def ping(self):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.connect(self.address)
-                self.send_command(sock, commands.PING)
-                return self.recv_bool(sock)
-            
-        except Exception as e:
-            # print(f"[PING ERROR] {e}")
-            return False
-
-    def list_files(self):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.connect(self.address)
-                self.send_command(sock, commands.LIST)
-                data = self.recv_all(sock, self.recv_int(sock)).decode()
-                data = data.splitlines()
-                files_data: list[tuple[str, str, str]] = []
-                for i in data:
-                    file_data: tuple[str, str, str] = tuple(i.split('@'))
-                    files_data.append(file_data)
-                return files_data
-        
-        except Exception as e:
-            print(f"[FILE LISTING ERROR] {e}")
-
-    def upload_chunk(self, path: str, start_byte: int, end_byte: int, chunk_number: int, progress_tracker = None):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.connect(self.address)
-
-                file_name: bytes = os.path.basename(path).encode()
-                self.send_command(sock, commands.UPLOAD_CHUNK, len(file_name))
-                sock.sendall(file_name)
-                self.send_int(sock, start_byte)
-                self.send_int(sock, end_byte)
-
-                with open(path, 'rb') as file:
-                    file.seek(start_byte)
-                    data_length: int = end_byte - start_byte + 1
-                    data: bytes = file.read(data_length)
-
-                    total_sent: int = 0
-                    while total_sent < data_length:
-                        sent = sock.send(data[total_sent:])
-                        if sent == 0:
-                            break
-                        total_sent += sent
-                        if not progress_tracker is None:
-                            progress_tracker(chunk_number, sent, total_sent / data_length)
-
-                print(f"Chunk {chunk_number} uploaded from {start_byte} to {end_byte}")
-        
-        except Exception as e:
-            print(f"[CHUNK UPLOAD ERROR] {e}")
-
-    def upload_file(self, path: str, chunk_count: int = 4, progress_tracker = None):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.connect(self.address)
-
-                file_name = os.path.basename(path).encode()
-                self.send_command(sock, commands.REQUEST_UPLOAD, len(file_name))
-                sock.sendall(file_name)
-                file_exists = self.recv_bool(sock)
-                if file_exists:
-                    raise FileExistsError("File has already existed on the server")
-                
-                file_size = os.path.getsize(path)
-                self.send_int(sock, file_size)
-                
-                chunk_size: int = file_size // chunk_count
-                threads = []
-                for i in range(chunk_count):
-                    start_byte = i * chunk_size
-                    end_byte = (file_size - 1) if (i == chunk_count - 1) else (start_byte + chunk_size - 1)
-
-                    thread = threading.Thread(target=self.upload_chunk, args=(path, start_byte, end_byte, i, progress_tracker))
-                    thread.start()
-                    threads.append(thread)
-
-                for thread in threads:
-                    thread.join()
-            
-        except Exception as e:
-            print(f"[FILE UPLOAD ERROR]: {e}")
-            
-    def download_chunk(self, file_name: str, destination: str, start_byte: int, end_byte: int, chunk_number: int, progress_tracker = None):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.connect(self.address)
-
-                self.send_command(sock, commands.DOWNLOAD_CHUNK, len(file_name))
-                sock.sendall(file_name.encode())
-                self.send_int(sock, start_byte)
-                self.send_int(sock, end_byte)
-
-                with open(destination, 'r+b') as file:
-                    file.seek(start_byte)
-                    data_length = end_byte - start_byte + 1
-                    # data = self.recv_all(sock, end_byte - start_byte + 1)
-
-                    data = bytearray()
-                    total_received: int = 0
-                    while total_received < data_length:
-                        packet = sock.recv(data_length - total_received)
-                        if not packet:
-                            raise ConnectionError("Socket connection closed before receiving all data")
-                        data.extend(packet)
-                        total_received += len(packet)
-
-                        if not progress_tracker is None:
-                            progress_tracker(chunk_number, len(packet), total_received / data_length)
-
-                    file.write(data)
-                    # if not progress_tracker is None:
-                    #     progress_tracker(chunk_number)
-                
-                print(f"Chunk {chunk_number} downloaded from {start_byte} to {end_byte}")
-        
-        except Exception as e:
-            print(f"[CHUNK DOWNLOAD ERROR] {e}")
-
-    def download_file(self, file_name: str, destination: str, chunk_count: int = 4, progress_tracker = None):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.connect(self.address)
-                self.send_command(sock, commands.REQUEST_DOWNLOAD, len(file_name))
-                sock.sendall(file_name.encode())
-                file_exists, file_size = struct.unpack('!?I', sock.recv(5))
-
-                if not file_exists:
-                    raise FileNotFoundError("File is not on the server")
-                
-                chunk_size = file_size // chunk_count
-
-                with open(destination, 'wb') as file:
-                    file.seek(file_size - 1)
-                    file.write(b'\0')
-
-                threads: list[threading.Thread] = []
-                for i in range(chunk_count):
-                    start_byte = i * chunk_size
-                    end_byte = (file_size - 1) if (i == chunk_count - 1) else (start_byte + chunk_size - 1)
-
-                    thread = threading.Thread(target=self.download_chunk, args=(file_name, destination, start_byte, end_byte, i, progress_tracker))
-                    thread.start()
-                    threads.append(thread)
-
-                for thread in threads:
-                    thread.join()
-
-        except Exception as e:
-            print(f"[FILE DOWNLOAD ERROR] {e}")
-
-
-    def delete_file(self, file_name: str):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.connect(self.address)
-                self.send_command(sock, commands.DELETE, len(file_name))
-                sock.sendall(file_name.encode())
-                file_exists = self.recv_bool(sock)
-                if not file_exists:
-                    raise FileNotFoundError("File is not on the server")
-        
-        except Exception as e:
-            print(f"[FILE DELETION ERROR] {e}")
+import socket
+import threading
+import struct
+import os
+import time
+import queue
+import itertools
+import mmap
+import posixpath
+import logging
+import contextvars
+from typing import Callable
+
+import commands
+import fileio
+import delta
+import codec
+from connectionpool import ConnectionPool
+from journal import RangeJournal, BlockDigests, merge_range, missing_ranges
+from fileindex import SORT_KEYS
+from logs import fields
+import tracing
+from tracing import tracer
+
+HELLO_TIMEOUT = 3
+# Transfers are cut into blocks of at most this size which the streams pull from a shared queue
+BLOCK_SIZE = 8 * 1024 * 1024
+
+# Rounds of re-sending missing ranges before a transfer is left for resume_upload/resume_download
+TRANSFER_ATTEMPTS = 3
+JOURNAL_SUFFIX = '.ftjournal'
+DIGESTS_SUFFIX = '.ftdigests'
+
+# Compression preference: 'auto' uses the best codec both sides have, a codec name
+# forces that codec, None sends chunks raw. Off by default, raw chunks go out with sendfile
+# and only pay off the codec's CPU time on slow links with compressible data
+COMPRESSION = None
+
+# Files up to this size are sent back to back in batches, bigger ones go through upload_file
+# and download_file to be split across streams
+BATCH_FILE_SIZE = BLOCK_SIZE
+# Most files and bytes one batch carries
+BATCH_FILES = 1000
+BATCH_BYTES = 64 * 1024 * 1024
+
+# Entries asked for per LIST_PAGE request
+LIST_PAGE_SIZE = 500
+# A WATCH stream that stays silent this long is dead, the server sends a batch every 15 seconds
+WATCH_TIMEOUT = 40
+
+# Pass as chunk_count to let the client tune the number of parallel streams
+AUTO = 0
+INITIAL_STREAMS = 2
+# Used when the server does not announce max_streams
+DEFAULT_MAX_STREAMS = 8
+PROBE_INTERVAL = 1.0
+MIN_GAIN = 0.1
+RETUNE_DRIFT = 0.3
+
+log = logging.getLogger('filetransfer.client')
+# Every chunk is an event, logs.configure can sample them
+chunk_log = logging.getLogger('filetransfer.client.chunks')
+
+
+def missing_size(ranges: list[tuple[int, int]]) -> int:
+    return sum(end - start + 1 for start, end in ranges)
+
+def report_resumed(progress_tracker, file_size: int, missing: list[tuple[int, int]]):
+    # Count what was transferred before so progress still adds up to the file size
+    done = file_size - missing_size(missing)
+    if progress_tracker is not None and done:
+        progress_tracker(0, done, 1.0, 0)
+
+
+
+class UnsupportedError(ConnectionError):
+    """The server is too old for the call or lacks the capability it needs."""
+
+
+
+class FileTransferClient:
+    """Progress trackers are called as tracker(stream, file_bytes, fraction_of_block, wire_bytes),
+    wire_bytes being what actually crossed the network for those file bytes."""
+    address: tuple[str, int]
+    pool: ConnectionPool
+    compression: str | None
+    versions: dict[tuple[str, int], int]
+    capabilities: dict[tuple[str, int], dict[str, str]]
+
+    def __init__(self, port: int, server_ip: str = socket.gethostbyname(socket.gethostname()), pool: ConnectionPool | None = None, compression: str | None = COMPRESSION) -> None:
+        self.address = (server_ip, port)
+        self.pool = ConnectionPool() if pool is None else pool
+        self.compression = compression
+        self.versions = {}
+        self.capabilities = {}
+        self.request_ids = itertools.count(1)
+        socket.setdefaulttimeout(13)
+
+    def close(self):
+        self.pool.close()
+
+    def peer(self) -> str:
+        return f"{self.address[0]}:{self.address[1]}"
+
+    def get_local_host(self):
+        return socket.gethostbyname(socket.gethostname())
+
+    def protocol_version(self) -> int:
+        """Protocol version agreed with the current server, negotiated with HELLO on first use."""
+        address = self.address
+        version = self.versions.get(address)
+        if version is not None:
+            return version
+
+        try:
+            with self.pool.connection(address) as sock:
+                # HELLO always uses v1 framing and carries no payload, a server that
+                # does not know it simply never answers
+                sock.settimeout(HELLO_TIMEOUT)
+                sock.sendall(struct.pack('!BI', commands.HELLO, commands.PROTOCOL_VERSION))
+                version = struct.unpack('!B', self.recv_all(sock, 1))[0]
+                capabilities: dict[str, str] = {}
+                if version >= 2:
+                    length = struct.unpack('!' + commands.INT_CODES[version], self.recv_all(sock, 8))[0]
+                    for line in self.recv_all(sock, length).decode().splitlines():
+                        key, _, value = line.partition('=')
+                        capabilities[key] = value
+                sock.settimeout(socket.getdefaulttimeout())
+        except TimeoutError:
+            version, capabilities = 1, {}
+
+        self.capabilities[address] = capabilities
+        self.versions[address] = version
+        return version
+
+    def capability(self, name: str, default: str | None = None) -> str | None:
+        """Capability the current server announced in its HELLO reply."""
+        self.protocol_version()
+        return self.capabilities.get(self.address, {}).get(name, default)
+
+    def max_streams(self) -> int:
+        """Most parallel streams the server lets one transfer use, the ceiling for AUTO."""
+        return max(1, int(self.capability('max_streams', str(DEFAULT_MAX_STREAMS))))
+
+    def small_file_size(self) -> int:
+        """Largest file the server takes or sends in a single round trip, 0 without a fast path."""
+        if self.protocol_version() < 2:
+            return 0
+        return int(self.capability('small_file', '0'))
+
+    def codec(self) -> int | None:
+        """Codec chunks are compressed with, None when they go raw."""
+        if self.protocol_version() < 2:
+            return None
+        return codec.choose(self.compression, self.capability('codecs', '').split(','))
+
+    def send_command(self, sock: socket.socket, command: int, data_length: int = 0, compressed: bool = False):
+        if self.protocol_version() >= 2:
+            flags = commands.V2_FLAG | (commands.COMPRESSED_FLAG if compressed else 0)
+            header = struct.pack('!BII', command | flags, data_length, next(self.request_ids))
+            # Commands of a traced transfer take its id along so the server's spans carry it too
+            transfer = tracing.transfer_id.get() if tracer.enabled else None
+            if transfer is not None and self.capability('trace') == '1':
+                header = bytes([header[0] | commands.TRACED_FLAG]) + header[1:] + struct.pack('!Q', transfer)
+            sock.sendall(header)
+        else:
+            sock.sendall(struct.pack('!BI', command, data_length))
+
+    def int_format(self) -> str:
+        return '!' + commands.INT_CODES[self.protocol_version()]
+
+    def send_int(self, sock: socket.socket, value: int):
+        sock.sendall(struct.pack(self.int_format(), value))
+
+    def recv_bool(self, sock: socket.socket) -> bool:
+        return struct.unpack('!?', sock.recv(1))[0]
+
+    def recv_int(self, sock: socket.socket) -> int:
+        int_format = self.int_format()
+        return struct.unpack(int_format, self.recv_all(sock, struct.calcsize(int_format)))[0]
+
+    def recv_digest(self, sock: socket.socket) -> bytes | None:
+        """Read a whole-file digest from a v2 reply, None when the server does not know it."""
+        if self.protocol_version() < 2:
+            return None
+        digest = self.recv_all(sock, commands.DIGEST_SIZE)
+        return None if digest == bytes(commands.DIGEST_SIZE) else digest
+
+    def recv_all(self, sock: socket.socket, length: int) -> bytes:
+        data = bytearray()
+        while len(data) < length:
+            packet = sock.recv(length - len(data))
+            if not packet:
+                raise ConnectionError("Socket connection closed before receiving all data")
+            data.extend(packet)
+        return bytes(data)
+
+
+
+    def split_blocks(self, ranges: list[tuple[int, int]], chunk_count: int) -> list[tuple[int, int]]:
+        """Cut the inclusive byte ranges into (start_byte, end_byte) blocks of at most BLOCK_SIZE bytes,
+        small transfers are cut so that every one of the chunk_count streams gets a block as long as
+        blocks stay at least DIGEST_BLOCK_SIZE."""
+        total: int = sum(end - start + 1 for start, end in ranges)
+        streams: int = self.max_streams() if chunk_count == AUTO else chunk_count
+        # Whole digest blocks only, so the checksums of a block never depend on how the file was split
+        block_size: int = max(1, -(-min(BLOCK_SIZE, -(-total // streams)) // commands.DIGEST_BLOCK_SIZE)) * commands.DIGEST_BLOCK_SIZE
+        return [(start_byte, min(start_byte + block_size - 1, end))
+                for start, end in ranges for start_byte in range(start, end + 1, block_size)]
+
+    def split_batches(self, files: list[tuple]) -> list[list[tuple]]:
+        """Group entries whose last field is a size into batches of at most BATCH_FILES files and,
+        unless a single file is bigger, BATCH_BYTES bytes."""
+        batches: list[list[tuple]] = []
+        batch: list[tuple] = []
+        batch_bytes: int = 0
+        for entry in files:
+            if batch and (len(batch) == BATCH_FILES or batch_bytes + entry[-1] > BATCH_BYTES):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(entry)
+            batch_bytes += entry[-1]
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def run_workers(self, blocks: list[tuple], worker_count: int, transfer_block: Callable, progress_tracker = None):
+        """Run worker_count streams that keep pulling blocks from a shared queue until it is empty,
+        so a fast stream ends up moving more blocks than a slow one instead of waiting for it.
+        transfer_block is called with the fields of the block, (start_byte, end_byte) for byte
+        ranges, followed by (worker, progress_tracker).
+
+        With worker_count == AUTO the number of streams is tuned while transferring: starting from
+        INITIAL_STREAMS, a stream is added every PROBE_INTERVAL as long as it raises the measured
+        throughput by at least MIN_GAIN, one that made things worse is removed again, and the
+        search restarts when the throughput drifts by more than RETUNE_DRIFT. The server's
+        max_streams is the ceiling."""
+        pending: queue.SimpleQueue[tuple[int, int]] = queue.SimpleQueue()
+        for block in blocks:
+            pending.put(block)
+
+        adaptive: bool = worker_count == AUTO
+        limit: int = min(self.max_streams() if adaptive else worker_count, len(blocks))
+        target: int = min(INITIAL_STREAMS, limit) if adaptive else limit
+
+        transferred: int = 0
+        transferred_lock = threading.Lock()
+
+        def track(worker: int, sent: int, fraction: float, wire: int):
+            nonlocal transferred
+            with transferred_lock:
+                transferred += sent
+            if progress_tracker is not None:
+                progress_tracker(worker, sent, fraction, wire)
+
+        # Set by the last stream to leave, so tuning stops as soon as the queue is drained
+        finished = threading.Event()
+        running: int = 0
+
+        def work(worker: int):
+            nonlocal running
+            try:
+                # Streams numbered past the target finish their block and leave
+                while worker < target:
+                    try:
+                        block = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    transfer_block(*block, worker, track)
+            finally:
+                with transferred_lock:
+                    running -= 1
+                    if not running:
+                        finished.set()
+
+        threads: dict[int, threading.Thread] = {}
+
+        def spawn():
+            nonlocal running
+            for i in range(target):
+                if i not in threads or not threads[i].is_alive():
+                    with transferred_lock:
+                        running += 1
+                    # Streams run in a copy of the caller's context, which holds the traced transfer
+                    threads[i] = threading.Thread(target=contextvars.copy_context().run, args=(work, i), name=f"stream {i}")
+                    threads[i].start()
+
+        spawn()
+        if not threads:
+            finished.set()
+        if adaptive:
+            previous_rate: float | None = None
+            settled_rate: float | None = None
+            last_bytes, last_time = 0, time.monotonic()
+
+            # Throughput is only sampled when a whole PROBE_INTERVAL went by without the streams finishing
+            while not finished.wait(max(0.0, last_time + PROBE_INTERVAL - time.monotonic())):
+                now = time.monotonic()
+                with transferred_lock:
+                    rate = (transferred - last_bytes) / (now - last_time)
+                    last_bytes, last_time = transferred, now
+
+                if settled_rate is not None:
+                    if abs(rate - settled_rate) > settled_rate * RETUNE_DRIFT:
+                        # Start the search over by trying one more stream right away, judged
+                        # by the next sample against this one
+                        settled_rate = None
+                        if target < limit:
+                            target += 1
+                            spawn()
+                elif previous_rate is not None and rate < previous_rate * (1 + MIN_GAIN):
+                    # The last stream added did not pay off, drop it if it made things worse
+                    if rate < previous_rate * (1 - MIN_GAIN) and target > 1:
+                        target -= 1
+                    settled_rate = rate
+                elif target < limit:
+                    target += 1
+                    spawn()
+                else:
+                    settled_rate = rate
+                previous_rate = rate
+
+        for thread in list(threads.values()):
+            thread.join()
+
+
+
+    def ping(self):
+        try:
+            with self.pool.connection(self.address) as sock:
+                self.send_command(sock, commands.PING)
+                return self.recv_bool(sock)
+            
+        except Exception as e:
+            # print(f"[PING ERROR] {e}")
+            # The server may come back as a different version, negotiate again next time
+            self.versions.pop(self.address, None)
+            self.capabilities.pop(self.address, None)
+            return False
+
+    def list_files(self):
+        try:
+            # v2 servers list page by page in binary, which also keeps names with '@' intact
+            if self.protocol_version() >= 2:
+                return [(name, time.ctime(ctime), str(size)) for name, ctime, size in self.iter_files()]
+
+            with self.pool.connection(self.address) as sock:
+                self.send_command(sock, commands.LIST)
+                data = self.recv_all(sock, self.recv_int(sock)).decode()
+                data = data.splitlines()
+                files_data: list[tuple[str, str, str]] = []
+                for i in data:
+                    file_data: tuple[str, str, str] = tuple(i.split('@'))
+                    files_data.append(file_data)
+                return files_data
+        
+        except Exception as e:
+            log.error("[FILE LISTING ERROR]", extra=fields(error=e))
+
+    def list_page(self, pattern: str = '', glob: bool = False, sort: str = 'name', descending: bool = False,
+                  limit: int = LIST_PAGE_SIZE, cursor: bytes | None = None) -> tuple[list[tuple[str, float, int]], bytes | None]:
+        """One page of (name, ctime, size) entries whose name starts with `pattern`, or matches it
+        as a glob, sorted by 'name', 'ctime' or 'size', and the cursor that fetches the next page,
+        None after the last one."""
+        if self.protocol_version() < 2:
+            raise UnsupportedError("The server does not support paginated listings")
+
+        with self.pool.connection(self.address) as sock:
+            encoded_pattern = pattern.encode()
+            self.send_command(sock, commands.LIST_PAGE, len(encoded_pattern))
+            sock.sendall(encoded_pattern)
+            cursor = b'' if cursor is None else cursor
+            sock.sendall(struct.pack('!?B?IH', glob, SORT_KEYS.index(sort), descending, limit, len(cursor)) + cursor)
+
+            entries: list[tuple[str, float, int]] = []
+            for _ in range(struct.unpack('!I', self.recv_all(sock, 4))[0]):
+                name = self.recv_all(sock, struct.unpack('!H', self.recv_all(sock, 2))[0]).decode()
+                ctime, size = struct.unpack('!dQ', self.recv_all(sock, 16))
+                entries.append((name, ctime, size))
+            next_cursor = self.recv_all(sock, struct.unpack('!H', self.recv_all(sock, 2))[0])
+
+        return entries, next_cursor or None
+
+    def iter_files(self, pattern: str = '', glob: bool = False, sort: str = 'name', descending: bool = False):
+        """Every matching (name, ctime, size) entry, fetched a page at a time."""
+        cursor: bytes | None = None
+        while True:
+            entries, cursor = self.list_page(pattern, glob, sort, descending, cursor=cursor)
+            yield from entries
+            if cursor is None:
+                return
+
+    def watch(self, since: int = 0):
+        """Follow the changes made on the server. Yields (token, reset, changes) batches, changes
+        being (kind, name, ctime, size) with kind one of commands.FILE_ADDED, FILE_COMPLETED and
+        FILE_DELETED. The first batch comes right away with the current token. `reset` means
+        `since` could not be followed and the file list has to be fetched again. The stream ends
+        with an exception when the connection is lost, watch from the last token to go on."""
+        if self.protocol_version() < 2:
+            raise UnsupportedError("The server does not support watching")
+
+        # A dedicated connection, the server keeps pushing on it so it can never go back to the pool
+        sock = socket.create_connection(self.address)
+        try:
+            sock.settimeout(WATCH_TIMEOUT)
+            self.send_command(sock, commands.WATCH)
+            self.send_int(sock, since)
+            while True:
+                reset, token, count = struct.unpack('!?QI', self.recv_all(sock, 13))
+                changes: list[tuple[int, str, float, int]] = []
+                for _ in range(count):
+                    kind, length = struct.unpack('!BH', self.recv_all(sock, 3))
+                    name = self.recv_all(sock, length).decode()
+                    ctime, size = struct.unpack('!dQ', self.recv_all(sock, 16))
+                    changes.append((kind, name, ctime, size))
+                yield token, reset, changes
+
+        finally:
+            sock.close()
+
+    def stat(self, file_name: str) -> tuple[float, int, bool] | None:
+        """(ctime, size, complete) of a file on the server, None when it is not there."""
+        if self.protocol_version() < 2:
+            for name, ctime, size in self.list_files() or []:
+                if name == file_name:
+                    return time.mktime(time.strptime(ctime)), int(size), True
+            return None
+
+        with self.pool.connection(self.address) as sock:
+            encoded_name = file_name.encode()
+            self.send_command(sock, commands.STAT, len(encoded_name))
+            sock.sendall(encoded_name)
+            if not self.recv_bool(sock):
+                return None
+            complete, ctime, size = struct.unpack('!?dQ', self.recv_all(sock, 17))
+            return ctime, size, complete
+
+    def stats(self) -> str:
+        """The server's counters, gauges and per-command latency histograms in the Prometheus
+        text format."""
+        if self.capability('stats') != '1':
+            raise UnsupportedError("The server does not report metrics")
+
+        with self.pool.connection(self.address) as sock:
+            self.send_command(sock, commands.STATS)
+            return self.recv_all(sock, self.recv_int(sock)).decode()
+
+    def upload_chunk(self, path: str, start_byte: int, end_byte: int, chunk_number: int, progress_tracker = None, file_name: str | None = None):
+        started: float = time.perf_counter()
+        try:
+            with tracer.span('upload chunk', range=f"{start_byte}-{end_byte}"), self.pool.connection(self.address) as sock:
+
+                file_name = os.path.basename(path) if file_name is None else file_name
+                encoded_name = file_name.encode()
+                chunk_codec = self.codec()
+                self.send_command(sock, commands.UPLOAD_CHUNK, len(encoded_name), chunk_codec is not None)
+                sock.sendall(encoded_name)
+                self.send_int(sock, start_byte)
+                self.send_int(sock, end_byte)
+
+                data_length: int = end_byte - start_byte + 1
+                total_sent: int = 0
+
+                def track_sent(sent: int, wire: int | None = None):
+                    nonlocal total_sent
+                    total_sent += sent
+                    progress_tracker(chunk_number, sent, total_sent / data_length, sent if wire is None else wire)
+
+                # v2 servers check the digest of every piece, it is computed as the data is sent
+                hasher = fileio.RangeHasher(start_byte) if self.protocol_version() >= 2 else None
+                with open(path, 'rb') as file:
+                    fileio.advise_sequential(file, start_byte, data_length)
+                    if chunk_codec is not None:
+                        codec.send_frames(sock, file, start_byte, data_length, chunk_codec, None if progress_tracker is None else track_sent, hasher)
+                    else:
+                        fileio.send_file_range(sock, file, start_byte, data_length, None if progress_tracker is None else track_sent, hasher)
+                    fileio.release_range(file, start_byte, data_length)
+
+                # and acknowledge once the chunk is on disk
+                if hasher is not None:
+                    sock.sendall(b''.join(hasher.finish()))
+                    with tracer.span('ack', 'socket'):
+                        accepted = self.recv_bool(sock)
+                    if not accepted:
+                        raise ValueError("Server rejected the chunk, checksum mismatch")
+
+                chunk_log.info("Chunk uploaded", extra=fields(self.peer(), file_name, (start_byte, end_byte), time.perf_counter() - started, chunk=chunk_number))
+                return True
+        
+        except Exception as e:
+            log.warning("[CHUNK UPLOAD ERROR]", extra=fields(self.peer(), range=(start_byte, end_byte), error=e))
+            return False
+
+    def remote_digest(self, file_name: str) -> bytes | None:
+        """Digest of a file on the server, None if the server does not have the file or its digest."""
+        with self.pool.connection(self.address) as sock:
+            encoded_name = file_name.encode()
+            self.send_command(sock, commands.REQUEST_DOWNLOAD, len(encoded_name))
+            sock.sendall(encoded_name)
+            self.recv_bool(sock)
+            self.recv_int(sock)
+            return self.recv_digest(sock)
+
+    def local_block_digests(self, path: str) -> list[bytes]:
+        hasher = fileio.RangeHasher(0)
+        with open(path, 'rb') as file:
+            while data := file.read(fileio.BUFFER_SIZE):
+                hasher.update(memoryview(data))
+        return hasher.finish()
+
+    def local_digest(self, path: str) -> bytes:
+        """Digest of a local file computed the same way the server does, to compare with remote_digest."""
+        file_hash = fileio.new_hash()
+        for digest in self.local_block_digests(path):
+            file_hash.update(digest)
+        return file_hash.digest()
+
+    def query_ranges(self, file_name: str) -> tuple[int, list[tuple[int, int]]] | None:
+        """Size of a file on the server and the byte ranges of it that the server has stored,
+        None when the file is not on the server."""
+        if self.protocol_version() < 2:
+            raise UnsupportedError("The server does not support resumable transfers")
+
+        with self.pool.connection(self.address) as sock:
+            encoded_name = file_name.encode()
+            self.send_command(sock, commands.QUERY_RANGES, len(encoded_name))
+            sock.sendall(encoded_name)
+            file_exists = self.recv_bool(sock)
+            file_size = self.recv_int(sock)
+            ranges = [(self.recv_int(sock), self.recv_int(sock)) for _ in range(self.recv_int(sock))]
+
+        return (file_size, ranges) if file_exists else None
+
+    def offer_blocks(self, path: str, file_name: str | None = None) -> list[tuple[int, int]]:
+        """Start an upload by sending the digest of every block of `path`, and return the byte
+        ranges the server still needs because its block store does not have them."""
+        file_name = os.path.basename(path) if file_name is None else file_name
+        file_size = os.path.getsize(path)
+        digests = self.local_block_digests(path)
+
+        with self.pool.connection(self.address) as sock:
+            encoded_name = file_name.encode()
+            self.send_command(sock, commands.OFFER_BLOCKS, len(encoded_name))
+            sock.sendall(encoded_name)
+            self.send_int(sock, file_size)
+            sock.sendall(b''.join(digests))
+            if self.recv_bool(sock):
+                digest = self.recv_digest(sock)
+                raise FileExistsError("File has already existed on the server" + ("" if digest is None else f" (digest {digest.hex()})"))
+            present = self.recv_all(sock, len(digests))
+
+        missing: list[tuple[int, int]] = []
+        for i, stored in enumerate(present):
+            if not stored:
+                start_byte = i * commands.DIGEST_BLOCK_SIZE
+                missing = merge_range(missing, start_byte, min(start_byte + commands.DIGEST_BLOCK_SIZE, file_size) - 1)
+        return missing
+
+    @tracing.transfer('upload file')
+    def upload_file(self, path: str, chunk_count: int = 4, progress_tracker = None, resume: bool = False, file_name: str | None = None) -> bool:
+        """Upload `path` under its base name, or `file_name` which may hold '/' to put it in a
+        directory on the server, and tell whether it got there whole."""
+        try:
+            file_name = os.path.basename(path) if file_name is None else file_name
+            file_size = os.path.getsize(path)
+            # v1 servers cannot tell what they have, resuming there is a whole upload
+            status = self.query_ranges(file_name) if resume and self.protocol_version() >= 2 else None
+            small_file_size = self.small_file_size()
+
+            if status is None and small_file_size and file_size <= small_file_size:
+                self.upload_small(path, file_name, progress_tracker)
+                return True
+
+            elif status is None and file_size and self.capability('dedup') == '1':
+                # The server keeps blocks by content, only the blocks it has never seen are sent
+                missing = self.offer_blocks(path, file_name)
+                report_resumed(progress_tracker, file_size, missing)
+
+            elif status is None:
+                with self.pool.connection(self.address) as sock:
+                    encoded_name = file_name.encode()
+                    self.send_command(sock, commands.REQUEST_UPLOAD, len(encoded_name))
+                    sock.sendall(encoded_name)
+                    file_exists = self.recv_bool(sock)
+                    if file_exists:
+                        digest = self.recv_digest(sock)
+                        raise FileExistsError("File has already existed on the server" + ("" if digest is None else f" (digest {digest.hex()})"))
+
+                    self.send_int(sock, file_size)
+                missing = missing_ranges([], file_size)
+
+            else:
+                server_size, completed = status
+                if server_size != file_size:
+                    raise ValueError("The partial upload on the server has a different size")
+                missing = missing_ranges(completed, file_size)
+                if not missing:
+                    raise FileExistsError("File has already existed on the server")
+                report_resumed(progress_tracker, file_size, missing)
+
+            for _ in range(TRANSFER_ATTEMPTS):
+                self.run_workers(self.split_blocks(missing, chunk_count), chunk_count,
+                                 lambda start_byte, end_byte, worker, tracker: self.upload_chunk(path, start_byte, end_byte, worker, tracker, file_name),
+                                 progress_tracker)
+
+                # v1 servers cannot tell which ranges arrived
+                if self.protocol_version() < 2:
+                    return True
+                status = self.query_ranges(file_name)
+                if status is None:
+                    raise FileNotFoundError("File was removed from the server during the upload")
+                missing = missing_ranges(status[1], file_size)
+                if not missing:
+                    return True
+
+            raise ConnectionError(f"Upload incomplete, {missing_size(missing)} bytes missing, continue it with resume_upload")
+            
+        except Exception as e:
+            log.error("[FILE UPLOAD ERROR]", extra=fields(file=path, error=e))
+            return False
+
+    @tracing.transfer('upload small')
+    def upload_small(self, path: str, file_name: str, progress_tracker = None) -> tuple[float, int, bytes]:
+        """Upload a file of at most small_file_size() bytes in a single round trip, the data going
+        with the request, and return the (ctime, size, digest) the server stored it with."""
+        file_size = os.path.getsize(path)
+        with self.pool.connection(self.address) as sock:
+            small_codec = self.codec()
+            encoded_name = file_name.encode()
+            self.send_command(sock, commands.UPLOAD_SMALL, len(encoded_name), small_codec is not None)
+            sock.sendall(encoded_name)
+            self.send_int(sock, file_size)
+
+            total_sent: int = 0
+
+            def track_sent(sent: int, wire: int | None = None):
+                nonlocal total_sent
+                total_sent += sent
+                progress_tracker(0, sent, total_sent / file_size, sent if wire is None else wire)
+
+            hasher = fileio.RangeHasher(0)
+            with open(path, 'rb') as file:
+                if small_codec is not None:
+                    codec.send_frames(sock, file, 0, file_size, small_codec, None if progress_tracker is None else track_sent, hasher)
+                else:
+                    fileio.send_file_range(sock, file, 0, file_size, None if progress_tracker is None else track_sent, hasher)
+            sock.sendall(b''.join(hasher.finish()))
+
+            status = self.recv_all(sock, 1)[0]
+            if status == commands.BATCH_EXISTS:
+                raise FileExistsError("File has already existed on the server")
+            if status == commands.BATCH_INVALID:
+                raise ValueError("The name is not valid or conflicts with a directory on the server")
+            if status != commands.BATCH_OK:
+                raise ValueError("Server rejected the file, checksum mismatch")
+            ctime, size = struct.unpack('!dQ', self.recv_all(sock, 16))
+            digest = self.recv_all(sock, commands.DIGEST_SIZE)
+
+        log.info("Uploaded in a single round trip", extra=fields(self.peer(), file_name, size=size))
+        return ctime, size, digest
+
+    def resume_upload(self, path: str, chunk_count: int = 4, progress_tracker = None, file_name: str | None = None) -> bool:
+        """Upload only the ranges of `path` that the server does not have yet, or the whole
+        file if the server has never seen it or cannot tell. `file_name` is as in upload_file."""
+        return self.upload_file(path, chunk_count, progress_tracker, resume=True, file_name=file_name)
+
+    def signatures(self, file_name: str, block_size: int) -> tuple[int, bytes, list[tuple[int, bytes]]] | None:
+        """Size, digest and (weak, strong) block signatures of a complete file on the server,
+        None when the server does not have it or is still receiving it."""
+        with self.pool.connection(self.address) as sock:
+            encoded_name = file_name.encode()
+            self.send_command(sock, commands.SIGNATURES, len(encoded_name))
+            sock.sendall(encoded_name)
+            self.send_int(sock, block_size)
+            if not self.recv_bool(sock):
+                return None
+            file_size = self.recv_int(sock)
+            digest = self.recv_all(sock, commands.DIGEST_SIZE)
+            data = self.recv_all(sock, self.recv_int(sock) * (4 + commands.DIGEST_SIZE))
+
+        record_size = 4 + commands.DIGEST_SIZE
+        signatures = [(struct.unpack('!I', data[i:i + 4])[0], data[i + 4:i + record_size]) for i in range(0, len(data), record_size)]
+        return file_size, digest, signatures
+
+    @tracing.transfer('update file')
+    def update_file(self, path: str, progress_tracker = None, file_name: str | None = None) -> bool:
+        """Replace the server's copy of `path`, named `file_name` or after the base name of `path`,
+        with the local one rsync style: the server sends block signatures of its version and only
+        the data it does not have already goes back, the rest is copied on the server. Files the
+        server does not have are uploaded whole. Tells whether the server's copy was replaced."""
+        try:
+            if self.protocol_version() < 2:
+                raise UnsupportedError("The server does not support delta updates")
+            file_name = os.path.basename(path) if file_name is None else file_name
+            file_size = os.path.getsize(path)
+            block_size = delta.block_size_for(file_size)
+            base = self.signatures(file_name, block_size)
+            if base is None:
+                return self.upload_file(path, progress_tracker=progress_tracker, file_name=file_name)
+            base_size, base_digest, signatures = base
+
+            with open(path, 'rb') as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if file_size else b''
+                try:
+                    instructions = delta.compute_delta(data, base_size, signatures, block_size)
+                finally:
+                    if file_size:
+                        data.close()
+            digest = self.local_digest(path)
+
+            done: int = 0
+
+            def track(sent: int, wire: int | None = None):
+                nonlocal done
+                done += sent
+                progress_tracker(0, sent, done / file_size, sent if wire is None else wire)
+
+            with self.pool.connection(self.address) as sock, open(path, 'rb') as file:
+                encoded_name = file_name.encode()
+                self.send_command(sock, commands.APPLY_DELTA, len(encoded_name))
+                sock.sendall(encoded_name)
+                self.send_int(sock, file_size)
+                sock.sendall(base_digest)
+                self.send_int(sock, len(instructions))
+                for kind, offset, length in instructions:
+                    sock.sendall(struct.pack('!B', kind))
+                    if kind == delta.COPY:
+                        self.send_int(sock, offset)
+                        self.send_int(sock, length)
+                        if progress_tracker is not None:
+                            track(length, 0)
+                    else:
+                        self.send_int(sock, length)
+                        fileio.send_file_range(sock, file, offset, length, None if progress_tracker is None else track)
+                sock.sendall(digest)
+
+                # Rebuilding a large file takes a while on the server
+                sock.settimeout(None)
+                applied = self.recv_bool(sock)
+                sock.settimeout(socket.getdefaulttimeout())
+            if not applied:
+                raise ValueError("Server rejected the update, its copy changed meanwhile or the result did not verify")
+
+            literal = sum(length for kind, _, length in instructions if kind == delta.LITERAL)
+            log.info("Updated", extra=fields(self.peer(), file_name, sent=literal, size=file_size))
+            return True
+
+        except Exception as e:
+            log.error("[FILE UPDATE ERROR]", extra=fields(file=path, error=e))
+            return False
+            
+    def download_chunk(self, file_name: str, destination: str, start_byte: int, end_byte: int, chunk_number: int, progress_tracker = None,
+                       digests: BlockDigests | None = None, journal: RangeJournal | None = None):
+        """Fetch an inclusive range into `destination` and tell whether all of it arrived intact.
+        Pieces whose digest matches are recorded in `digests` and `journal` even when others
+        of the range do not, so only the bad pieces have to be fetched again."""
+        started: float = time.perf_counter()
+        try:
+            with tracer.span('download chunk', range=f"{start_byte}-{end_byte}"), self.pool.connection(self.address) as sock:
+
+                chunk_codec = self.codec()
+                encoded_name = file_name.encode()
+                self.send_command(sock, commands.DOWNLOAD_CHUNK, len(encoded_name), chunk_codec is not None)
+                sock.sendall(encoded_name)
+                self.send_int(sock, start_byte)
+                self.send_int(sock, end_byte)
+                if chunk_codec is not None:
+                    sock.sendall(struct.pack('!B', chunk_codec))
+
+                data_length: int = end_byte - start_byte + 1
+                total_received: int = 0
+
+                def track_received(received: int, wire: int | None = None):
+                    nonlocal total_received
+                    total_received += received
+                    progress_tracker(chunk_number, received, total_received / data_length, received if wire is None else wire)
+
+                # v2 servers follow the data with the digest of every piece of it
+                hasher = fileio.RangeHasher(start_byte) if self.protocol_version() >= 2 else None
+                with open(destination, 'r+b') as file:
+                    if chunk_codec is not None:
+                        codec.recv_frames(sock, file, start_byte, data_length, None if progress_tracker is None else track_received, hasher)
+                    else:
+                        fileio.recv_file_range(sock, file, start_byte, data_length, None if progress_tracker is None else track_received, hasher)
+                    fileio.release_range(file, start_byte, data_length)
+
+                if hasher is not None:
+                    pieces = fileio.digest_pieces(start_byte, end_byte)
+                    expected = self.recv_all(sock, len(pieces) * commands.DIGEST_SIZE)
+
+            verified: list[tuple[int, int]] = []
+            if hasher is None:
+                verified = [(start_byte, end_byte)]
+            else:
+                for i, (piece, digest) in enumerate(zip(pieces, hasher.finish())):
+                    if digest == expected[i * commands.DIGEST_SIZE:(i + 1) * commands.DIGEST_SIZE]:
+                        if digests is not None:
+                            digests.record(*piece, digest)
+                        verified = merge_range(verified, *piece)
+            if journal is not None:
+                for verified_range in verified:
+                    journal.add(*verified_range)
+            if verified != [(start_byte, end_byte)]:
+                failed = missing_ranges(verified, end_byte + 1)
+                raise ValueError(f"Checksum mismatch in {', '.join(f'{start}-{end}' for start, end in failed if end >= start_byte)}")
+
+            chunk_log.info("Chunk downloaded", extra=fields(self.peer(), file_name, (start_byte, end_byte), time.perf_counter() - started, chunk=chunk_number))
+            return True
+        
+        except Exception as e:
+            log.warning("[CHUNK DOWNLOAD ERROR]", extra=fields(self.peer(), file_name, (start_byte, end_byte), error=e))
+            return False
+
+    @tracing.transfer('download file')
+    def download_file(self, file_name: str, destination: str, chunk_count: int = 4, progress_tracker = None, resume: bool = False) -> bool:
+        try:
+            # Files up to small_file_size() come back whole in the reply to a one-file batch,
+            # the server only tells the size of bigger ones and they are split across streams
+            small_file_size = self.small_file_size()
+            if small_file_size and not (resume and os.path.exists(destination + JOURNAL_SUFFIX)):
+                failed, large = self.download_batch([(file_name, destination)], 0, progress_tracker, small_file_size)
+                if not large:
+                    return not failed
+
+            with self.pool.connection(self.address) as sock:
+                encoded_name = file_name.encode()
+                self.send_command(sock, commands.REQUEST_DOWNLOAD, len(encoded_name))
+                sock.sendall(encoded_name)
+                file_exists = self.recv_bool(sock)
+                file_size = self.recv_int(sock)
+                server_digest = self.recv_digest(sock)
+
+                if not file_exists:
+                    raise FileNotFoundError("File is not on the server")
+
+            # Completed ranges and block digests are journaled next to the destination until the download is done
+            download_journal = RangeJournal.load(destination + JOURNAL_SUFFIX) if resume else None
+            download_digests = BlockDigests(destination + DIGESTS_SUFFIX, file_size)
+            if download_journal is None or download_journal.size != file_size or not os.path.exists(destination):
+                fileio.allocate(destination, file_size)
+                download_journal = RangeJournal(destination + JOURNAL_SUFFIX, file_size)
+                download_journal.save()
+                download_digests.remove()
+            else:
+                report_resumed(progress_tracker, file_size, download_journal.missing())
+
+            def download_block(start_byte: int, end_byte: int, worker: int, tracker):
+                self.download_chunk(file_name, destination, start_byte, end_byte, worker, tracker, download_digests, download_journal)
+
+            for _ in range(TRANSFER_ATTEMPTS):
+                missing = download_journal.missing()
+                if not missing:
+                    break
+                self.run_workers(self.split_blocks(missing, chunk_count), chunk_count, download_block, progress_tracker)
+
+            missing = download_journal.missing()
+            if missing:
+                raise ConnectionError(f"Download incomplete, {missing_size(missing)} bytes missing, continue it with resume_download")
+
+            local_digest = download_digests.file_digest()
+            if server_digest is not None and local_digest is not None and local_digest != server_digest:
+                # Every block matched when it arrived, so the file changed on the server meanwhile
+                raise ValueError("Downloaded file does not match the digest of the file on the server")
+            download_journal.remove()
+            download_digests.remove()
+            return True
+
+        except Exception as e:
+            log.error("[FILE DOWNLOAD ERROR]", extra=fields(file=file_name, error=e))
+            return False
+
+    def resume_download(self, file_name: str, destination: str, chunk_count: int = 4, progress_tracker = None) -> bool:
+        """Continue an interrupted download into `destination`, fetching only the ranges its journal
+        does not list as completed, or the whole file if there is nothing to resume."""
+        return self.download_file(file_name, destination, chunk_count, progress_tracker, resume=True)
+
+    @tracing.transfer('upload batch')
+    def upload_batch(self, batch: list[tuple[str, str, int]], worker: int, progress_tracker = None) -> list[str]:
+        """Upload a batch of (path, name, size) files on one connection: the names and sizes go
+        first and the files the server accepts follow back to back, each with the digest of its
+        pieces. Returns the names that were not stored."""
+        try:
+            with self.pool.connection(self.address) as sock:
+                batch_codec = self.codec()
+                self.send_command(sock, commands.UPLOAD_BATCH, len(batch), batch_codec is not None)
+                entries = bytearray()
+                for _, file_name, file_size in batch:
+                    encoded_name = file_name.encode()
+                    entries += struct.pack('!H', len(encoded_name)) + encoded_name + struct.pack(self.int_format(), file_size)
+                sock.sendall(entries)
+                statuses = self.recv_all(sock, len(batch))
+                accepted = [entry for entry, status in zip(batch, statuses) if status == commands.BATCH_OK]
+
+                batch_bytes: int = max(1, sum(file_size for _, _, file_size in accepted))
+                total_sent: int = 0
+
+                def track_sent(sent: int, wire: int | None = None):
+                    nonlocal total_sent
+                    total_sent += sent
+                    progress_tracker(worker, sent, total_sent / batch_bytes, sent if wire is None else wire)
+
+                for path, _, file_size in accepted:
+                    hasher = fileio.RangeHasher(0)
+                    with open(path, 'rb') as file:
+                        if batch_codec is not None:
+                            codec.send_frames(sock, file, 0, file_size, batch_codec, None if progress_tracker is None else track_sent, hasher)
+                        else:
+                            fileio.send_file_range(sock, file, 0, file_size, None if progress_tracker is None else track_sent, hasher)
+                    sock.sendall(b''.join(hasher.finish()))
+                stored = self.recv_all(sock, len(accepted))
+
+            failed: list[str] = []
+            for (_, file_name, _), status in zip(batch, statuses):
+                if status != commands.BATCH_OK:
+                    log.warning("[BATCH UPLOAD ERROR]", extra=fields(file=file_name, error="has already existed on the server" if status == commands.BATCH_EXISTS else "is not a valid name or conflicts with a directory"))
+                    failed.append(file_name)
+            for (_, file_name, _), ok in zip(accepted, stored):
+                if not ok:
+                    log.warning("[BATCH UPLOAD ERROR]", extra=fields(file=file_name, error="was rejected by the server"))
+                    failed.append(file_name)
+
+            log.info("Batch uploaded", extra=fields(self.peer(), files=len(batch), stream=worker))
+            return failed
+
+        except Exception as e:
+            log.error("[BATCH UPLOAD ERROR]", extra=fields(self.peer(), files=len(batch), error=e))
+            return [file_name for _, file_name, _ in batch]
+
+    @tracing.transfer('upload files')
+    def upload_files(self, files: list[tuple[str, str]], chunk_count: int = 4, progress_tracker = None) -> list[str]:
+        """Upload many files, given as (local path, name on the server) pairs where names may hold
+        '/' to build a directory tree on the server. Files up to BATCH_FILE_SIZE are streamed back
+        to back in batches over chunk_count connections, two round trips per batch whatever the
+        number of files in it, bigger ones go through upload_file. Returns the names that were not
+        uploaded."""
+        try:
+            if self.protocol_version() < 2:
+                raise UnsupportedError("The server does not support batch transfers")
+
+            failed: list[str] = []
+            failed_lock = threading.Lock()
+            small: list[tuple[str, str, int]] = []
+            large: list[tuple[str, str]] = []
+            for path, file_name in files:
+                file_size = os.path.getsize(path)
+                if file_size <= BATCH_FILE_SIZE:
+                    small.append((path, file_name, file_size))
+                else:
+                    large.append((path, file_name))
+
+            def upload_batch(batch: list[tuple[str, str, int]], worker: int, tracker):
+                rejected = self.upload_batch(batch, worker, tracker)
+                with failed_lock:
+                    failed.extend(rejected)
+
+            self.run_workers([(batch,) for batch in self.split_batches(small)], chunk_count, upload_batch, progress_tracker)
+            for path, file_name in large:
+                if not self.upload_file(path, chunk_count, progress_tracker, file_name=file_name):
+                    failed.append(file_name)
+            return failed
+
+        except Exception as e:
+            log.error("[FILE UPLOAD ERROR]", extra=fields(files=len(files), error=e))
+            return [file_name for _, file_name in files]
+
+    def upload_directory(self, directory: str, remote_directory: str = '', chunk_count: int = 4, progress_tracker = None) -> list[str]:
+        """Upload every file under `directory` to the same place under `remote_directory` on the
+        server, returning the names that were not uploaded."""
+        files: list[tuple[str, str]] = []
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                files.append((path, posixpath.join(remote_directory, *os.path.relpath(path, directory).split(os.sep))))
+        return self.upload_files(files, chunk_count, progress_tracker)
+
+    @tracing.transfer('download batch')
+    def download_batch(self, batch: list[tuple[str, str]], worker: int, progress_tracker = None, size_limit: int = BATCH_FILE_SIZE) -> tuple[list[str], list[tuple[str, str]]]:
+        """Download a batch of (name, destination) files on one connection, the server streams them
+        back to back right after the request. Returns the names that were not downloaded and the
+        files the server left out for being bigger than `size_limit`."""
+        failed: list[str] = []
+        large: list[tuple[str, str]] = []
+        position: int = 0
+        try:
+            with self.pool.connection(self.address) as sock:
+                batch_codec = self.codec()
+                self.send_command(sock, commands.DOWNLOAD_BATCH, len(batch), batch_codec is not None)
+                request = bytearray()
+                for file_name, _ in batch:
+                    encoded_name = file_name.encode()
+                    request += struct.pack('!H', len(encoded_name)) + encoded_name
+                request += struct.pack(self.int_format(), size_limit)
+                if batch_codec is not None:
+                    request += struct.pack('!B', batch_codec)
+                sock.sendall(request)
+
+                for position, (file_name, destination) in enumerate(batch):
+                    status, file_size = struct.unpack('!BQ', self.recv_all(sock, 9))
+                    if status == commands.BATCH_TOO_LARGE:
+                        large.append((file_name, destination))
+                        continue
+                    if status != commands.BATCH_OK:
+                        log.warning("[BATCH DOWNLOAD ERROR]", extra=fields(file=file_name, error="is not on the server"))
+                        failed.append(file_name)
+                        continue
+
+                    total_received: int = 0
+
+                    def track_received(received: int, wire: int | None = None):
+                        nonlocal total_received
+                        total_received += received
+                        progress_tracker(worker, received, total_received / file_size, received if wire is None else wire)
+
+                    if os.path.dirname(destination):
+                        os.makedirs(os.path.dirname(destination), exist_ok=True)
+                    hasher = fileio.RangeHasher(0)
+                    with open(destination, 'wb') as file:
+                        if batch_codec is not None:
+                            codec.recv_frames(sock, file, 0, file_size, None if progress_tracker is None else track_received, hasher)
+                        else:
+                            fileio.recv_file_range(sock, file, 0, file_size, None if progress_tracker is None else track_received, hasher)
+                    expected = self.recv_all(sock, len(fileio.digest_pieces(0, file_size - 1)) * commands.DIGEST_SIZE)
+                    if b''.join(hasher.finish()) != expected:
+                        log.warning("[BATCH DOWNLOAD ERROR]", extra=fields(file=file_name, error="checksum mismatch"))
+                        os.remove(destination)
+                        failed.append(file_name)
+
+            log.info("Batch downloaded", extra=fields(self.peer(), files=len(batch), stream=worker))
+
+        except Exception as e:
+            log.error("[BATCH DOWNLOAD ERROR]", extra=fields(self.peer(), files=len(batch), error=e))
+            # Everything from the file being received on is lost with the connection
+            failed += [file_name for file_name, _ in batch[position:]]
+        return failed, large
+
+    @tracing.transfer('download files')
+    def download_files(self, files: list[tuple[str, str]], chunk_count: int = 4, progress_tracker = None) -> list[str]:
+        """Download many files, given as (name on the server, destination) pairs, creating the
+        directories the destinations need. Files are streamed back to back in batches over
+        chunk_count connections, one round trip per batch, and those bigger than BATCH_FILE_SIZE
+        are fetched with download_file after. Returns the names that were not downloaded."""
+        try:
+            if self.protocol_version() < 2:
+                raise UnsupportedError("The server does not support batch transfers")
+
+            failed: list[str] = []
+            large: list[tuple[str, str]] = []
+            results_lock = threading.Lock()
+
+            def download_batch(batch: list[tuple[str, str]], worker: int, tracker):
+                batch_failed, batch_large = self.download_batch(batch, worker, tracker)
+                with results_lock:
+                    failed.extend(batch_failed)
+                    large.extend(batch_large)
+
+            batches = [(files[i:i + BATCH_FILES],) for i in range(0, len(files), BATCH_FILES)]
+            self.run_workers(batches, chunk_count, download_batch, progress_tracker)
+            for file_name, destination in large:
+                if os.path.dirname(destination):
+                    os.makedirs(os.path.dirname(destination), exist_ok=True)
+                if not self.download_file(file_name, destination, chunk_count, progress_tracker):
+                    failed.append(file_name)
+            return failed
+
+        except Exception as e:
+            log.error("[FILE DOWNLOAD ERROR]", extra=fields(files=len(files), error=e))
+            return [file_name for file_name, _ in files]
+
+    def download_directory(self, remote_directory: str, destination: str, chunk_count: int = 4, progress_tracker = None) -> list[str]:
+        """Download every file under `remote_directory` on the server to the same place under
+        `destination`, returning the names that were not downloaded."""
+        prefix = remote_directory.rstrip('/') + '/' if remote_directory else ''
+        files: list[tuple[str, str]] = []
+        for file_name, _, _ in self.iter_files(prefix):
+            relative = file_name[len(prefix):]
+            # Names come from the server, never let one point outside the destination
+            if fileio.valid_name(relative):
+                files.append((file_name, os.path.join(destination, *relative.split('/'))))
+        return self.download_files(files, chunk_count, progress_tracker)
+
+    def delete_file(self, file_name: str):
+        try:
+            with self.pool.connection(self.address) as sock:
+                encoded_name = file_name.encode()
+                self.send_command(sock, commands.DELETE, len(encoded_name))
+                sock.sendall(encoded_name)
+                file_exists = self.recv_bool(sock)
+                if not file_exists:
+                    raise FileNotFoundError("File is not on the server")
+        
+        except Exception as e:
+            log.error("[FILE DELETION ERROR]", extra=fields(file=file_name, error=e))
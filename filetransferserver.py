@@ -1,169 +1,1102 @@
-import os
-import socket
-import threading
-import struct
-import time
-from humanize import naturalsize
-
-import commands
-
-HOST = '0.0.0.0'
-PORT = 61306
-ADDRESS = (HOST, PORT)
-SIZE = 1024
-SERVER_DATA_PATH = "server_data"
-
-
-
-def send_bool(conn: socket.socket, value: bool):
-    conn.sendall(struct.pack('!?', value))
-
-def send_int(conn: socket.socket, value: int):
-    conn.sendall(struct.pack('!I', value))
-
-def recv_int(sock: socket.socket) -> int:
-    return struct.unpack('!I', sock.recv(4))[0]
-
-def recv_all(sock: socket.socket, length: int) -> bytes:
-    data = bytearray()
-    while len(data) < length:
-        packet = sock.recv(length - len(data))
-        if not packet:
-            raise ConnectionError("Socket connection closed before receiving all data")
-        data.extend(packet)
-    return bytes(data)
-
-def path_to(file_name: str):
-    return os.path.join(SERVER_DATA_PATH, file_name)
-
-
-
-def handle_client(conn: socket.socket, addr: str):
-    print(f"[NEW CONNECTION] {addr}")
-
-    try:
-        while True:
-            header = conn.recv(5)
-            if not header:
-                break
-            command, data_length = struct.unpack('!BI', header)
-            # print(f"[COMMAND] {command} with data length {data_length}")
-
-            match command:
-                case commands.PING:
-                    # print(f"[PING] {addr}")
-                    send_bool(conn, True)
-
-                case commands.LIST:
-                    print(f"[LIST] {addr}")
-                    files = os.listdir(SERVER_DATA_PATH)
-                    for i in range(len(files)):
-                        file: str = files[i]
-                        path = path_to(file)
-                        creation_time: str = time.ctime(os.path.getctime(path))
-                        size: str = str(os.path.getsize(path))
-                        files[i] = f"{file}@{creation_time}@{size}"
-                    data = '\n'.join(file_data for file_data in files).encode()
-                    send_int(conn, len(data))
-                    conn.sendall(data)
-
-                case commands.REQUEST_UPLOAD:
-                    file_name: str = recv_all(conn, data_length).decode()
-                    path: str = os.path.join(SERVER_DATA_PATH, file_name)
-                    file_exists: bool = os.path.exists(path)
-                    if file_exists:
-                        send_bool(conn, True)
-                        break
-                    send_bool(conn, False)
-
-                    file_size: int = recv_int(conn)
-                    with open(path, 'wb') as file:
-                        file.seek(file_size - 1)
-                        file.write(b'\0')
-
-                    print(f"[REQUEST UPLOAD] {addr} {file_name}")
-                    
-                case commands.REQUEST_DOWNLOAD:
-                    file_name: str = recv_all(conn, data_length).decode()
-                    path: str = os.path.join(SERVER_DATA_PATH, file_name)
-                    
-                    if not os.path.exists(path):
-                        conn.sendall(struct.pack('!?I', False, 0))
-                    else:
-                        conn.sendall(struct.pack('!?I', True, os.path.getsize(path)))
-                    
-                    print(f"[REQUEST DOWNLOAD] {addr} {file_name}")
-
-                case commands.UPLOAD_CHUNK:
-                    try:
-                        file_name: str = recv_all(conn, data_length).decode()
-                        path: str = path_to(file_name)
-                        start_byte: int = recv_int(conn)
-                        end_byte: int = recv_int(conn)
-                        data: bytes = recv_all(conn, end_byte - start_byte + 1)
-
-                        with open(path, 'r+b') as file:
-                            file.seek(start_byte)
-                            file.write(data)
-                        
-                        print(f"[UPLOAD CHUNK] {addr} {file_name} {start_byte} {end_byte}")
-                    
-                    except Exception as e:
-                        print(f"[CHUNK UPLOAD ERROR] {addr} {e}")
-
-                case commands.DOWNLOAD_CHUNK:
-                    try:
-                        file_name: str = recv_all(conn, data_length).decode()
-                        start_byte: int = recv_int(conn)
-                        end_byte: int = recv_int(conn)
-
-                        path: str = path_to(file_name)
-                        with open(path, 'rb') as file:
-                            file.seek(start_byte)
-                            data: bytes = file.read(end_byte - start_byte + 1)
-                            conn.sendall(data)
-                        
-                        print(f"[DOWNLOAD CHUNK] {addr} {file_name} {start_byte} {end_byte}")
-
-                    except Exception as e:
-                        print(f"[CHUNK DOWNLOAD ERROR] {addr} {e}")
-
-                case commands.DELETE:
-                    file_name = recv_all(conn, data_length).decode()
-                    path = os.path.join(SERVER_DATA_PATH, file_name)
-
-                    if os.path.exists(path):
-                        os.remove(path)
-                        send_bool(conn, True)
-                    else:
-                        send_bool(conn, False)
-                    
-                    print(f"[DELETE] {addr} {file_name}")
-
-
-
-    except Exception as e:
-        print(f"[ERROR] {addr} {e}")
-
-    finally:
-        conn.close()
-        print(f"[DISCONNECTED] {addr}")
-
-def start_server():
-    print("[STARTING] Server is starting")
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(ADDRESS)
-    server.listen()
-    print(f"[LISTENING] Server is listening on {HOST}:{PORT}.")
-    print(f"Clients can connect to this server locally at {socket.gethostbyname(socket.gethostname())}")
-
-    while True:
-        conn, addr = server.accept()
-        thread = threading.Thread(target=handle_client, args=(conn, addr))
-        thread.start()
-        print(f"[ACTIVE CONNECTIONS] {threading.active_count() - 1}")
-
-if __name__ == "__main__":
-    if not os.path.exists(SERVER_DATA_PATH):
-        os.makedirs(SERVER_DATA_PATH)
-    start_server()
+import os
+import time
+import socket
+import threading
+import struct
+import queue
+import selectors
+import logging
+import argparse
+import atexit
+import signal
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from humanize import naturalsize
+
+import commands
+import fileio
+import delta
+import codec
+from journal import RangeJournal, BlockDigests, merge_range
+from blockstore import BlockStore
+from filecache import FileCache
+from fileindex import FileIndex, SORT_KEYS, encode_cursor, decode_cursor
+from metrics import Metrics, MeteredSocket, serve_http
+import logs
+from logs import fields
+import tracing
+from tracing import tracer
+
+HOST = '0.0.0.0'
+PORT = 61306
+ADDRESS = (HOST, PORT)
+SIZE = 1024
+SERVER_DATA_PATH = "server_data"
+SERVER_JOURNAL_PATH = "server_journal"
+SERVER_CAS_PATH = "server_cas"
+BACKLOG = 1024
+WORKERS = 32
+# Seconds the selector engine lets a client stall in the middle of a command. A worker is held
+# for the whole command, so this bounds every wait on the client, not the command as a whole
+CLIENT_TIMEOUT = 60
+# Upper bound on the parallel streams a client should open for one transfer
+MAX_STREAMS = 16
+# Most entries one LIST_PAGE reply carries
+LIST_PAGE_LIMIT = 1000
+# Seconds after which a WATCH stream gets an empty batch, so either side notices a dead peer
+WATCH_HEARTBEAT = 15
+# Seconds a watcher may take to accept a batch, a slower one is dropped so it cannot hold up the others
+WATCH_SEND_TIMEOUT = 5
+# Most files one UPLOAD_BATCH or DOWNLOAD_BATCH request may name
+BATCH_LIMIT = 10000
+# Files up to this size go whole in a single round trip, announced as the small_file capability
+SMALL_FILE_SIZE = 1024 * 1024
+# fsync stored files and their directories before a transfer is acknowledged, so an
+# acknowledged file survives a power loss. One sync covers every file of a batch
+SYNC = False
+
+log = logging.getLogger('filetransfer.server')
+# Every chunk is an event, --log-chunk-sample keeps one in N of them
+chunk_log = logging.getLogger('filetransfer.server.chunks')
+
+
+
+def send_bool(conn: socket.socket, value: bool):
+    conn.sendall(struct.pack('!?', value))
+
+def send_int(conn: socket.socket, value: int, version: int = 1):
+    conn.sendall(struct.pack('!' + commands.INT_CODES[version], value))
+
+def recv_int(sock: socket.socket, version: int = 1) -> int:
+    int_format = '!' + commands.INT_CODES[version]
+    return struct.unpack(int_format, recv_all(sock, struct.calcsize(int_format)))[0]
+
+def recv_all(sock: socket.socket, length: int) -> bytes:
+    data = bytearray()
+    while len(data) < length:
+        packet = sock.recv(length - len(data))
+        if not packet:
+            raise ConnectionError("Socket connection closed before receiving all data")
+        data.extend(packet)
+    return bytes(data)
+
+def recv_name(sock: socket.socket, length: int) -> str:
+    """Receive a file name, names may hold '/' to build a tree but never leave SERVER_DATA_PATH."""
+    file_name = recv_all(sock, length).decode()
+    if not fileio.valid_name(file_name):
+        raise ValueError(f"Invalid file name {file_name!r}")
+    return file_name
+
+def path_to(file_name: str):
+    return os.path.join(SERVER_DATA_PATH, file_name)
+
+# Journals, digests and temporary files of every file are kept side by side in SERVER_JOURNAL_PATH
+def journal_path_to(file_name: str):
+    return os.path.join(SERVER_JOURNAL_PATH, fileio.flat_name(file_name) + '.json')
+
+# Journals of uploads still in progress, a file without one is complete
+journals: dict[str, RangeJournal] = {}
+journals_lock = threading.Lock()
+
+def upload_journal(file_name: str) -> RangeJournal | None:
+    with journals_lock:
+        journal = journals.get(file_name)
+        if journal is None:
+            journal = RangeJournal.load(journal_path_to(file_name))
+            if journal is not None:
+                journals[file_name] = journal
+        return journal
+
+def start_upload_journal(file_name: str, file_size: int):
+    journal = RangeJournal(journal_path_to(file_name), file_size)
+    journal.save()
+    with journals_lock:
+        journals[file_name] = journal
+
+def drop_upload_journal(file_name: str):
+    with journals_lock:
+        journals.pop(file_name, None)
+    RangeJournal(journal_path_to(file_name), 0).remove()
+    if store is not None:
+        store.drop_holds(file_name)
+
+def digests_path_to(file_name: str):
+    return os.path.join(SERVER_JOURNAL_PATH, fileio.flat_name(file_name) + '.digests')
+
+def block_digests(file_name: str) -> BlockDigests:
+    return BlockDigests(digests_path_to(file_name), file_size_of(file_name))
+
+def file_digest(file_name: str) -> bytes:
+    """Digest of a complete file, zeros while it is being uploaded or if a block digest is unknown."""
+    digest = None if upload_journal(file_name) is not None else block_digests(file_name).file_digest()
+    return bytes(commands.DIGEST_SIZE) if digest is None else digest
+
+def completed_ranges(file_name: str) -> list[tuple[int, int]]:
+    journal = upload_journal(file_name)
+    if journal is not None:
+        return journal.completed()
+    file_size = file_size_of(file_name)
+    return [(0, file_size - 1)] if file_size else []
+
+# Content-addressed store for complete files, None keeps every file flat in SERVER_DATA_PATH.
+# Uploads in progress are always flat files and are moved into the store once complete.
+store: BlockStore | None = None
+# Metadata LIST is answered from, every handler that adds, changes or removes a file updates it
+index = FileIndex()
+
+# Files the chunk handlers read and write, shared between connections
+files = FileCache()
+
+metrics = Metrics()
+
+def file_exists(file_name: str) -> bool:
+    return os.path.isfile(path_to(file_name)) or (store is not None and store.has_file(file_name))
+
+# Names claimed by batch uploads whose data is still on its way
+batch_files: set[str] = set()
+
+def file_taken(file_name: str) -> bool:
+    return file_exists(file_name) or file_name in batch_files
+
+def tree_conflict(file_name: str) -> bool:
+    """Whether a file is where the name needs a directory, or the name is a directory of other
+    files. Flat files would trip over it on disk, files in the store would not."""
+    parents = itertools.accumulate(file_name.split('/')[:-1], lambda parent, part: f"{parent}/{part}")
+    return any(index.get(parent) is not None for parent in parents) or bool(index.page(file_name + '/', limit=1)[0])
+
+def remove_empty_directories(file_name: str):
+    # Directories of the tree go away with the last file in them
+    directory = os.path.dirname(file_name)
+    while directory:
+        try:
+            os.rmdir(path_to(directory))
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+def file_size_of(file_name: str) -> int:
+    if store is not None and store.has_file(file_name):
+        return store.file_size(file_name)
+    return os.path.getsize(path_to(file_name))
+
+def file_segments(file_name: str, start_byte: int, end_byte: int) -> list[tuple[str, int, int]]:
+    """(path, offset, count) pieces holding the inclusive byte range of a file, in order."""
+    if store is not None and store.has_file(file_name):
+        return store.segments(file_name, start_byte, end_byte)
+    return [(path_to(file_name), start_byte, end_byte - start_byte + 1)]
+
+def start_upload(file_name: str, file_size: int):
+    if tree_conflict(file_name):
+        raise ValueError(f"{file_name} conflicts with a file or directory on the server")
+    os.makedirs(os.path.dirname(path_to(file_name)), exist_ok=True)
+    files.invalidate(path_to(file_name))
+    fileio.allocate(path_to(file_name), file_size)
+    start_upload_journal(file_name, file_size)
+    block_digests(file_name).remove()
+    index.put(file_name, os.path.getctime(path_to(file_name)), file_size)
+
+# Uploads being moved into the store, several chunks can complete the same journal at once
+finishing: set[str] = set()
+
+def finish_upload(file_name: str, addr: str):
+    with journals_lock:
+        if file_name in finishing or not os.path.exists(journal_path_to(file_name)):
+            return
+        finishing.add(file_name)
+
+    try:
+        # The journal outlives the ingest, so blocks offered to this upload stay in use until
+        # the manifest holds references to them
+        if store is not None:
+            digests = block_digests(file_name)
+            known = digests.digests()
+            files.invalidate(path_to(file_name))
+            stored = store.ingest(file_name, path_to(file_name), known)
+            remove_empty_directories(file_name)
+            for i, digest in enumerate(stored):
+                if known[i] is None:
+                    start_byte = i * commands.DIGEST_BLOCK_SIZE
+                    digests.record(start_byte, min(start_byte + commands.DIGEST_BLOCK_SIZE, digests.size) - 1, digest)
+            index.put(file_name, store.file_ctime(file_name), store.file_size(file_name), commands.FILE_COMPLETED)
+        else:
+            index.put(file_name, *index.get(file_name), commands.FILE_COMPLETED)
+        sync_stored([file_name])
+        drop_upload_journal(file_name)
+    finally:
+        with journals_lock:
+            finishing.discard(file_name)
+    log.info("[UPLOAD COMPLETE]", extra=fields(addr, file_name))
+
+def sync_stored(file_names: list[str]):
+    """With SYNC, get the stored files on disk: flat files, or the blocks and manifest of
+    files in the store, and the directories naming them."""
+    if not SYNC or not file_names:
+        return
+    paths: dict[str, None] = {}
+    for file_name in file_names:
+        if store is not None and store.has_file(file_name):
+            file_size = store.file_size(file_name)
+            if file_size:
+                paths.update(dict.fromkeys(path for path, _, _ in store.segments(file_name, 0, file_size - 1)))
+            paths[store.manifest_path(file_name)] = None
+        else:
+            paths[path_to(file_name)] = None
+    with tracer.span('fsync', 'disk', files=len(file_names)):
+        fileio.sync_paths(paths)
+
+def hold_pending_blocks():
+    """Hold the blocks of the uploads an earlier run left in progress, as if their digests had
+    just been recorded, then collect the blocks nothing refers to or holds anymore."""
+    for name in os.listdir(SERVER_JOURNAL_PATH):
+        if not name.endswith('.json'):
+            continue
+        journal = RangeJournal.load(os.path.join(SERVER_JOURNAL_PATH, name))
+        if journal is None:
+            continue
+        file_name = fileio.unflat_name(name[:-len('.json')])
+        for digest in BlockDigests(digests_path_to(file_name), journal.size).digests():
+            if digest is not None:
+                store.hold(file_name, digest)
+    store.collect_garbage()
+
+def read_file_range(file_name: str, start_byte: int, count: int) -> bytes:
+    data = bytearray()
+    for path, offset, length in file_segments(file_name, start_byte, start_byte + count - 1):
+        with files.open(path) as file:
+            data += codec.read_at(file, offset, length)
+    return bytes(data)
+
+def copy_stored_range(file_name: str, start_byte: int, count: int, file, position: int, hasher: fileio.RangeHasher) -> int:
+    """Copy `count` bytes of a stored file into `file` at `position` and return how many there were."""
+    buffer = fileio.thread_buffer()
+    copied: int = 0
+    for path, offset, length in file_segments(file_name, start_byte, start_byte + count - 1):
+        with files.open(path) as source:
+            while length:
+                read = fileio.readinto_at(source, buffer[:min(len(buffer), length)], offset)
+                if not read:
+                    return copied
+                offset += read
+                hasher.update(buffer[:read])
+                fileio.write_at(file, buffer[:read], position + copied)
+                copied += read
+                length -= read
+    return copied
+
+# Bumped whenever a complete file is replaced or deleted, so digests hashed from an older
+# version while it was being downloaded are not recorded for the current one
+generations: dict[str, int] = {}
+replace_lock = threading.Lock()
+
+def bump_generation(file_name: str):
+    with replace_lock:
+        generations[file_name] = generations.get(file_name, 0) + 1
+
+def replace_file(file_name: str, temporary_path: str, digests: list[bytes], generation: int | None = None) -> bool:
+    """Swap in a rebuilt version of a complete file, readers that already opened the old one keep it.
+    Also puts new files that arrived whole in place, in the store when there is one. Given the
+    `generation` the file was rebuilt from, nothing is swapped in if the file was replaced or
+    deleted since. Tells whether the file was put in place."""
+    temporary_digests = temporary_path + '.digests'
+    with open(temporary_digests, 'wb') as file:
+        file.write(b''.join(digests))
+    with replace_lock:
+        if generation is not None and generations.get(file_name, 0) != generation:
+            return False
+        generations[file_name] = generations.get(file_name, 0) + 1
+        if store is not None and not os.path.isfile(path_to(file_name)):
+            replacing: bool = store.has_file(file_name)
+            store.ingest(file_name, temporary_path, digests)
+            if replacing:
+                # Blocks only the old version used are gone, let go of them so their space is freed
+                files.invalidate_under(SERVER_CAS_PATH)
+            index.put(file_name, store.file_ctime(file_name), store.file_size(file_name), commands.FILE_COMPLETED)
+        else:
+            os.makedirs(os.path.dirname(path_to(file_name)), exist_ok=True)
+            files.invalidate(path_to(file_name))
+            os.replace(temporary_path, path_to(file_name))
+            index.put(file_name, os.path.getctime(path_to(file_name)), os.path.getsize(path_to(file_name)), commands.FILE_COMPLETED)
+        os.replace(temporary_digests, digests_path_to(file_name))
+    return True
+
+def server_capabilities() -> dict[str, str]:
+    """Sent to v2 clients in the HELLO reply as key=value lines."""
+    return {
+        'max_streams': str(MAX_STREAMS),
+        'dedup': '1' if store is not None else '0',
+        'codecs': ','.join(codec.available()),
+        'small_file': str(SMALL_FILE_SIZE),
+        'stats': '1',
+        'trace': '1',
+    }
+
+
+def send_stored_range(conn: socket.socket, file_name: str, start_byte: int, end_byte: int, chunk_codec: int | None = None):
+    """Send an inclusive range of a stored file to a v2 client followed by the digest of every
+    piece of it. Blocks whose digest was recorded on upload go out with sendfile, the others are
+    hashed while they stream and their digests recorded for the next time."""
+    pieces = fileio.digest_pieces(start_byte, end_byte)
+    digests = block_digests(file_name)
+    known = [digest if digests.is_whole_block(*piece) else None
+             for piece, digest in zip(pieces, digests.digests(start_byte // commands.DIGEST_BLOCK_SIZE, len(pieces)))]
+
+    hasher = fileio.RangeHasher(start_byte) if None in known else None
+    generation = generations.get(file_name, 0)
+    for path, offset, count in file_segments(file_name, start_byte, end_byte):
+        with files.open(path) as file:
+            fileio.advise_sequential(file, offset, count)
+            if chunk_codec is not None:
+                codec.send_frames(conn, file, offset, count, chunk_codec, hasher=hasher)
+            else:
+                fileio.send_file_range(conn, file, offset, count, hasher=hasher)
+            fileio.release_range(file, offset, count)
+    if hasher is not None:
+        known = hasher.finish()
+        with replace_lock:
+            if upload_journal(file_name) is None and generations.get(file_name, 0) == generation:
+                for piece, digest in zip(pieces, known):
+                    digests.record(*piece, digest)
+    conn.sendall(b''.join(known))
+
+def reserve_batch_file(file_name: str) -> int:
+    if not fileio.valid_name(file_name) or tree_conflict(file_name):
+        return commands.BATCH_INVALID
+    with journals_lock:
+        if file_taken(file_name):
+            return commands.BATCH_EXISTS
+        batch_files.add(file_name)
+    return commands.BATCH_OK
+
+def recv_whole_file(conn: socket.socket, file_name: str, file_size: int, compressed: bool, addr: str, keep: bool = True) -> bool:
+    """Receive a file sent in one piece, its data then the digest of every piece of it, and put
+    it in place if the digests match and `keep` is set. The file is written next to its journal
+    first, so it never shows up half received."""
+    temporary_path = os.path.join(SERVER_JOURNAL_PATH, f"{fileio.flat_name(file_name)}.{threading.get_ident()}.batch")
+    try:
+        hasher = fileio.RangeHasher(0)
+        with open(temporary_path, 'wb') as file:
+            if compressed:
+                codec.recv_frames(conn, file, 0, file_size, hasher=hasher)
+            else:
+                fileio.recv_file_range(conn, file, 0, file_size, hasher=hasher)
+        digests = hasher.finish()
+        if recv_all(conn, len(digests) * commands.DIGEST_SIZE) != b''.join(digests) or not keep:
+            return False
+
+        try:
+            replace_file(file_name, temporary_path, digests)
+        except OSError as e:
+            # A file where the name needs a directory
+            log.warning("[BATCH FILE ERROR]", extra=fields(addr, file_name, error=e))
+            return False
+        return True
+
+    finally:
+        for leftover in (temporary_path, f"{temporary_path}.digests"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+# WATCH connections with their address, token and next heartbeat, all served by one notifier thread
+watchers: dict[socket.socket, tuple[str, int, float]] = {}
+watchers_lock = threading.Lock()
+notifier: threading.Thread | None = None
+
+def change_batch(token: int) -> tuple[bytes, int, bool]:
+    """The batch taking a watcher from `token` to the latest change, that token and whether the
+    batch has anything to tell. A batch is '!?QI': whether the client has to list everything
+    again, the token it brings the client to and the number of changes, each one '!BH' kind
+    and name length, the name and '!dQ' ctime and size."""
+    changes, token, reset = index.changes_since(token, 0)
+    batch = bytearray(struct.pack('!?QI', reset, token, len(changes)))
+    for kind, name, ctime, size in changes:
+        encoded_name = name.encode()
+        batch += struct.pack('!BH', kind, len(encoded_name)) + encoded_name + struct.pack('!dQ', ctime, size)
+    return bytes(batch), token, bool(changes) or reset
+
+def add_watcher(conn: socket.socket, addr: str, token: int):
+    """Send the first batch of a WATCH right away and leave the connection to the notifier."""
+    global notifier
+    batch, token, _ = change_batch(token)
+    conn.settimeout(WATCH_SEND_TIMEOUT)
+    conn.sendall(batch)
+    with watchers_lock:
+        watchers[conn] = (addr, token, time.monotonic() + WATCH_HEARTBEAT)
+        if notifier is None:
+            notifier = threading.Thread(target=notify_watchers, name="watch notifier", daemon=True)
+            notifier.start()
+    metrics.add('watchers_active')
+
+def drop_watcher(conn: socket.socket, addr: str, error: Exception):
+    with watchers_lock:
+        del watchers[conn]
+    metrics.add('watchers_active', -1)
+    log.info("[WATCH ENDED]", extra=fields(addr, error=error))
+    close_client(conn, addr)
+
+def notify_watchers():
+    """Push the changes of the index to every watcher from a single thread, however many there
+    are. Wakes up on every change, and when a heartbeat is due, an empty batch sent to watchers
+    that got nothing for WATCH_HEARTBEAT so either side notices a dead peer."""
+    token: int = 0
+    while True:
+        with watchers_lock:
+            # A watcher added while the last changes were being sent may still be behind them
+            oldest = min((watcher_token for _, watcher_token, _ in watchers.values()), default=token)
+            due = min((heartbeat for _, _, heartbeat in watchers.values()), default=time.monotonic() + WATCH_HEARTBEAT)
+            current = list(watchers.items())
+        token = index.wait(oldest, max(0.0, due - time.monotonic()))
+
+        now = time.monotonic()
+        for conn, (addr, watcher_token, heartbeat) in current:
+            batch, watcher_token, pending = change_batch(watcher_token)
+            if not pending and heartbeat > now:
+                continue
+            try:
+                conn.sendall(batch)
+            except OSError as e:
+                drop_watcher(conn, addr, e)
+                continue
+            with watchers_lock:
+                watchers[conn] = (addr, watcher_token, now + WATCH_HEARTBEAT)
+
+def serve_command(conn: socket.socket, addr: str) -> bool | None:
+    header = conn.recv(5)
+    if not header:
+        return False
+    # The header may arrive in pieces, the rest of it is waited for like any other data
+    if len(header) < 5:
+        header += recv_all(conn, 5 - len(header))
+    command, data_length = struct.unpack('!BI', header)
+    version: int = 1
+    compressed: bool = False
+    transfer: int | None = None
+    if command & commands.V2_FLAG:
+        # v2 framing: 64-bit sizes and offsets, and a request id to tag the logs with
+        compressed = bool(command & commands.COMPRESSED_FLAG)
+        traced: bool = bool(command & commands.TRACED_FLAG)
+        command &= ~(commands.V2_FLAG | commands.COMPRESSED_FLAG | commands.TRACED_FLAG)
+        version = 2
+        request_id: int = recv_int(conn)
+        addr = f"{addr}#{request_id}"
+        if traced:
+            transfer = recv_int(conn, version)
+    # print(f"[COMMAND] {command} with data length {data_length}")
+
+    start = time.perf_counter()
+    # Spans of this command are tagged with the transfer the client traces it under
+    token = tracing.transfer_id.set(transfer)
+    try:
+        with tracer.span(commands.NAMES.get(command, str(command)), 'command', addr=addr):
+            return run_command(conn, addr, command, data_length, version, compressed)
+    except Exception:
+        metrics.add('errors', label=command)
+        raise
+    finally:
+        tracing.transfer_id.reset(token)
+        metrics.observe('command_seconds', time.perf_counter() - start, command)
+
+def run_command(conn: socket.socket, addr: str, command: int, data_length: int, version: int, compressed: bool) -> bool | None:
+    match command:
+        case commands.HELLO:
+            # The client announces the highest version it speaks in the length field
+            agreed_version: int = max(1, min(data_length, commands.PROTOCOL_VERSION))
+            conn.sendall(struct.pack('!B', agreed_version))
+            if agreed_version >= 2:
+                data = '\n'.join(f"{key}={value}" for key, value in server_capabilities().items()).encode()
+                send_int(conn, len(data), agreed_version)
+                conn.sendall(data)
+            log.info("[HELLO]", extra=fields(addr, version=data_length))
+
+        case commands.PING:
+            # print(f"[PING] {addr}")
+            send_bool(conn, True)
+
+        case commands.STATS:
+            # The metrics in the Prometheus text format, the same page --metrics-port serves
+            data = metrics.render().encode()
+            send_int(conn, len(data), version)
+            conn.sendall(data)
+
+        case commands.LIST:
+            log.info("[LIST]", extra=fields(addr))
+            data = index.listing()
+            send_int(conn, len(data), version)
+            conn.sendall(data)
+
+        case commands.LIST_PAGE:
+            # Filter, sort order and cursor come after the pattern, entries go back length-prefixed:
+            # '!H' name length, name, '!dQ' ctime and size, then the '!H' length-prefixed next cursor
+            pattern: str = recv_all(conn, data_length).decode()
+            glob, sort_id, descending, limit = struct.unpack('!?B?I', recv_all(conn, 7))
+            sort: str = SORT_KEYS[sort_id] if sort_id < len(SORT_KEYS) else SORT_KEYS[0]
+            cursor = decode_cursor(sort, recv_all(conn, struct.unpack('!H', recv_all(conn, 2))[0]))
+            limit = min(limit, LIST_PAGE_LIMIT) if limit else LIST_PAGE_LIMIT
+
+            entries, next_cursor = index.page(pattern, glob, sort, descending, limit, cursor)
+            reply = bytearray(struct.pack('!I', len(entries)))
+            for name, ctime, size in entries:
+                encoded_name = name.encode()
+                reply += struct.pack('!H', len(encoded_name)) + encoded_name + struct.pack('!dQ', ctime, size)
+            encoded_cursor = b'' if next_cursor is None else encode_cursor(sort, next_cursor)
+            reply += struct.pack('!H', len(encoded_cursor)) + encoded_cursor
+            conn.sendall(reply)
+
+            log.info("[LIST PAGE]", extra=fields(addr, pattern=pattern, entries=len(entries)))
+
+        case commands.STAT:
+            file_name: str = recv_name(conn, data_length)
+            metadata = index.get(file_name)
+            if metadata is None:
+                send_bool(conn, False)
+            else:
+                conn.sendall(struct.pack('!??dQ', True, upload_journal(file_name) is None, *metadata))
+
+        case commands.WATCH:
+            # After the first batch the notifier thread pushes the changes for as long as the client
+            # watches, so watchers cost neither a thread of their own nor a worker of the selector engine
+            token: int = recv_int(conn, version)
+            add_watcher(conn, addr, token)
+            log.info("[WATCH]", extra=fields(addr, since=token))
+            return None
+
+        case commands.REQUEST_UPLOAD:
+            file_name: str = recv_name(conn, data_length)
+            if file_taken(file_name):
+                send_bool(conn, True)
+                if version >= 2:
+                    conn.sendall(file_digest(file_name))
+                return False
+            send_bool(conn, False)
+
+            file_size: int = recv_int(conn, version)
+            start_upload(file_name, file_size)
+            # No chunk will ever complete the journal of an empty file
+            if file_size == 0:
+                finish_upload(file_name, addr)
+
+            log.info("[REQUEST UPLOAD]", extra=fields(addr, file_name))
+
+        case commands.REQUEST_DOWNLOAD:
+            file_name: str = recv_name(conn, data_length)
+
+            reply_format = '!?' + commands.INT_CODES[version]
+            if not file_exists(file_name):
+                conn.sendall(struct.pack(reply_format, False, 0))
+                if version >= 2:
+                    conn.sendall(bytes(commands.DIGEST_SIZE))
+            else:
+                conn.sendall(struct.pack(reply_format, True, file_size_of(file_name)))
+                if version >= 2:
+                    conn.sendall(file_digest(file_name))
+
+            log.info("[REQUEST DOWNLOAD]", extra=fields(addr, file_name))
+
+        case commands.UPLOAD_CHUNK:
+            started: float = time.perf_counter()
+            try:
+                with tracer.span('parse'):
+                    file_name: str = recv_name(conn, data_length)
+                    path: str = path_to(file_name)
+                    start_byte: int = recv_int(conn, version)
+                    end_byte: int = recv_int(conn, version)
+
+                hasher = fileio.RangeHasher(start_byte) if version >= 2 else None
+                with files.open(path, 'r+b') as file:
+                    if compressed:
+                        codec.recv_frames(conn, file, start_byte, end_byte - start_byte + 1, hasher=hasher)
+                    else:
+                        fileio.recv_file_range(conn, file, start_byte, end_byte - start_byte + 1, hasher=hasher)
+                    fileio.release_range(file, start_byte, end_byte - start_byte + 1)
+
+                # v2 clients follow the data with the digest of every piece of it,
+                # only the pieces that match are counted as stored
+                pieces = fileio.digest_pieces(start_byte, end_byte)
+                verified: list[tuple[int, int]] = []
+                if hasher is None:
+                    verified = [(start_byte, end_byte)]
+                else:
+                    expected: bytes = recv_all(conn, len(pieces) * commands.DIGEST_SIZE)
+                    digests = block_digests(file_name)
+                    with tracer.span('verify'):
+                        for i, (piece, digest) in enumerate(zip(pieces, hasher.finish())):
+                            if digest == expected[i * commands.DIGEST_SIZE:(i + 1) * commands.DIGEST_SIZE]:
+                                digests.record(*piece, digest)
+                                if store is not None and digests.is_whole_block(*piece):
+                                    store.hold(file_name, digest)
+                                verified = merge_range(verified, *piece)
+
+                journal = upload_journal(file_name)
+                if journal is not None:
+                    for verified_range in verified:
+                        journal.add(*verified_range)
+                    if journal.is_complete():
+                        finish_upload(file_name, addr)
+
+                # v2 clients wait for the chunk to be on disk and verified before counting it as done
+                if version >= 2:
+                    send_bool(conn, verified == [(start_byte, end_byte)])
+
+                chunk_log.info("[UPLOAD CHUNK]", extra=fields(addr, file_name, (start_byte, end_byte), time.perf_counter() - started))
+
+            except Exception as e:
+                # The rest of the chunk may still be in flight, so the stream cannot be trusted anymore
+                log.warning("[CHUNK UPLOAD ERROR]", extra=fields(addr, error=e))
+                metrics.add('errors', label=command)
+                return False
+
+        case commands.DOWNLOAD_CHUNK:
+            started: float = time.perf_counter()
+            try:
+                with tracer.span('parse'):
+                    file_name: str = recv_name(conn, data_length)
+                    start_byte: int = recv_int(conn, version)
+                    end_byte: int = recv_int(conn, version)
+                    # Compressed requests name the codec the client wants the frames in
+                    chunk_codec: int | None = recv_all(conn, 1)[0] if compressed else None
+
+                if version < 2:
+                    for path, offset, count in file_segments(file_name, start_byte, end_byte):
+                        with files.open(path) as file:
+                            fileio.advise_sequential(file, offset, count)
+                            fileio.send_file_range(conn, file, offset, count)
+                            fileio.release_range(file, offset, count)
+                else:
+                    # v2 clients get the digest of every piece after the data
+                    send_stored_range(conn, file_name, start_byte, end_byte, chunk_codec)
+
+                chunk_log.info("[DOWNLOAD CHUNK]", extra=fields(addr, file_name, (start_byte, end_byte), time.perf_counter() - started))
+
+            except Exception as e:
+                # The client is waiting for bytes that will never come, hang up instead
+                log.warning("[CHUNK DOWNLOAD ERROR]", extra=fields(addr, error=e))
+                metrics.add('errors', label=command)
+                return False
+
+        case commands.QUERY_RANGES:
+            file_name: str = recv_name(conn, data_length)
+
+            if not file_exists(file_name):
+                send_bool(conn, False)
+                send_int(conn, 0, version)
+                send_int(conn, 0, version)
+            else:
+                ranges = completed_ranges(file_name)
+                send_bool(conn, True)
+                int_code = commands.INT_CODES[version]
+                conn.sendall(struct.pack(f'!{2 + 2 * len(ranges)}{int_code}', file_size_of(file_name), len(ranges),
+                                         *(i for byte_range in ranges for i in byte_range)))
+
+            log.info("[QUERY RANGES]", extra=fields(addr, file_name))
+
+        case commands.OFFER_BLOCKS:
+            # Upload request from a v2 client that lists the digest of every block first, blocks the
+            # store already has are taken from it and the client is told to send only the others
+            file_name: str = recv_name(conn, data_length)
+            file_size: int = recv_int(conn, version)
+            offered: bytes = recv_all(conn, BlockDigests('', file_size).block_count() * commands.DIGEST_SIZE)
+            if file_taken(file_name):
+                send_bool(conn, True)
+                conn.sendall(file_digest(file_name))
+                return True
+            send_bool(conn, False)
+
+            start_upload(file_name, file_size)
+            digests = block_digests(file_name)
+            present = bytearray(digests.block_count())
+            stored: list[tuple[int, int]] = []
+            if store is not None:
+                # Holding the block under the store lock keeps it from being collected by a
+                # concurrent DELETE before this upload completes
+                with store.lock:
+                    for i in range(len(present)):
+                        digest = offered[i * commands.DIGEST_SIZE:(i + 1) * commands.DIGEST_SIZE]
+                        if store.has_block(digest):
+                            start_byte = i * commands.DIGEST_BLOCK_SIZE
+                            end_byte = min(start_byte + commands.DIGEST_BLOCK_SIZE, file_size) - 1
+                            store.hold(file_name, digest)
+                            digests.record(start_byte, end_byte, digest)
+                            stored = merge_range(stored, start_byte, end_byte)
+                            present[i] = 1
+
+            journal = upload_journal(file_name)
+            for stored_range in stored:
+                journal.add(*stored_range)
+            conn.sendall(bytes(present))
+            if journal.is_complete():
+                finish_upload(file_name, addr)
+
+            log.info("[OFFER BLOCKS]", extra=fields(addr, file_name, stored=f"{sum(present)}/{len(present)}"))
+
+        case commands.SIGNATURES:
+            # Rolling and strong checksum of every block of a complete file, for delta updates
+            file_name: str = recv_name(conn, data_length)
+            block_size: int = recv_int(conn, version)
+            if not file_exists(file_name) or upload_journal(file_name) is not None or not 0 < block_size <= commands.DIGEST_BLOCK_SIZE:
+                send_bool(conn, False)
+                return True
+
+            file_size: int = file_size_of(file_name)
+            signatures = bytearray()
+            for start_byte in range(0, file_size, block_size):
+                data = read_file_range(file_name, start_byte, min(block_size, file_size - start_byte))
+                signatures += struct.pack('!I', delta.weak_checksum(data)) + delta.strong_checksum(data)
+            send_bool(conn, True)
+            send_int(conn, file_size, version)
+            conn.sendall(file_digest(file_name))
+            send_int(conn, len(signatures) // (4 + commands.DIGEST_SIZE), version)
+            conn.sendall(signatures)
+
+            log.info("[SIGNATURES]", extra=fields(addr, file_name, block_size=block_size))
+
+        case commands.APPLY_DELTA:
+            # The new version is rebuilt next to the old one from COPY and LITERAL instructions
+            # and swapped in only if it hashes to the digest the client sends after them
+            temporary_path: str | None = None
+            try:
+                file_name: str = recv_name(conn, data_length)
+                file_size: int = recv_int(conn, version)
+                base_digest: bytes = recv_all(conn, commands.DIGEST_SIZE)
+                instruction_count: int = recv_int(conn, version)
+                # Taken before the digest is checked, a change made after the check moves it on
+                generation: int = generations.get(file_name, 0)
+                base_current: bool = file_exists(file_name) and upload_journal(file_name) is None and file_digest(file_name) == base_digest
+
+                temporary_path = os.path.join(SERVER_JOURNAL_PATH, f"{fileio.flat_name(file_name)}.{threading.get_ident()}.delta")
+                hasher = fileio.RangeHasher(0)
+                position: int = 0
+                with open(temporary_path, 'wb') as file:
+                    for _ in range(instruction_count):
+                        kind: int = recv_all(conn, 1)[0]
+                        if kind == delta.COPY:
+                            start_byte: int = recv_int(conn, version)
+                            length: int = recv_int(conn, version)
+                            if base_current and length:
+                                position += copy_stored_range(file_name, start_byte, length, file, position, hasher)
+                        else:
+                            length: int = recv_int(conn, version)
+                            fileio.recv_file_range(conn, file, position, length, hasher=hasher)
+                            position += length
+
+                expected: bytes = recv_all(conn, commands.DIGEST_SIZE)
+                digests = hasher.finish()
+                file_hash = fileio.new_hash()
+                for digest in digests:
+                    file_hash.update(digest)
+                # The file may also have been replaced or deleted while it was being rebuilt
+                applied: bool = (base_current and position == file_size and file_hash.digest() == expected
+                                 and replace_file(file_name, temporary_path, digests, generation))
+                if applied:
+                    sync_stored([file_name])
+                send_bool(conn, applied)
+
+                log.info("[APPLY DELTA]", extra=fields(addr, file_name, applied=applied))
+
+            except Exception as e:
+                log.warning("[APPLY DELTA ERROR]", extra=fields(addr, error=e))
+                metrics.add('errors', label=command)
+                return False
+
+            finally:
+                for leftover in (temporary_path, f"{temporary_path}.digests"):
+                    if temporary_path is not None and os.path.exists(leftover):
+                        os.remove(leftover)
+
+        case commands.UPLOAD_BATCH:
+            # Many files in two round trips: data_length entries of '!H' name length, name and size,
+            # answered with a BATCH_* status byte each, then the data of the accepted files back
+            # to back, each followed by the digest of its pieces, answered with whether each was stored
+            if version < 2 or data_length > BATCH_LIMIT:
+                return False
+            entries: list[tuple[str, int]] = []
+            for _ in range(data_length):
+                name_length: int = struct.unpack('!H', recv_all(conn, 2))[0]
+                entries.append((recv_all(conn, name_length).decode(), recv_int(conn, version)))
+
+            statuses = bytes(reserve_batch_file(file_name) for file_name, _ in entries)
+            accepted = [entry for entry, status in zip(entries, statuses) if status == commands.BATCH_OK]
+            try:
+                conn.sendall(statuses)
+                stored = bytes(recv_whole_file(conn, file_name, file_size, compressed, addr) for file_name, file_size in accepted)
+                sync_stored([file_name for (file_name, _), kept in zip(accepted, stored) if kept])
+                conn.sendall(stored)
+            finally:
+                with journals_lock:
+                    batch_files.difference_update(file_name for file_name, _ in accepted)
+
+            log.info("[UPLOAD BATCH]", extra=fields(addr, stored=f"{sum(stored)}/{len(entries)}"))
+
+        case commands.UPLOAD_SMALL:
+            # A file of at most SMALL_FILE_SIZE bytes in one round trip: the '!Q' size, the data and
+            # the digest of its pieces follow the name, answered with a BATCH_* status and, once
+            # stored, '!dQ' ctime and size and the file digest. Single small downloads use DOWNLOAD_BATCH.
+            if version < 2:
+                return False
+            file_name: str = recv_all(conn, data_length).decode()
+            file_size: int = recv_int(conn, version)
+            if file_size > SMALL_FILE_SIZE:
+                return False
+
+            status: int = reserve_batch_file(file_name)
+            try:
+                # The data is on its way whatever the answer, a file that cannot be stored is read and dropped
+                if not recv_whole_file(conn, file_name, file_size, compressed, addr, status == commands.BATCH_OK) and status == commands.BATCH_OK:
+                    status = commands.BATCH_CORRUPT
+            finally:
+                if status != commands.BATCH_EXISTS:
+                    with journals_lock:
+                        batch_files.discard(file_name)
+
+            reply = struct.pack('!B', status)
+            if status == commands.BATCH_OK:
+                sync_stored([file_name])
+                reply += struct.pack('!dQ', *index.get(file_name)) + file_digest(file_name)
+            conn.sendall(reply)
+
+            log.info("[UPLOAD SMALL]", extra=fields(addr, file_name, size=file_size, status=status))
+
+        case commands.DOWNLOAD_BATCH:
+            # data_length '!H' length-prefixed names, the '!Q' size above which files are left to
+            # download_file and the codec byte when compressed. Every file is answered in order with
+            # '!BQ' BATCH_* status and size, and when sent its data and the digest of its pieces.
+            if version < 2 or data_length > BATCH_LIMIT:
+                return False
+            names: list[str] = [recv_all(conn, struct.unpack('!H', recv_all(conn, 2))[0]).decode() for _ in range(data_length)]
+            size_limit: int = recv_int(conn, version)
+            batch_codec: int | None = recv_all(conn, 1)[0] if compressed else None
+
+            sent: int = 0
+            for file_name in names:
+                if not fileio.valid_name(file_name):
+                    conn.sendall(struct.pack('!BQ', commands.BATCH_INVALID, 0))
+                elif not file_exists(file_name) or upload_journal(file_name) is not None:
+                    conn.sendall(struct.pack('!BQ', commands.BATCH_MISSING, 0))
+                elif file_size_of(file_name) > size_limit:
+                    conn.sendall(struct.pack('!BQ', commands.BATCH_TOO_LARGE, file_size_of(file_name)))
+                else:
+                    file_size: int = file_size_of(file_name)
+                    conn.sendall(struct.pack('!BQ', commands.BATCH_OK, file_size))
+                    if file_size:
+                        send_stored_range(conn, file_name, 0, file_size - 1, batch_codec)
+                    sent += 1
+
+            log.info("[DOWNLOAD BATCH]", extra=fields(addr, sent=f"{sent}/{len(names)}"))
+
+        case commands.DELETE:
+            file_name = recv_name(conn, data_length)
+            path = path_to(file_name)
+            bump_generation(file_name)
+
+            if os.path.isfile(path):
+                files.invalidate(path)
+                os.remove(path)
+                remove_empty_directories(file_name)
+                drop_upload_journal(file_name)
+                BlockDigests(digests_path_to(file_name), 0).remove()
+                index.remove(file_name)
+                send_bool(conn, True)
+            elif store is not None and store.has_file(file_name):
+                store.delete_file(file_name)
+                files.invalidate_under(SERVER_CAS_PATH)
+                BlockDigests(digests_path_to(file_name), 0).remove()
+                index.remove(file_name)
+                send_bool(conn, True)
+            else:
+                send_bool(conn, False)
+
+            log.info("[DELETE]", extra=fields(addr, file_name))
+
+    return True
+
+def handle_client(conn: socket.socket, addr: str):
+    log.info("[NEW CONNECTION]", extra=fields(addr))
+
+    # serve_command returns None once another thread has taken over the connection
+    keep_alive: bool | None = False
+    try:
+        while keep_alive := serve_command(conn, addr):
+            pass
+
+    except Exception as e:
+        log.error("[ERROR]", extra=fields(addr, error=e))
+        keep_alive = False
+
+    finally:
+        if keep_alive is not None:
+            close_client(conn, addr)
+
+def accept_client(server: socket.socket) -> tuple[socket.socket, str]:
+    conn, addr = server.accept()
+    conn = MeteredSocket(conn, metrics)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    metrics.add('connections')
+    metrics.add('connections_active')
+    return conn, f"{addr[0]}:{addr[1]}"
+
+def close_client(conn: socket.socket, addr: str):
+    conn.close()
+    metrics.add('connections_active', -1)
+    log.info("[DISCONNECTED]", extra=fields(addr))
+
+def raise_file_limit():
+    # Each idle connection costs one descriptor, so lift the soft limit to the hard one
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def open_server_socket() -> socket.socket:
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(ADDRESS)
+    server.listen(BACKLOG)
+    log.info(f"[LISTENING] Server is listening on {HOST}:{PORT}.")
+    log.info(f"Clients can connect to this server locally at {socket.gethostbyname(socket.gethostname())}")
+    return server
+
+def start_server():
+    log.info("[STARTING] Server is starting")
+    server = open_server_socket()
+
+    while True:
+        conn, addr = accept_client(server)
+        thread = threading.Thread(target=handle_client, args=(conn, addr))
+        thread.start()
+        log.info("[ACTIVE CONNECTIONS]", extra=fields(count=metrics.value('connections_active')))
+
+def start_selector_server(workers: int = WORKERS):
+    """Event-driven engine: idle connections wait in the selector (epoll/kqueue)
+    and cost no thread, each received command is handed to a bounded pool of
+    workers running serve_command, so all blocking socket and file I/O stays
+    off the event loop. The connection goes back to the selector once the
+    command has been served. A client that goes silent in the middle of a
+    command holds its worker for up to `--client-timeout` seconds per wait."""
+    log.info(f"[STARTING] Server is starting with {workers} workers")
+    raise_file_limit()
+    server = open_server_socket()
+    server.setblocking(False)
+
+    selector = selectors.DefaultSelector()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    served: queue.SimpleQueue[tuple[socket.socket, str]] = queue.SimpleQueue()
+    wakeup_reader, wakeup_writer = socket.socketpair()
+    wakeup_reader.setblocking(False)
+    wakeup_writer.setblocking(False)
+
+    selector.register(server, selectors.EVENT_READ)
+    selector.register(wakeup_reader, selectors.EVENT_READ)
+
+    def serve(conn: socket.socket, addr: str):
+        metrics.add('commands_queued', -1)
+        try:
+            keep_alive = serve_command(conn, addr)
+        except Exception as e:
+            log.error("[ERROR]", extra=fields(addr, error=e))
+            keep_alive = False
+
+        if keep_alive is None:
+            return
+        if not keep_alive:
+            close_client(conn, addr)
+            return
+
+        served.put((conn, addr))
+        try:
+            wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    connections: int = 0
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj is server:
+                while True:
+                    try:
+                        conn, addr = accept_client(server)
+                    except BlockingIOError:
+                        break
+                    conn.settimeout(CLIENT_TIMEOUT)
+                    selector.register(conn, selectors.EVENT_READ, addr)
+                    log.info("[NEW CONNECTION]", extra=fields(addr))
+
+            elif key.fileobj is wakeup_reader:
+                try:
+                    while wakeup_reader.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                while not served.empty():
+                    conn, addr = served.get()
+                    selector.register(conn, selectors.EVENT_READ, addr)
+
+            else:
+                selector.unregister(key.fileobj)
+                metrics.add('commands_queued')
+                executor.submit(serve, key.fileobj, key.data)
+
+        active = len(selector.get_map()) - 2
+        if active != connections:
+            connections = active
+            log.info("[ACTIVE CONNECTIONS]", extra=fields(count=connections))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multithreaded file transfer server")
+    parser.add_argument('--host', default=HOST, help="address to listen on")
+    parser.add_argument('--port', type=int, default=PORT, help="port to listen on")
+    parser.add_argument('--engine', choices=('thread', 'selector'), default='thread',
+                        help="thread: one thread per connection, selector: event loop with a bounded worker pool")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="size of the worker pool used by the selector engine")
+    parser.add_argument('--client-timeout', type=float, default=CLIENT_TIMEOUT,
+                        help="seconds a selector engine worker waits on a client that stalls in the middle of a command, 0 waits forever")
+    parser.add_argument('--max-streams', type=int, default=MAX_STREAMS,
+                        help="most parallel streams a client may use for one transfer")
+    parser.add_argument('--small-file-size', type=int, default=SMALL_FILE_SIZE,
+                        help="largest file sent whole in a single round trip, 0 turns the fast path off")
+    parser.add_argument('--storage', choices=('flat', 'cas'), default='flat',
+                        help="flat: one file per upload, cas: content-addressed blocks shared between files")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="also serve the STATS metrics over HTTP at http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--log-level', choices=logs.LEVELS, default='INFO',
+                        help="least severe events written to stdout")
+    parser.add_argument('--log-chunk-sample', type=int, default=1, metavar='N',
+                        help="log one in N chunk events of each kind, 1 logs every chunk")
+    parser.add_argument('--file-cache-size', type=int, default=files.size,
+                        help="unused files kept open for the next chunk, 0 opens a file per chunk")
+    parser.add_argument('--fsync', action='store_true',
+                        help="fsync every stored file before acknowledging it, slower but crash safe")
+    parser.add_argument('--trace', metavar='FILE', default=None,
+                        help="record spans of every command and write them to FILE as Chrome trace events at exit and on SIGUSR1")
+    args = parser.parse_args()
+    logs.configure(args.log_level, max(1, args.log_chunk_sample))
+    if args.trace is not None:
+        tracer.enable('filetransfer server')
+        atexit.register(tracer.export, args.trace)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: tracer.export(args.trace))
+    HOST, PORT = args.host, args.port
+    ADDRESS = (HOST, PORT)
+    MAX_STREAMS = max(1, args.max_streams)
+    SMALL_FILE_SIZE = max(0, args.small_file_size)
+    CLIENT_TIMEOUT = args.client_timeout if args.client_timeout > 0 else None
+    files.size = max(0, args.file_cache_size)
+    SYNC = args.fsync
+
+    for directory in (SERVER_DATA_PATH, SERVER_JOURNAL_PATH):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    if args.storage == 'cas':
+        store = BlockStore(SERVER_CAS_PATH)
+        hold_pending_blocks()
+    index.reconcile(SERVER_DATA_PATH, store)
+    if args.metrics_port is not None:
+        serve_http(metrics, ('127.0.0.1', args.metrics_port))
+        log.info(f"[METRICS] Serving metrics at http://127.0.0.1:{args.metrics_port}/metrics")
+
+    if args.engine == 'selector':
+        start_selector_server(args.workers)
+    else:
+        start_server()
\ No newline at end of file
@@ -0,0 +1,155 @@
+import os
+import json
+import threading
+
+import commands
+import fileio
+
+
+
+def merge_range(ranges: list[tuple[int, int]], start_byte: int, end_byte: int) -> list[tuple[int, int]]:
+    """Add the inclusive range [start_byte, end_byte] to sorted, disjoint ranges, merging neighbours."""
+    merged: list[tuple[int, int]] = []
+    for start, end in ranges:
+        if end + 1 < start_byte or start > end_byte + 1:
+            merged.append((start, end))
+        else:
+            start_byte, end_byte = min(start, start_byte), max(end, end_byte)
+    merged.append((start_byte, end_byte))
+    merged.sort()
+    return merged
+
+def missing_ranges(completed: list[tuple[int, int]], size: int) -> list[tuple[int, int]]:
+    """Inclusive ranges of a `size` byte file that are not covered by the sorted `completed` ranges."""
+    missing: list[tuple[int, int]] = []
+    position: int = 0
+    for start, end in completed:
+        if start > position:
+            missing.append((position, start - 1))
+        position = max(position, end + 1)
+    if position < size:
+        missing.append((position, size - 1))
+    return missing
+
+
+
+class RangeJournal:
+    """Persistent record of which byte ranges of a file have been transferred.
+
+    The journal is rewritten atomically after every completed range, so a
+    transfer interrupted at any point can be resumed by moving only
+    `missing()`.
+    """
+    path: str
+    size: int
+
+    def __init__(self, path: str, size: int, completed: list[tuple[int, int]] | None = None) -> None:
+        self.path = path
+        self.size = size
+        self._completed = [] if completed is None else completed
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> 'RangeJournal | None':
+        try:
+            with open(path, 'r') as file:
+                data = json.load(file)
+            return cls(path, data['size'], [(start, end) for start, end in data['completed']])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump({'size': self.size, 'completed': self._completed}, file)
+        os.replace(temporary_path, self.path)
+
+    def add(self, start_byte: int, end_byte: int):
+        with self._lock:
+            self._completed = merge_range(self._completed, start_byte, end_byte)
+            self._save()
+
+    def completed(self) -> list[tuple[int, int]]:
+        with self._lock:
+            return list(self._completed)
+
+    def missing(self) -> list[tuple[int, int]]:
+        return missing_ranges(self.completed(), self.size)
+
+    def is_complete(self) -> bool:
+        return not self.missing()
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+
+class BlockDigests:
+    """Digests of the DIGEST_BLOCK_SIZE blocks of a file of `size` bytes.
+
+    They are kept as fixed-size records in a side file, so recording the
+    digest of a block is one positional write however large the file is.
+    A record of zeros means the digest of that block is not known.
+    """
+    path: str
+    size: int
+
+    def __init__(self, path: str, size: int) -> None:
+        self.path = path
+        self.size = size
+
+    def block_count(self) -> int:
+        return -(-self.size // commands.DIGEST_BLOCK_SIZE)
+
+    def is_whole_block(self, start_byte: int, end_byte: int) -> bool:
+        index = start_byte // commands.DIGEST_BLOCK_SIZE
+        return start_byte % commands.DIGEST_BLOCK_SIZE == 0 and end_byte == min((index + 1) * commands.DIGEST_BLOCK_SIZE, self.size) - 1
+
+    def record(self, start_byte: int, end_byte: int, digest: bytes):
+        """Store the digest of the piece [start_byte, end_byte] if that piece is a whole block."""
+        if not self.is_whole_block(start_byte, end_byte):
+            return
+        index = start_byte // commands.DIGEST_BLOCK_SIZE
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        with os.fdopen(fd, 'r+b') as file:
+            fileio.write_at(file, memoryview(digest), index * commands.DIGEST_SIZE)
+
+    def digests(self, first: int = 0, count: int | None = None) -> list[bytes | None]:
+        """Digests of `count` blocks starting with block `first`, all remaining blocks by default."""
+        if count is None:
+            count = self.block_count() - first
+        try:
+            with open(self.path, 'rb') as file:
+                file.seek(first * commands.DIGEST_SIZE)
+                data = file.read(count * commands.DIGEST_SIZE)
+        except FileNotFoundError:
+            data = b''
+
+        empty = bytes(commands.DIGEST_SIZE)
+        records: list[bytes | None] = []
+        for i in range(count):
+            digest = data[i * commands.DIGEST_SIZE:(i + 1) * commands.DIGEST_SIZE]
+            records.append(digest if len(digest) == commands.DIGEST_SIZE and digest != empty else None)
+        return records
+
+    def file_digest(self) -> bytes | None:
+        """Digest of the whole file, None unless the digest of every block is known."""
+        file_hash = fileio.new_hash()
+        for digest in self.digests():
+            if digest is None:
+                return None
+            file_hash.update(digest)
+        return file_hash.digest()
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
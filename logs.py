@@ -0,0 +1,81 @@
+import sys
+import queue
+import atexit
+import logging
+import itertools
+import logging.handlers
+
+# Chunk events go to these loggers, which `configure` samples
+CHUNK_LOGGERS = ('filetransfer.server.chunks', 'filetransfer.client.chunks')
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+
+
+def fields(addr: str | None = None, file: str | None = None, range: tuple[int, int] | None = None,
+           duration: float | None = None, **others) -> dict:
+    """`extra` for a log call, the structured fields of the event. Fields left as None are
+    not written, the duration is in seconds."""
+    values = {'addr': addr, 'file': file, 'range': range, 'duration': duration, **others}
+    return {'fields': {name: value for name, value in values.items() if value is not None}}
+
+def format_field(name: str, value: object) -> str:
+    if name == 'range':
+        return f"{value[0]}-{value[1]}"
+    if name == 'duration':
+        return f"{value * 1000:.3f}ms"
+    text = str(value)
+    return repr(text) if not text or ' ' in text or '=' in text else text
+
+
+
+class FieldFormatter(logging.Formatter):
+    """Writes the structured fields of a record after its message as name=value pairs."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        values: dict = getattr(record, 'fields', {})
+        if not values:
+            return message
+        return message + ' ' + ' '.join(f"{name}={format_field(name, value)}" for name, value in values.items())
+
+
+
+class SampleFilter(logging.Filter):
+    """Lets the first of every `every` records of each message through. Counting per message
+    keeps a frequent event from starving a rare one on the same logger."""
+
+    def __init__(self, every: int) -> None:
+        super().__init__()
+        self.every = every
+        self._counts: dict[str, itertools.count] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        count = self._counts.get(record.msg)
+        if count is None:
+            count = self._counts.setdefault(record.msg, itertools.count())
+        # next() on a count is atomic under the GIL, so threads never hand out the same number
+        return next(count) % self.every == 0
+
+
+
+def configure(level: str = 'INFO', chunk_sample: int = 1, stream = None) -> logging.handlers.QueueListener:
+    """Send the 'filetransfer' loggers through a queue to a background thread writing to
+    `stream` (stdout by default), so logging never waits on a slow terminal or pipe.
+    Only one in `chunk_sample` chunk events of each kind is kept, 1 keeps them all."""
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+    handler.setFormatter(FieldFormatter(FORMAT))
+    listener = logging.handlers.QueueListener(records, handler)
+
+    root = logging.getLogger('filetransfer')
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+    root.propagate = False
+    for name in CHUNK_LOGGERS:
+        logging.getLogger(name).filters = [SampleFilter(chunk_sample)] if chunk_sample > 1 else []
+
+    listener.start()
+    # Write out what is still queued when the program exits
+    atexit.register(listener.stop)
+    return listener
@@ -12,6 +12,8 @@ import os
 from humanize import naturalsize
 
 import filetransferclient
+import commands
+import logs
 
 
 class App(ctk.CTk):
@@ -51,6 +53,7 @@ class App(ctk.CTk):
         self.server_active: bool = False
         self.server_ip: str = ftc.get_local_host()
         self.chunks: int = 4
+        self.auto_chunks: bool = True
 
         self.status_label = ctk.CTkLabel(
             master=self,
@@ -134,6 +137,12 @@ class App(ctk.CTk):
 
     #     widget.place(x=x, y=y)
     
+    def transfer_streams(self) -> int:
+        return filetransferclient.AUTO if self.auto_chunks else self.chunks
+
+    def progress_bar_count(self) -> int:
+        return ftc.max_streams() if self.auto_chunks else self.chunks
+    
     def show_notification(self, text: str):
         notification = SlideInNotification(self, text=text)
         self.after(5000, notification.destroy)
@@ -146,6 +155,7 @@ class App(ctk.CTk):
     def close(self):
         self.pinging = False
         self.ping_thread.join()
+        ftc.close()
         self.destroy()
 
 
@@ -348,12 +358,21 @@ class UploadFrame(ctk.CTkFrame):
 
         else:
             if self.file_exists():
-                app.show_notification("The selected file has already existed on the server.")
+                if messagebox.askyesno("File exists", "The selected file has already existed on the server. Update it with the local version?"):
+                    try:
+                        progress_window = ProgressWindow(master=self, title="Updating...", main_label_text=app.truncate_text(text=self.file_path, max_length=30), bar_count=1, goal=path.getsize(self.file_path))
+                        if ftc.update_file(self.file_path, progress_window.track_progress):
+                            self.file_path = ""
+                        else:
+                            app.show_notification("Failed to update file.")
+
+                    except Exception as e:
+                        app.show_notification(f"Failed to update file: {e}")
 
             else:
                 try:
-                    progress_window = ProgressWindow(master=self, title="Uploading...", main_label_text=app.truncate_text(text=self.file_path, max_length=30), bar_count=app.chunks, goal=path.getsize(self.file_path))
-                    ftc.upload_file(self.file_path, app.chunks, progress_window.track_progress)
+                    progress_window = ProgressWindow(master=self, title="Uploading...", main_label_text=app.truncate_text(text=self.file_path, max_length=30), bar_count=app.progress_bar_count(), goal=path.getsize(self.file_path))
+                    ftc.upload_file(self.file_path, app.transfer_streams(), progress_window.track_progress)
                     # ftc.upload_file(self.file_path, app.chunks)
                     # app.show_notification("File uploaded successfully!")
                     self.file_path = ""
@@ -363,11 +382,7 @@ class UploadFrame(ctk.CTkFrame):
 
     def file_exists(self):
         try:
-            existing_files = ftc.list_files()
-            if existing_files is None:
-                return False
-            file_name = path.basename(self.file_path)
-            return any(file_name == name for name, _, _ in existing_files)
+            return ftc.stat(path.basename(self.file_path)) is not None
         except Exception as e:
             print(e)
     
@@ -461,6 +476,10 @@ class UploadedFilesFrame(ctk.CTkFrame):
             self.files = []
             self.refresh()
 
+            watch_thread = threading.Thread(target=self.watch)
+            watch_thread.daemon = True
+            watch_thread.start()
+
             if len(self.files) == 0:
                 self.file_list.pack_forget()
                 self.label.pack(fill="both", expand=True)
@@ -495,8 +514,8 @@ class UploadedFilesFrame(ctk.CTkFrame):
 
                 if destination:
                     try:
-                        progress_window = ProgressWindow(master=self, title="Downloading...", main_label_text=app.truncate_text(text=selected_file, max_length=30), bar_count=app.chunks, goal=int(self.files[selection][2]))
-                        ftc.download_file(selected_file, destination, app.chunks, progress_window.track_progress)
+                        progress_window = ProgressWindow(master=self, title="Downloading...", main_label_text=app.truncate_text(text=selected_file, max_length=30), bar_count=app.progress_bar_count(), goal=int(self.files[selection][2]))
+                        ftc.download_file(selected_file, destination, app.transfer_streams(), progress_window.track_progress)
                         app.show_notification("File downloaded successfully!")
                     except Exception as e:
                         app.show_notification(f"Failed to download file: {str(e)}")
@@ -523,6 +542,10 @@ class UploadedFilesFrame(ctk.CTkFrame):
                 except Exception as e:
                     app.show_notification(f"Failed to delete file: {str(e)}")
 
+    def entry_text(self, name, creation_time, size):
+        size = naturalsize(size)
+        return f"{name:<64}\n\t{creation_time:<64}\n\t{size:<64}"
+
     def refresh(self):
         try:
             self.files = ftc.list_files()
@@ -534,13 +557,61 @@ class UploadedFilesFrame(ctk.CTkFrame):
                 self.files = []
 
             for name, creation_time, size in self.files:
-                size = naturalsize(size)
-                self.file_list.insert('end', f"{name:<64}\n\t{creation_time:<64}\n\t{size:<64}")
+                self.file_list.insert('end', self.entry_text(name, creation_time, size))
         
         except Exception as e:
             self.files = []
             print(e)
 
+    def watch(self):
+        # Follows the server's changes for as long as the app runs, a lost connection is
+        # picked up again from the last token. Anything else stops watching, the list is then
+        # only brought up to date by refresh
+        token = 0
+        while True:
+            try:
+                # Watching from 0 starts after the list was fetched, so list again with the first
+                # batch in case something changed in between
+                relist = token == 0
+                for token, reset, changes in ftc.watch(token):
+                    self.after(0, self.apply_changes, reset or relist, changes)
+                    relist = False
+            except filetransferclient.UnsupportedError:
+                return
+            except OSError:
+                # Lost connections and timeouts, ConnectionError included
+                sleep(1)
+            except Exception as e:
+                print(e)
+                return
+
+    def apply_changes(self, reset, changes):
+        if reset:
+            self.refresh()
+            return
+
+        try:
+            for kind, name, creation_time, size in changes:
+                names = [file[0] for file in self.files]
+                position = names.index(name) if name in names else None
+                if position is not None:
+                    del self.files[position]
+                    self.file_list.delete(position)
+
+                if kind == commands.FILE_DELETED:
+                    continue
+
+                file = (name, time.ctime(creation_time), str(size))
+                if position is None:
+                    self.files.append(file)
+                    self.file_list.insert('end', self.entry_text(*file))
+                else:
+                    self.files.insert(position, file)
+                    self.file_list.insert(position, self.entry_text(*file))
+
+        except Exception as e:
+            print(e)
+
     def delete_and_refresh(self):
         self.delete_file()
         self.refresh()
@@ -629,17 +700,35 @@ class SettingsFrame(ctk.CTkFrame):
                 spinbox.entry.delete(0, ctk.END)
                 spinbox.entry.insert(0, str(chunks))
                 app.chunks = chunks
+                app.auto_chunks = False
+                self.auto_checkbox.deselect()
             
             except ValueError:
                 print(f"\"{input}\" is not a valid int")
                 spinbox.entry.delete(0, ctk.END)
                 spinbox.entry.insert(0, str(app.chunks))
+
+        self.auto_checkbox = ctk.CTkCheckBox(
+            master=frame2,
+            text="Auto",
+            font=('Segoe UI',16, 'bold'),
+            command=lambda app=app: _on_auto_toggled(app)
+        )
+        self.auto_checkbox.pack(side="right", padx=16)
+
+        def _on_auto_toggled(app: App):
+            app.focus_set()
+            app.auto_chunks = bool(self.auto_checkbox.get())
     
     def refresh(self):
         self.server_ip_entry.delete(0, ctk.END)
         self.server_ip_entry.insert(0, str(app.server_ip))
         self.spinbox.entry.delete(0, ctk.END)
         self.spinbox.entry.insert(0, str(app.chunks))
+        if app.auto_chunks:
+            self.auto_checkbox.select()
+        else:
+            self.auto_checkbox.deselect()
 
 
 
@@ -807,13 +896,21 @@ class ProgressWindow(ctk.CTkToplevel):
                 text="0%",
                 font=('Segoe UI', 16, 'bold')
             )
-            self.progress_in_percentage.pack(padx=16, pady=(0, 16), anchor='w')
+            self.progress_in_percentage.pack(padx=16, anchor='w')
+
+            self.progress_on_wire = ctk.CTkLabel(
+                master=self,
+                text="0 on the wire",
+                font=('Segoe UI', 12)
+            )
+            self.progress_on_wire.pack(padx=16, pady=(0, 16), anchor='w')
 
             progress_bars = ctk.CTkFrame(master=self)
             progress_bars.pack(padx=16, pady=16)
 
             self.progress_bar_list: list[ctk.CTkProgressBar] = []
             self.current_progress: int = 0
+            self.wire_progress: int = 0
 
             for i in range(bar_count):
                 progress_bars.columnconfigure(i, weight=1)
@@ -827,11 +924,13 @@ class ProgressWindow(ctk.CTkToplevel):
         except Exception as e:
             print(e)
 
-    def track_progress(self, chunk_number, transferred, percentage):
+    def track_progress(self, chunk_number, transferred, percentage, wire_transferred):
         self.progress_bar_list[chunk_number].set(percentage)
         self.current_progress += transferred
+        self.wire_progress += wire_transferred
         self.progress_in_size.configure(text=f"{naturalsize(self.current_progress)} / {self.humanized_goal}")
         self.progress_in_percentage.configure(text=f"{self.current_progress / self.goal * 100:.2f}%")
+        self.progress_on_wire.configure(text=f"{naturalsize(self.wire_progress)} on the wire")
 
         if self.current_progress == self.goal:
             # print(f"{self.current_progress} {self.goal}")
@@ -845,6 +944,7 @@ class ProgressWindow(ctk.CTkToplevel):
 ftc: filetransferclient.FileTransferClient
 
 if __name__ == "__main__":
+    logs.configure()
     ftc = filetransferclient.FileTransferClient(61306)
     app = App()
     app.mainloop()
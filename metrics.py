@@ -0,0 +1,201 @@
+import time
+import socket
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import commands
+
+PREFIX = 'filetransfer'
+# Upper bounds in seconds of the latency histogram buckets, slower commands land in +Inf
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# name: (type, label, help) of everything the server records, in the order they are rendered.
+# Values labelled 'command' are kept by opcode and named after commands.NAMES when rendered
+METRICS = {
+    'bytes_received': ('counter', None, "Bytes read from client connections"),
+    'bytes_sent': ('counter', None, "Bytes written to client connections"),
+    'connections': ('counter', None, "Client connections accepted"),
+    'connections_active': ('gauge', None, "Client connections currently open"),
+    'commands_queued': ('gauge', None, "Commands waiting for a worker of the selector engine"),
+    'watchers_active': ('gauge', None, "Connections currently held by WATCH"),
+    'errors': ('counter', 'command', "Commands that failed, by opcode"),
+    'command_seconds': ('histogram', 'command', "Time spent serving a command, by opcode"),
+}
+
+
+
+class Metrics:
+    """Counters, gauges and latency histograms of the server.
+
+    Every thread updates a shard of its own, so recording takes no lock and never waits on
+    another thread: counters and gauges are kept as running sums of what was added to them
+    (gauges go up and down), histograms as bucket counts followed by the sum of the values.
+    `snapshot` adds the shards up, folding the ones of threads that have exited into the
+    totals so a thread per connection does not leave a shard per connection behind.
+    """
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards: list[tuple[threading.Thread, dict, dict]] = []
+        self._retired: tuple[dict, dict] = ({}, {})
+        self._started: float = time.time()
+
+    def _register(self) -> tuple[dict, dict]:
+        shard = ({}, {})
+        with self._lock:
+            self._retire()
+            self._shards.append((threading.current_thread(), *shard))
+        self._local.values, self._local.histograms = shard
+        return shard
+
+    def _retire(self):
+        alive = []
+        for thread, values, histograms in self._shards:
+            if thread.is_alive():
+                alive.append((thread, values, histograms))
+            else:
+                self._merge(self._retired, values, histograms)
+        self._shards = alive
+
+    def _merge(self, into: tuple[dict, dict], values: dict, histograms: dict):
+        total_values, total_histograms = into
+        # Another thread may be adding to the shard, copies are taken in one step under the GIL
+        for key, value in values.copy().items():
+            total_values[key] = total_values.get(key, 0) + value
+        for key, buckets in histograms.copy().items():
+            total = total_histograms.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 1) + [0.0])
+            for i, value in enumerate(buckets.copy()):
+                total[i] += value
+
+    def add(self, name: str, value: int = 1, label: object = None):
+        """Add `value` to a counter, or to a gauge, negative to take it down."""
+        try:
+            values = self._local.values
+        except AttributeError:
+            values = self._register()[0]
+        key = (name, label)
+        values[key] = values.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, label: object = None):
+        try:
+            histograms = self._local.histograms
+        except AttributeError:
+            histograms = self._register()[1]
+        key = (name, label)
+        buckets = histograms.get(key)
+        if buckets is None:
+            buckets = histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        buckets[-1] += seconds
+
+    def snapshot(self) -> tuple[dict, dict]:
+        """({(name, label): value}, {(name, label): [bucket counts..., +Inf count, sum]})"""
+        totals: tuple[dict, dict] = ({}, {})
+        with self._lock:
+            self._retire()
+            self._merge(totals, *self._retired)
+            for _, values, histograms in self._shards:
+                self._merge(totals, values, histograms)
+        return totals
+
+    def value(self, name: str, label: object = None) -> int:
+        """Current total of a counter or gauge."""
+        return self.snapshot()[0].get((name, label), 0)
+
+    def render(self) -> str:
+        """Everything recorded so far in the Prometheus text exposition format."""
+        values, histograms = self.snapshot()
+        lines: list[str] = []
+
+        def label_text(label_name: str | None, label: object) -> str:
+            return str(commands.NAMES.get(label, label) if label_name == 'command' else label)
+
+        def sample(name: str, label_name: str | None, label: object, value, extra: str = ''):
+            labels = []
+            if label_name is not None:
+                labels.append(f'{label_name}="{label_text(label_name, label)}"')
+            if extra:
+                labels.append(extra)
+            lines.append(f"{PREFIX}_{name}{'{' + ','.join(labels) + '}' if labels else ''} {value}")
+
+        lines += [f"# HELP {PREFIX}_uptime_seconds Seconds since the server started",
+                  f"# TYPE {PREFIX}_uptime_seconds gauge",
+                  f"{PREFIX}_uptime_seconds {time.time() - self._started:.3f}"]
+        for name, (kind, label_name, description) in METRICS.items():
+            exposed = f"{name}_total" if kind == 'counter' else name
+            lines += [f"# HELP {PREFIX}_{exposed} {description}", f"# TYPE {PREFIX}_{exposed} {kind}"]
+            if kind != 'histogram':
+                samples = {label: value for (key, label), value in values.items() if key == name}
+                if label_name is None:
+                    sample(exposed, None, None, samples.get(None, 0))
+                else:
+                    for label in sorted(samples, key=lambda label: label_text(label_name, label)):
+                        sample(exposed, label_name, label, samples[label])
+                continue
+
+            for (key, label), buckets in sorted(histograms.items(), key=lambda item: label_text(label_name, item[0][1])):
+                if key != name:
+                    continue
+                count = 0
+                for bound, bucket in zip((*LATENCY_BUCKETS, '+Inf'), buckets):
+                    count += bucket
+                    sample(f"{name}_bucket", label_name, label, count, f'le="{bound}"')
+                sample(f"{name}_sum", label_name, label, f"{buckets[-1]:.6f}")
+                sample(f"{name}_count", label_name, label, count)
+        return '\n'.join(lines) + '\n'
+
+
+
+class MeteredSocket(socket.socket):
+    """A client connection that adds the bytes going through it to `metrics`."""
+
+    def __init__(self, sock: socket.socket, metrics: Metrics) -> None:
+        timeout = sock.gettimeout()
+        super().__init__(sock.family, sock.type, sock.proto, fileno=sock.detach())
+        self.settimeout(timeout)
+        self.metrics = metrics
+
+    def recv(self, bufsize: int, flags: int = 0) -> bytes:
+        data = super().recv(bufsize, flags)
+        self.metrics.add('bytes_received', len(data))
+        return data
+
+    def recv_into(self, buffer, nbytes: int = 0, flags: int = 0) -> int:
+        size = super().recv_into(buffer, nbytes, flags)
+        self.metrics.add('bytes_received', size)
+        return size
+
+    def sendall(self, data, flags: int = 0):
+        super().sendall(data, flags)
+        self.metrics.add('bytes_sent', memoryview(data).nbytes)
+
+    def sendfile(self, file, offset: int = 0, count: int | None = None) -> int:
+        sent = super().sendfile(file, offset, count)
+        self.metrics.add('bytes_sent', sent)
+        return sent
+
+
+
+def serve_http(metrics: Metrics, address: tuple[str, int]) -> ThreadingHTTPServer:
+    """Answer GET /metrics on `address` with `metrics.render()` from a background thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    http_server = ThreadingHTTPServer(address, MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    return http_server
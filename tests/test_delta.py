@@ -0,0 +1,124 @@
+import random
+
+import commands
+import delta
+
+BLOCK_SIZE = delta.MIN_BLOCK_SIZE
+
+
+
+def random_bytes(size: int, seed: int = 0) -> bytes:
+    return random.Random(seed).randbytes(size)
+
+def signatures_of(base: bytes, block_size: int = BLOCK_SIZE) -> list[tuple[int, bytes]]:
+    return [(delta.weak_checksum(base[i:i + block_size]), delta.strong_checksum(base[i:i + block_size]))
+            for i in range(0, len(base), block_size)]
+
+def compute(data: bytes, base: bytes, block_size: int = BLOCK_SIZE) -> list[tuple[int, int, int]]:
+    return delta.compute_delta(data, len(base), signatures_of(base, block_size), block_size)
+
+def rebuild(instructions: list[tuple[int, int, int]], data: bytes, base: bytes) -> bytes:
+    return b''.join(base[offset:offset + length] if kind == delta.COPY else data[offset:offset + length]
+                    for kind, offset, length in instructions)
+
+def literal_size(instructions: list[tuple[int, int, int]]) -> int:
+    return sum(length for kind, _, length in instructions if kind == delta.LITERAL)
+
+
+
+def test_block_size_for_bounds():
+    assert delta.block_size_for(0) == delta.MIN_BLOCK_SIZE
+    assert delta.block_size_for(100 * 1024 * 1024) == 10 * 1024
+    assert delta.block_size_for(1 << 50) == commands.DIGEST_BLOCK_SIZE
+
+def test_roll_matches_adler32():
+    data = random_bytes(3 * BLOCK_SIZE)
+    checksum = delta.weak_checksum(data[:BLOCK_SIZE])
+    for position in range(100):
+        checksum = delta.roll(checksum, data[position], data[position + BLOCK_SIZE], BLOCK_SIZE)
+        assert checksum == delta.weak_checksum(data[position + 1:position + 1 + BLOCK_SIZE])
+
+def test_identical_data_is_one_copy():
+    base = random_bytes(10 * BLOCK_SIZE)
+    assert compute(base, base) == [(delta.COPY, 0, len(base))]
+
+def test_empty_data_and_empty_base():
+    base = random_bytes(3 * BLOCK_SIZE)
+    assert compute(b'', base) == []
+    data = random_bytes(2 * BLOCK_SIZE + 5)
+    assert compute(data, b'') == [(delta.LITERAL, 0, len(data))]
+
+def test_data_shorter_than_a_block_is_literal():
+    base = random_bytes(3 * BLOCK_SIZE)
+    assert compute(base[:100], base) == [(delta.LITERAL, 0, 100)]
+
+def test_insertion_sends_only_the_new_bytes():
+    base = random_bytes(20 * BLOCK_SIZE)
+    data = base[:7 * BLOCK_SIZE + 123] + random_bytes(50, 1) + base[7 * BLOCK_SIZE + 123:]
+    instructions = compute(data, base)
+    assert rebuild(instructions, data, base) == data
+    # The block the bytes went into has to be sent again, nothing else
+    assert literal_size(instructions) == BLOCK_SIZE + 50
+
+def test_shifted_data_matches_at_any_offset():
+    base = random_bytes(10 * BLOCK_SIZE)
+    data = b'x' * 17 + base
+    instructions = compute(data, base)
+    assert instructions == [(delta.LITERAL, 0, 17), (delta.COPY, 0, len(base))]
+
+def test_reordered_blocks_are_copied():
+    base = random_bytes(4 * BLOCK_SIZE)
+    blocks = [base[i:i + BLOCK_SIZE] for i in range(0, len(base), BLOCK_SIZE)]
+    data = blocks[2] + blocks[3] + blocks[0] + blocks[1]
+    instructions = compute(data, base)
+    # Copies of neighbouring blocks are merged
+    assert instructions == [(delta.COPY, 2 * BLOCK_SIZE, 2 * BLOCK_SIZE), (delta.COPY, 0, 2 * BLOCK_SIZE)]
+    assert rebuild(instructions, data, base) == data
+
+def test_short_last_block_matches_the_end_only():
+    base = random_bytes(5 * BLOCK_SIZE + 1000)
+    last = base[5 * BLOCK_SIZE:]
+
+    appended = base + b'tail'
+    instructions = compute(appended, base)
+    assert rebuild(instructions, appended, base) == appended
+    assert instructions[-1] == (delta.LITERAL, len(base) - len(last), len(last) + 4)
+
+    # The same bytes in the middle of the data are not taken for the short block
+    inside = last + base[:5 * BLOCK_SIZE]
+    instructions = compute(inside, base)
+    assert rebuild(instructions, inside, base) == inside
+    assert instructions[0] == (delta.LITERAL, 0, len(last))
+
+    prefixed = random_bytes(300, 2) + base
+    instructions = compute(prefixed, base)
+    assert rebuild(instructions, prefixed, base) == prefixed
+    assert instructions[-1] == (delta.COPY, 0, len(base))
+
+def test_unrelated_data_is_one_literal(monkeypatch):
+    rolls: list[int] = []
+    roll = delta.roll
+    monkeypatch.setattr(delta, 'roll', lambda *args: rolls.append(1) or roll(*args))
+    base = random_bytes(20 * BLOCK_SIZE)
+    data = random_bytes(50 * BLOCK_SIZE + 7, 3)
+    assert compute(data, base) == [(delta.LITERAL, 0, len(data))]
+    # Rolling stops ROLL_LIMIT blocks past the last match and the search skips ahead from there
+    assert len(rolls) < len(data) // 2
+
+def test_skip_ahead_finds_the_base_again():
+    base = random_bytes(64 * BLOCK_SIZE)
+    junk = random_bytes(20 * BLOCK_SIZE + 11, 4)
+    data = junk + base
+    instructions = compute(data, base)
+    assert rebuild(instructions, data, base) == data
+    # Jumps double from one block, so at most the last jump plus the rolling window is overshot
+    assert literal_size(instructions) < len(junk) + 16 * BLOCK_SIZE
+    assert instructions[-1][0] == delta.COPY and sum(instructions[-1][1:]) == len(base)
+
+def test_rolling_resumes_after_a_match():
+    base = random_bytes(40 * BLOCK_SIZE)
+    junk = random_bytes(30 * BLOCK_SIZE, 5)
+    data = base[:4 * BLOCK_SIZE] + junk + base[4 * BLOCK_SIZE:]
+    instructions = compute(data, base)
+    assert rebuild(instructions, data, base) == data
+    assert instructions[0] == (delta.COPY, 0, 4 * BLOCK_SIZE)
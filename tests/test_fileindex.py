@@ -0,0 +1,157 @@
+import threading
+
+import pytest
+
+import commands
+import fileindex
+from fileindex import FileIndex, encode_cursor, decode_cursor
+
+FILES = {
+    'a.txt': (30.0, 300),
+    'b/one.bin': (10.0, 100),
+    'b/two.bin': (20.0, 200),
+    'b/three.txt': (50.0, 200),
+    'c.bin': (40.0, 50),
+}
+
+
+
+def make_index() -> FileIndex:
+    index = FileIndex()
+    for name, (ctime, size) in FILES.items():
+        index.put(name, ctime, size)
+    return index
+
+def names(entries: list[tuple[str, float, int]]) -> list[str]:
+    return [name for name, _, _ in entries]
+
+def all_pages(index: FileIndex, limit: int, **options) -> list[list[str]]:
+    pages, cursor = [], None
+    while True:
+        entries, cursor = index.page(limit=limit, cursor=cursor, **options)
+        pages.append(names(entries))
+        if cursor is None:
+            return pages
+
+
+
+@pytest.mark.parametrize('sort', fileindex.SORT_KEYS)
+@pytest.mark.parametrize('descending', (False, True))
+def test_pages_cover_every_file_once_in_order(sort, descending):
+    index = make_index()
+    position = {'name': None, 'ctime': 0, 'size': 1}[sort]
+    expected = sorted(FILES, key=lambda name: (name if position is None else FILES[name][position], name), reverse=descending)
+    for limit in range(1, len(FILES) + 2):
+        pages = all_pages(index, limit, sort=sort, descending=descending)
+        assert [name for page in pages for name in page] == expected
+        assert all(len(page) <= limit for page in pages)
+
+def test_ties_are_ordered_by_name():
+    index = make_index()
+    assert names(index.page(sort='size', limit=10)[0]) == ['c.bin', 'b/one.bin', 'b/three.txt', 'b/two.bin', 'a.txt']
+    pages = all_pages(index, 1, sort='size', descending=True)
+    assert [name for page in pages for name in page] == ['a.txt', 'b/two.bin', 'b/three.txt', 'b/one.bin', 'c.bin']
+
+def test_last_full_page_has_no_cursor():
+    index = make_index()
+    entries, cursor = index.page(limit=len(FILES))
+    assert len(entries) == len(FILES) and cursor is None
+
+@pytest.mark.parametrize('descending', (False, True))
+def test_prefix(descending):
+    index = make_index()
+    expected = sorted(['b/one.bin', 'b/three.txt', 'b/two.bin'], reverse=descending)
+    pages = all_pages(index, 2, pattern='b/', descending=descending)
+    assert [name for page in pages for name in page] == expected
+    assert names(index.page('zzz', descending=descending)[0]) == []
+
+@pytest.mark.parametrize('sort', fileindex.SORT_KEYS)
+def test_glob(sort):
+    index = make_index()
+    assert sorted(names(index.page('*.txt', glob=True, sort=sort)[0])) == ['a.txt', 'b/three.txt']
+    assert names(index.page('b/t*', glob=True, descending=True)[0]) == ['b/two.bin', 'b/three.txt']
+    pages = all_pages(index, 1, pattern='b/*.bin', glob=True, sort=sort)
+    assert sorted(name for page in pages for name in page) == ['b/one.bin', 'b/two.bin']
+
+def test_cursor_of_a_removed_entry_still_resumes():
+    index = make_index()
+    entries, cursor = index.page(limit=2)
+    assert names(entries) == ['a.txt', 'b/one.bin']
+    index.remove('b/one.bin')
+    assert names(index.page(limit=10, cursor=cursor)[0]) == ['b/three.txt', 'b/two.bin', 'c.bin']
+    entries, cursor = index.page(limit=2, descending=True)
+    index.remove('b/two.bin')
+    assert names(index.page(limit=10, cursor=cursor, descending=True)[0]) == ['b/three.txt', 'a.txt']
+
+def test_put_replaces_the_entry():
+    index = make_index()
+    index.put('c.bin', 5.0, 1000)
+    assert index.get('c.bin') == (5.0, 1000)
+    assert names(index.page(sort='ctime', limit=1)[0]) == ['c.bin']
+    assert names(index.page(sort='size', descending=True, limit=1)[0]) == ['c.bin']
+    assert len(index.listing().splitlines()) == len(FILES)
+
+@pytest.mark.parametrize('sort', fileindex.SORT_KEYS)
+def test_cursor_round_trip(sort):
+    index = make_index()
+    _, cursor = index.page(sort=sort, limit=2)
+    assert decode_cursor(sort, encode_cursor(sort, cursor)) == cursor
+    assert decode_cursor(sort, b'') is None
+
+
+
+def test_changes_since_follows_every_change():
+    index = FileIndex()
+    changes, start, reset = index.changes_since(0, 0)
+    assert changes == [] and not reset
+
+    index.put('x', 1.0, 10)
+    index.put('x', 2.0, 20, commands.FILE_COMPLETED)
+    index.remove('x')
+    index.remove('x')
+    changes, token, reset = index.changes_since(start, 0)
+    assert not reset and token == start + 3
+    assert changes == [(commands.FILE_ADDED, 'x', 1.0, 10), (commands.FILE_COMPLETED, 'x', 2.0, 20), (commands.FILE_DELETED, 'x', 0.0, 0)]
+    assert index.changes_since(start + 2, 0)[0] == [(commands.FILE_DELETED, 'x', 0.0, 0)]
+    assert index.changes_since(token, 0) == ([], token, False)
+
+def test_token_zero_starts_from_now():
+    index = make_index()
+    changes, token, reset = index.changes_since(0, 0)
+    assert changes == [] and not reset
+    index.put('new', 1.0, 1)
+    assert index.changes_since(token, 0)[0] == [(commands.FILE_ADDED, 'new', 1.0, 1)]
+
+def test_unknown_tokens_reset():
+    index = make_index()
+    _, token, _ = index.changes_since(0, 0)
+    assert index.changes_since(token + 1, 0) == ([], token, True)
+    assert index.changes_since(1, 0) == ([], token, True)
+    # Tokens of an earlier run of the server are older than this one's
+    assert index.changes_since(token - len(FILES) - 1, 0)[2]
+    assert not index.changes_since(token - len(FILES), 0)[2]
+
+def test_tokens_rolled_out_of_the_history_reset(monkeypatch):
+    monkeypatch.setattr(fileindex, 'CHANGE_HISTORY', 4)
+    index = FileIndex()
+    _, start, _ = index.changes_since(0, 0)
+    for i in range(6):
+        index.put(f"f{i}", 0.0, i)
+    _, token, _ = index.changes_since(0, 0)
+    assert index.changes_since(start, 0) == ([], token, True)
+    assert index.changes_since(start + 1, 0) == ([], token, True)
+    changes, _, reset = index.changes_since(start + 2, 0)
+    assert not reset and [name for _, name, _, _ in changes] == ['f2', 'f3', 'f4', 'f5']
+
+def test_changes_since_waits_for_a_change():
+    index = FileIndex()
+    _, token, _ = index.changes_since(0, 0)
+    timer = threading.Timer(0.05, index.put, ('late', 1.0, 1))
+    timer.start()
+    try:
+        changes, new_token, reset = index.changes_since(token, 5)
+    finally:
+        timer.join()
+    assert changes == [(commands.FILE_ADDED, 'late', 1.0, 1)] and new_token == token + 1 and not reset
+    assert index.wait(new_token, 0.01) == new_token
+    assert index.wait(token, 5) == new_token
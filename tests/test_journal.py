@@ -0,0 +1,129 @@
+import random
+
+import pytest
+
+import commands
+from journal import RangeJournal, BlockDigests, merge_range, missing_ranges
+
+
+
+def covered(ranges: list[tuple[int, int]]) -> set[int]:
+    return {i for start, end in ranges for i in range(start, end + 1)}
+
+
+
+@pytest.mark.parametrize('ranges, added, expected', [
+    ([], (0, 9), [(0, 9)]),
+    ([(0, 9)], (20, 29), [(0, 9), (20, 29)]),
+    ([(20, 29)], (0, 9), [(0, 9), (20, 29)]),
+    # Neighbours merge even without overlapping
+    ([(0, 9)], (10, 19), [(0, 19)]),
+    ([(10, 19)], (0, 9), [(0, 19)]),
+    ([(0, 9)], (11, 19), [(0, 9), (11, 19)]),
+    ([(0, 9), (20, 29)], (10, 19), [(0, 29)]),
+    ([(0, 9), (20, 29), (40, 49)], (5, 44), [(0, 49)]),
+    ([(0, 9), (20, 29), (40, 49)], (21, 25), [(0, 9), (20, 29), (40, 49)]),
+    ([(10, 19)], (0, 30), [(0, 30)]),
+    ([(5, 5)], (5, 5), [(5, 5)]),
+])
+def test_merge_range(ranges, added, expected):
+    assert merge_range(ranges, *added) == expected
+
+def test_merge_range_leaves_its_input_alone():
+    ranges = [(0, 9), (20, 29)]
+    merge_range(ranges, 10, 19)
+    assert ranges == [(0, 9), (20, 29)]
+
+def test_merge_range_matches_a_set_of_bytes():
+    rng = random.Random(0)
+    for _ in range(200):
+        ranges: list[tuple[int, int]] = []
+        added: set[int] = set()
+        for _ in range(rng.randrange(1, 10)):
+            start = rng.randrange(100)
+            end = min(99, start + rng.randrange(20))
+            ranges = merge_range(ranges, start, end)
+            added |= set(range(start, end + 1))
+        assert covered(ranges) == added
+        assert ranges == sorted(ranges)
+        # Disjoint and never touching, or they would have been merged
+        assert all(end + 1 < start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+
+@pytest.mark.parametrize('completed, size, expected', [
+    ([], 0, []),
+    ([], 10, [(0, 9)]),
+    ([(0, 9)], 10, []),
+    ([(0, 4)], 10, [(5, 9)]),
+    ([(5, 9)], 10, [(0, 4)]),
+    ([(2, 3), (6, 7)], 10, [(0, 1), (4, 5), (8, 9)]),
+    # Overlapping or contained ranges from older journals
+    ([(0, 5), (3, 4)], 10, [(6, 9)]),
+    ([(0, 5), (2, 7)], 10, [(8, 9)]),
+])
+def test_missing_ranges(completed, size, expected):
+    assert missing_ranges(completed, size) == expected
+
+def test_missing_ranges_complements_merge_range():
+    rng = random.Random(1)
+    for _ in range(200):
+        size = rng.randrange(1, 100)
+        completed: list[tuple[int, int]] = []
+        for _ in range(rng.randrange(5)):
+            start = rng.randrange(size)
+            completed = merge_range(completed, start, min(size - 1, start + rng.randrange(10)))
+        missing = missing_ranges(completed, size)
+        assert covered(missing) == set(range(size)) - covered(completed)
+        for start, end in missing:
+            completed = merge_range(completed, start, end)
+        assert completed == [(0, size - 1)]
+
+
+
+def test_range_journal_round_trip(tmp_path):
+    path = str(tmp_path / 'file.json')
+    journal = RangeJournal(path, 100)
+    journal.save()
+    journal.add(50, 59)
+    journal.add(0, 9)
+    journal.add(10, 19)
+
+    loaded = RangeJournal.load(path)
+    assert loaded.size == 100
+    assert loaded.completed() == [(0, 19), (50, 59)]
+    assert loaded.missing() == [(20, 49), (60, 99)]
+    assert not loaded.is_complete()
+    loaded.add(20, 99)
+    assert RangeJournal.load(path).is_complete()
+
+    journal.remove()
+    journal.remove()
+    assert RangeJournal.load(path) is None
+
+def test_empty_file_journal_is_complete(tmp_path):
+    assert RangeJournal(str(tmp_path / 'empty.json'), 0).is_complete()
+
+def test_damaged_journal_does_not_load(tmp_path):
+    path = tmp_path / 'bad.json'
+    path.write_text('{"size": 10')
+    assert RangeJournal.load(str(path)) is None
+
+
+
+def test_block_digests_only_whole_blocks(tmp_path):
+    size = 2 * commands.DIGEST_BLOCK_SIZE + 10
+    digests = BlockDigests(str(tmp_path / 'file.digests'), size)
+    assert digests.block_count() == 3
+    assert digests.digests() == [None, None, None]
+    assert digests.file_digest() is None
+
+    first, last = b'\1' * commands.DIGEST_SIZE, b'\3' * commands.DIGEST_SIZE
+    digests.record(0, commands.DIGEST_BLOCK_SIZE - 1, first)
+    # Part of a block is not recorded, the short last block is whole
+    digests.record(commands.DIGEST_BLOCK_SIZE, commands.DIGEST_BLOCK_SIZE + 99, b'\2' * commands.DIGEST_SIZE)
+    digests.record(2 * commands.DIGEST_BLOCK_SIZE, size - 1, last)
+    assert digests.digests() == [first, None, last]
+    assert digests.digests(2, 1) == [last]
+    assert digests.file_digest() is None
+
+    digests.record(commands.DIGEST_BLOCK_SIZE, 2 * commands.DIGEST_BLOCK_SIZE - 1, b'\2' * commands.DIGEST_SIZE)
+    assert digests.file_digest() is not None
@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import random
+import functools
+import threading
+import contextlib
+from collections import deque
+from contextvars import ContextVar
+
+# Spans kept in memory, the oldest are dropped past this
+TRACE_EVENTS = 1000000
+
+# Transfer the current thread works for, spans are tagged with it. Client streams inherit it
+# through the context they are started in, the server sets it from the id a command carries
+transfer_id: ContextVar[int | None] = ContextVar('transfer_id', default=None)
+
+
+
+def new_transfer_id() -> int:
+    return random.getrandbits(63) + 1
+
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'category', 'args', 'start')
+
+    def __init__(self, tracer: 'Tracer', name: str, category: str, args: dict) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self) -> 'Span':
+        self.start = time.time_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, self.category, self.start, time.time_ns(), self.args)
+
+
+
+class Tracer:
+    """Opt-in timing of the phases of every transfer, written out as Chrome trace events so
+    the streams of a transfer line up on a timeline (chrome://tracing, Perfetto).
+
+    Off by default, `span` then hands back one shared context that does nothing. Once
+    enabled, every span records its wall clock start and duration, thread and the transfer
+    it belongs to, so the traces of a client and a server can be loaded side by side.
+    """
+
+    def __init__(self) -> None:
+        self.enabled: bool = False
+        self.process_name: str = 'filetransfer'
+        self._events: deque[dict] = deque(maxlen=TRACE_EVENTS)
+        # Names of the threads seen, taken as they record since streams are gone by the export
+        self._threads: dict[int, str] = {}
+
+    def enable(self, process_name: str):
+        self.process_name = process_name
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def span(self, name: str, category: str = 'transfer', **args):
+        """Context that records the time spent in it, `args` go with the event."""
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, category, args)
+
+    def record(self, name: str, category: str, start_ns: int, end_ns: int, args: dict):
+        transfer = transfer_id.get()
+        if transfer is not None:
+            args = {'transfer': f"{transfer:016x}", **args}
+        tid = threading.get_native_id()
+        if tid not in self._threads:
+            self._threads[tid] = threading.current_thread().name
+        # deque.append is atomic, spans of many threads need no lock
+        self._events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': start_ns / 1000,
+            'dur': (end_ns - start_ns) / 1000,
+            'pid': os.getpid(),
+            'tid': tid,
+            'args': args,
+        })
+
+    def events(self) -> list[dict]:
+        """Recorded spans with the metadata events naming the process and its threads."""
+        events = list(self._events)
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': self.process_name}}]
+        for tid in sorted({event['tid'] for event in events}):
+            metadata.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': self._threads.get(tid, str(tid))}})
+        return metadata + events
+
+    def export(self, path: str):
+        """Write the Chrome trace event JSON of everything recorded so far to `path`."""
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as file:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, file)
+        os.replace(temporary_path, path)
+
+    def clear(self):
+        self._events.clear()
+        self._threads.clear()
+
+
+NO_SPAN = contextlib.nullcontext()
+
+tracer = Tracer()
+
+
+
+def transfer(name: str):
+    """Decorate a client method that moves files: when tracing, each call outside another
+    transfer gets a new transfer id, and the call is a span of its own either way."""
+    def decorate(function):
+        @functools.wraps(function)
+        def traced(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            token = transfer_id.set(transfer_id.get() or new_transfer_id())
+            try:
+                with tracer.span(name):
+                    return function(*args, **kwargs)
+            finally:
+                transfer_id.reset(token)
+        return traced
+    return decorate